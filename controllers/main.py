@@ -3,16 +3,140 @@
 import logging
 import os
 
-from werkzeug.exceptions import Forbidden, abort
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import Forbidden, RequestedRangeNotSatisfiable, abort
 from werkzeug.wrappers import Response
 from werkzeug.wsgi import wrap_file
 
 from odoo import _, fields, http
-from odoo.http import request
+from odoo.http import content_disposition, request
+
+from ..models.oomusic_transcoder import CacheWriter, FixedLengthStream, TranscodeBusy
 
 _logger = logging.getLogger(__name__)
 
 
+def send_file_range(filepath, mimetype, filename=None):
+    """
+    Send a file with the support of byte ranges, which allows seeking in the file. Unlike
+    `http.send_file`, the Range header of the request is taken into account. The modification date
+    of the file is updated, since it is used for the eviction of the transcoding and archive
+    caches.
+
+    :param str filepath: path of the file to send
+    :param str mimetype: mimetype of the file
+    :param str filename: if set, the file is sent as an attachment with this name
+    :raises FileNotFoundError: if the file does not exist, e.g. it was evicted from the cache
+    """
+    # Once opened, the file can be sent even if it is evicted from the cache in the meantime
+    f = open(filepath, "rb")
+    try:
+        os.utime(filepath)
+    except OSError:
+        pass
+    size = os.fstat(f.fileno()).st_size
+    data = wrap_file(request.httprequest.environ, f)
+    rv = Response(data, mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = size
+    if filename:
+        rv.headers["Content-Disposition"] = content_disposition(filename)
+    rv.set_etag("{}-{}".format(os.path.basename(filepath), size))
+    return rv.make_conditional(request.httprequest, accept_ranges=True, complete_length=size)
+
+
+def send_zip(tracks, filename, flatten=False, cache=False):
+    """
+    Send a ZIP archive of tracks, generated while it is sent. The length of the archive is known
+    in advance, so the client can display the progress of the download.
+
+    If `cache` is set, the archive is built once in the archive cache, then sent from there with
+    the support of byte ranges. It is useful for archives downloaded several times, such as the
+    ones of shared links. The archive is streamed if it does not fit in the cache, or if it was
+    evicted from the cache before being sent.
+
+    :param tracks: tracks to send
+    :param str filename: name of the archive
+    :param bool flatten: put all the files at the root of the archive
+    :param bool cache: use the archive cache
+    """
+    z_name = cache and tracks._build_zip(flatten=flatten)
+    if z_name:
+        try:
+            return send_file_range(z_name, "application/zip", filename="{}.zip".format(filename))
+        except FileNotFoundError:
+            _logger.debug('Archive "%s" was evicted from the cache', z_name)
+
+    stream = tracks._zip_stream(flatten=flatten)
+    rv = Response(stream, mimetype="application/zip", direct_passthrough=True)
+    rv.content_length = len(stream)
+    rv.headers["Content-Disposition"] = content_disposition("{}.zip".format(filename))
+    return rv
+
+
+def send_transcode(Transcoder, track_id, bitrate=0, seek=0, norm=False, estimate=False):
+    """
+    Send the transcoded output of a track.
+    - If the output is in the transcoding cache, the file is sent directly.
+    - If the length of the output can be estimated (constant bitrate) and a byte range is
+      requested, the range is converted into a time offset and a `206 Partial Content` response
+      is sent. The range is read from the cache file being written if it is already available.
+    - If `estimate` is set, i.e. the client asked for it, the estimated length is announced. The
+      output is padded to this length.
+    - Otherwise, the output is streamed without length.
+
+    :param Transcoder: transcoder to use
+    :param int track_id: ID of the track to transcode
+    :param int bitrate: value of the bitrate for the output file
+    :param int seek: start time for the encoding
+    :param bool norm: normalization of the output
+    :param bool estimate: announce the estimated length of the output
+    :raises TranscodeBusy: if the transcoding job could not be started
+    """
+    mimetype = Transcoder.output_format.mimetype
+    cache_path = not seek and Transcoder._get_cache_path(track_id, bitrate=bitrate, norm=norm)
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            return send_file_range(cache_path, mimetype)
+        except FileNotFoundError:
+            pass
+
+    length = not seek and Transcoder._estimate_length(track_id, bitrate=bitrate)
+    http_range = request.httprequest.range
+    start, stop, status = 0, length, 200
+    if length and http_range:
+        rng = http_range.range_for_length(length)
+        if rng is None:
+            raise RequestedRangeNotSatisfiable(length=length)
+        start, stop = rng
+        status = 206
+
+    generator = start and cache_path and Transcoder._open_part(cache_path, start)
+    if not generator:
+        if start:
+            duration = request.env["oomusic.track"].browse([track_id]).duration
+            seek = float(start) * duration / length
+        generator = Transcoder.transcode_stream(track_id, bitrate=bitrate, seek=seek, norm=norm)
+    if status == 206 or (length and estimate):
+        generator = FixedLengthStream(
+            generator, stop - start, drain=isinstance(generator, CacheWriter)
+        )
+    # Set a buffer size of 200 KB. The default value (8 KB) seems too small and leads to chunk
+    # download errors. Since the player is not fault-tolerant, a single download error leads to
+    # a complete stop of the music. Maybe consider this value as a user option for people with
+    # bad network.
+    data = wrap_file(
+        request.httprequest.environ, generator, buffer_size=Transcoder.buffer_size * 1024
+    )
+    rv = Response(data, status=status, mimetype=mimetype, direct_passthrough=True)
+    if length:
+        rv.accept_ranges = "bytes"
+    if status == 206 or (length and estimate):
+        rv.content_length = stop - start
+    if status == 206:
+        rv.content_range = ContentRange("bytes", start, stop, length)
+    return rv
+
+
 class MusicController(http.Controller):
     @http.route(["/oomusic/down"], auth="public", type="http")
     def down(self, **kwargs):
@@ -39,9 +163,7 @@ class MusicController(http.Controller):
         # Get the ZIP file
         obj_sudo = request.env[down.res_model].sudo().browse(down.res_id)
         tracks = obj_sudo._get_track_ids()
-        return http.send_file(
-            tracks._build_zip(flatten=down.flatten, name=kwargs["token"]), as_attachment=True
-        )
+        return send_zip(tracks, obj_sudo.display_name, flatten=down.flatten, cache=True)
 
     @http.route(["/oomusic/down_user"], auth="user", type="http")
     def down_user(self, **kwargs):
@@ -50,7 +172,7 @@ class MusicController(http.Controller):
             abort(404)
         tracks = obj._get_track_ids()
         flatten = bool(int(kwargs.get("flatten", "0")))
-        return http.send_file(tracks._build_zip(flatten=flatten), as_attachment=True)
+        return send_zip(tracks, obj.display_name, flatten=flatten)
 
     @http.route(["/oomusic/trans/<int:track_id>.<string:output_format>"], type="http", auth="user")
     def trans(self, track_id, output_format, **kwargs):
@@ -70,29 +192,17 @@ class MusicController(http.Controller):
         elif mode == "raw" and seek:
             Transcoder = request.env.ref("oomusic.oomusic_transcoder_99")
         else:
-            Transcoder = (
-                request.env["oomusic.transcoder"]
-                .search([("output_format.name", "=", output_format)])
-                .filtered(lambda r: fn_ext[1:] not in r.mapped("black_formats.name"))
+            Transcoder = request.env["oomusic.transcoder"]._get_transcoder(
+                output_format, fn_ext[1:]
             )
-        Transcoder = Transcoder[0] if Transcoder else False
 
         if Transcoder:
-            generator = Transcoder.transcode(
-                track_id, seek=seek, norm=True if mode == "norm" else False
-            ).stdout
-            mimetype = Transcoder.output_format.mimetype
+            norm = True if mode == "norm" else False
+            try:
+                return send_transcode(Transcoder, track_id, seek=seek, norm=norm)
+            except TranscodeBusy:
+                _logger.warning("Too many transcoding jobs, could not transcode track %s", track_id)
+                abort(503)
         else:
             _logger.warning("Could not find converter from '%s' to '%s'", fn_ext[1:], output_format)
             return http.send_file(Track.path)
-
-        # FIXME: see http://librelist.com/browser/flask/2011/10/5/response-to-a-range-request/#1e95dd715f412161d3db2fc8aaf8666f
-
-        # Set a buffer size of 200 KB. The default value (8 KB) seems too small and leads to chunk
-        # download errors. Since the player is not fault-tolerant, a single download error leads to
-        # a complete stop of the music. Maybe consider this value as a user option for people with
-        # bad network.
-        data = wrap_file(
-            request.httprequest.environ, generator, buffer_size=Transcoder.buffer_size * 1024
-        )
-        return Response(data, mimetype=mimetype, direct_passthrough=True)
@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 
 from .common import SubsonicREST
@@ -21,7 +19,7 @@ class MusicSubsonicBookmarks(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_bookmarks = rest.make_Bookmarks()
         root.append(xml_bookmarks)
 
@@ -49,6 +47,6 @@ class MusicSubsonicBookmarks(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
@@ -2,8 +2,6 @@
 
 import logging
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
@@ -26,7 +24,12 @@ class MusicSubsonicBrowsing(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        # The library did not change since the response was built
+        response = rest.get_cached_response(kwargs)
+        if response:
+            return response
+
+        root = rest.make_root()
         xml_music_folders = rest.make_MusicFolders()
         root.append(xml_music_folders)
 
@@ -49,6 +52,11 @@ class MusicSubsonicBrowsing(http.Controller):
         if not success:
             return response
 
+        # The library did not change since the response was built
+        response = rest.get_cached_response(kwargs)
+        if response:
+            return response
+
         ifModifiedSince = kwargs.get("ifModifiedSince")
         if ifModifiedSince:
             try:
@@ -69,7 +77,7 @@ class MusicSubsonicBrowsing(http.Controller):
             if not folder.exists():
                 return rest.make_error(code="70", message="Folder not found")
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_indexes = rest.make_Indexes(folder)
         root.append(xml_indexes)
 
@@ -88,9 +96,7 @@ class MusicSubsonicBrowsing(http.Controller):
                 xml_index.append(xml_data)
 
         # List of tracks
-        for track in folder.track_ids:
-            xml_data = rest.make_Child_track(track)
-            xml_indexes.append(xml_data)
+        xml_indexes.extend(rest.make_Child_tracks(folder.track_ids))
 
         return rest.make_response(root)
 
@@ -115,19 +121,15 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_directory = rest.make_Directory(folder)
         root.append(xml_directory)
 
         # List of folders
-        for child in folder.child_ids:
-            xml_data = rest.make_Child_folder(child)
-            xml_directory.append(xml_data)
+        xml_directory.extend(rest.make_Child_folders(folder.child_ids))
 
         # List of tracks
-        for track in folder.track_ids:
-            xml_data = rest.make_Child_track(track)
-            xml_directory.append(xml_data)
+        xml_directory.extend(rest.make_Child_tracks(folder.track_ids))
 
         return rest.make_response(root)
 
@@ -144,7 +146,12 @@ class MusicSubsonicBrowsing(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        # The library did not change since the response was built
+        response = rest.get_cached_response(kwargs)
+        if response:
+            return response
+
+        root = rest.make_root()
         xml_genres = rest.make_Genres()
         root.append(xml_genres)
 
@@ -163,7 +170,12 @@ class MusicSubsonicBrowsing(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        # The library did not change since the response was built
+        response = rest.get_cached_response(kwargs)
+        if response:
+            return response
+
+        root = rest.make_root()
         xml_artists = rest.make_ArtistsID3()
         root.append(xml_artists)
 
@@ -213,7 +225,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_artist = rest.make_ArtistID3(artist)
         root.append(xml_artist)
 
@@ -244,13 +256,11 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_album = rest.make_AlbumID3(album)
         root.append(xml_album)
 
-        for track in album.track_ids:
-            xml_song = rest.make_Child_track(track, tag_name="song")
-            xml_album.append(xml_song)
+        xml_album.extend(rest.make_Child_tracks(album.track_ids, tag_name="song"))
 
         return rest.make_response(root)
 
@@ -275,7 +285,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song = rest.make_Child_track(track, tag_name="song")
         root.append(xml_song)
 
@@ -294,7 +304,7 @@ class MusicSubsonicBrowsing(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_videos = rest.make_Videos()
         root.append(xml_videos)
 
@@ -343,7 +353,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             includeNotPresent = False
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_artist_info = rest.make_ArtistInfo(
             folder, count=count, includeNotPresent=includeNotPresent
         )
@@ -378,7 +388,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             includeNotPresent = False
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_artist_info = rest.make_ArtistInfo2(
             artist, count=count, includeNotPresent=includeNotPresent
         )
@@ -407,7 +417,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_album_info = rest.make_AlbumInfo(folder)
         root.append(xml_album_info)
 
@@ -434,7 +444,7 @@ class MusicSubsonicBrowsing(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_album_info = rest.make_AlbumInfo2(album)
         root.append(xml_album_info)
 
@@ -474,7 +484,7 @@ class MusicSubsonicBrowsing(http.Controller):
         count = int(kwargs.get("count", 50))
         tag_name = kwargs.get("tag_name", "similarSongs2")
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song_info = rest.make_SimilarSongs2(track, count=count, tag_name=tag_name)
         root.append(xml_song_info)
 
@@ -501,7 +511,7 @@ class MusicSubsonicBrowsing(http.Controller):
 
         count = int(kwargs.get("count", 50))
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song_info = rest.make_TopSongs(artist_name, count=count)
         root.append(xml_song_info)
 
@@ -5,6 +5,8 @@ import hashlib
 import logging
 import mimetypes
 import os
+import threading
+import time
 from collections import OrderedDict
 from pprint import pformat
 
@@ -12,11 +14,19 @@ from lxml import etree
 
 from odoo import fields
 from odoo.exceptions import AccessError
-from odoo.http import request
+from odoo.http import Response, request
 
+from ...models.res_users import subsonic_credential_checked
 from . import xml2json
 
 _logger = logging.getLogger(__name__)
+
+# Serialized responses of the browsing endpoints, by database and ETag. Since the ETag contains
+# the library generation, an outdated entry is never used and is evicted with the least recently
+# used ones.
+_payload_cache = OrderedDict()
+_payload_cache_lock = threading.Lock()
+
 API_VERSION_LIST = {
     "1.16.1": 18,
     "1.16.0": 17,
@@ -49,6 +59,8 @@ API_ERROR_LIST = {
     "60": "The trial period for the Subsonic server is over. Please upgrade to Subsonic Premium.",
     "70": "The requested data was not found.",
 }
+# Maximum number of responses in the payload cache
+PAYLOAD_CACHE_SIZE = 64
 IGNORED_ARTICLES = ["The", "El", "La", "Los", "Las", "Le", "Les"]
 
 
@@ -70,72 +82,171 @@ class SubsonicREST:
         if self.version_server == "1.16.1" and self.client == "Ultrasonic":
             self.version_server = "1.16.0"
 
+        # ETag of the response, see `get_cached_response`
+        self.etag = None
+        self.payload_etag = None
+
+        # Format parameters, read on first use
+        self._trans_disabled = None
+        self._format_name = None
+
     def _dt_to_string(self, dt):
         dt_string = fields.Datetime.to_string(dt)
         return dt_string.replace(" ", "T") + "Z"
 
+    def Element(self, tag, attrib=None, **extra):
+        """
+        Create an element of the response. The JSON formats use a plain element converted directly
+        into JSON, instead of an XML element converted into XML then parsed back.
+        """
+        if self.format in ("json", "jsonp"):
+            return xml2json.JsonElement(tag, attrib, **extra)
+        return etree.Element(tag, attrib, **extra)
+
+    def SubElement(self, parent, tag, attrib=None, **extra):
+        if self.format in ("json", "jsonp"):
+            return xml2json.JsonSubElement(parent, tag, attrib, **extra)
+        return etree.SubElement(parent, tag, attrib, **extra)
+
+    def make_root(self, status="ok"):
+        return self.Element("subsonic-response", status=status, version=self.version_server)
+
+    def get_cached_response(self, kwargs, payload=True):
+        """
+        Validate the request against the library generation, before building anything. The ETag
+        is made of the generation and of the last change of the preferences of the user, and of
+        the request. It changes as soon as the library of the user, or a preference (favorite,
+        rating, play count...), changes. When the folders are shared amongst all users, the
+        generations of all users are summed, since the library of any user is visible.
+        - If the client already has the response (If-None-Match), a 304 response is returned.
+        - If `payload` is set and the response is in the payload cache, it is returned.
+        - Otherwise, the ETag is kept so that `make_response` sends it and caches the payload.
+
+        :param dict kwargs: parameters of the request
+        :param bool payload: use the payload cache
+        :returns: the response, or None if it must be built
+        """
+        sharing = request.env["res.users"]._get_oomusic_folder_sharing()
+        request.env.cr.execute(
+            """
+            SELECT
+                CASE WHEN %s
+                    THEN (SELECT COALESCE(sum(oomusic_generation), 0) FROM res_users)
+                    ELSE COALESCE(u.oomusic_generation, 0)
+                END, (
+                    SELECT max(p.write_date) FROM oomusic_preference p WHERE p.user_id = u.id
+                )
+            FROM res_users u
+            WHERE u.id = %s
+        """,
+            (sharing, request.env.uid),
+        )
+        generation, pref_date = request.env.cr.fetchone()
+        params = sorted((k, v) for k, v in kwargs.items() if k not in ("u", "p", "t", "s"))
+        key = "{}:{}:{}:{}:{}".format(
+            request.env.uid, sharing, pref_date, request.httprequest.path, params
+        )
+        etag = "{}-{}".format(generation, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+        if request.httprequest.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        if payload:
+            with _payload_cache_lock:
+                cached = _payload_cache.get((request.session.db, etag))
+                if cached:
+                    _payload_cache.move_to_end((request.session.db, etag))
+                    data, headers = cached
+                    response = request.make_response(data, headers=headers)
+                    response.set_etag(etag)
+                    return response
+            self.payload_etag = etag
+        self.etag = etag
+        return None
+
     def make_response(self, root):
         if self.format == "json":
-            json_root = xml2json.xml2json(etree.tostring(root))
-            return request.make_response(
-                json_root,
-                headers=[
-                    ("Content-Type", "application/json; charset=UTF-8"),
-                    ("Content-Length", len(json_root)),
-                    ("Access-Control-Allow-Origin", "*"),
-                ],
-            )
+            data = xml2json.json_elem2json(root)
+            headers = [
+                ("Content-Type", "application/json; charset=UTF-8"),
+                ("Content-Length", len(data)),
+                ("Access-Control-Allow-Origin", "*"),
+            ]
         elif self.format == "jsonp":
-            json_root = xml2json.xml2json(etree.tostring(root))
-            json_root = self.callback + "(" + json_root + ");"
-            return request.make_response(
-                json_root,
-                headers=[
-                    ("Content-Type", "text/javascript; charset=UTF-8"),
-                    ("Content-Length", len(json_root)),
-                    ("Access-Control-Allow-Origin", "*"),
-                ],
-            )
+            data = xml2json.json_elem2json(root)
+            data = self.callback + "(" + data + ");"
+            headers = [
+                ("Content-Type", "text/javascript; charset=UTF-8"),
+                ("Content-Length", len(data)),
+                ("Access-Control-Allow-Origin", "*"),
+            ]
         else:
-            response = b'<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(
+            data = b'<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(
                 root, encoding="UTF-8", pretty_print=True
             )
-            return request.make_response(response)
+            headers = []
+        response = request.make_response(data, headers=headers)
+
+        if self.etag:
+            response.set_etag(self.etag)
+        if self.payload_etag:
+            with _payload_cache_lock:
+                _payload_cache[(request.session.db, self.payload_etag)] = (data, headers)
+                while len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+                    _payload_cache.popitem(last=False)
+        return response
 
     def make_error(self, code="0", message=""):
-        root = etree.Element("subsonic-response", status="failed", version=self.version_server)
-        etree.SubElement(root, "error", code=code, message=message or API_ERROR_LIST[code])
+        # Errors are never cached
+        self.etag = self.payload_etag = None
+        root = self.make_root(status="failed")
+        self.SubElement(root, "error", code=code, message=message or API_ERROR_LIST[code])
         return self.make_response(root)
 
     def check_login(self):
-        uid = False
+        mark = time.perf_counter()
+        Users = request.env["res.users"]
+        request.env.cr.execute(
+            """
+            SELECT password FROM res_users
+            WHERE login=%s
+                AND active
+                AND password IS NOT NULL
+                AND password != ''
+        """,
+            (self.login,),
+        )
+        stored = request.env.cr.fetchone()
+        stored = stored and stored[0]
+
+        password = False
         if self.password:
             if self.password.startswith("enc:"):
                 password = binascii.unhexlify(self.password[4:])
             else:
                 password = self.password
-            uid = request.session.authenticate(request.session.db, self.login, password)
 
         elif self.token and self.salt:
-            request.env.cr.execute(
-                """
-                SELECT password FROM res_users
-                WHERE login=%s
-                    AND active
-                    AND password IS NOT NULL
-                    AND password != ''
-            """,
-                (self.login,),
-            )
-            if request.env.cr.rowcount:
-                password = request.env.cr.fetchone()[0]
-                if hashlib.md5((password + self.salt).encode("utf-8")).hexdigest() == self.token:
-                    uid = request.session.authenticate(request.session.db, self.login, password)
-            else:
+            if not stored:
                 return False, self.make_error("41")
-
+            token = hashlib.md5((stored + self.salt).encode("utf-8")).hexdigest()
+            if token == self.token:
+                password = stored
+
+        # The credentials checked recently are not checked again. The rest of the authentication
+        # of the session is the standard one.
+        uid = hit = False
+        if password:
+            hit = stored and Users._get_subsonic_credential(self.login, password, stored)
+            with subsonic_credential_checked(hit):
+                uid = request.session.authenticate(request.session.db, self.login, password)
+            if uid and stored and not hit:
+                Users._set_subsonic_credential(self.login, password, stored, uid)
+
+        Users._add_subsonic_auth_stats(time.perf_counter() - mark, bool(hit))
         if uid:
-            root = etree.Element("subsonic-response", status="ok", version=self.version_server)
+            root = self.Element("subsonic-response", status="ok", version=self.version_server)
             return True, self.make_response(root)
         else:
             _logger.info("Subsonic login failed for db:%s login:%s", request.session.db, self.login)
@@ -184,39 +295,101 @@ class SubsonicREST:
         return indexes_dict
 
     def _get_format(self, track=None):
-        ConfigParam = request.env["ir.config_parameter"].sudo()
-        if ConfigParam.get_param("oomusic.trans_disabled") and track:
-            return os.path.splitext(track.path)[1].lstrip(".")
-        elif ConfigParam.get_param("oomusic.subsonic_format_name"):
-            return ConfigParam.get_param("oomusic.subsonic_format_name")
-        elif not ConfigParam.get_param("oomusic.subsonic_format_id"):
-            return "mp3"
-        return (
-            request.env["oomusic.format"]
-            .browse(int(ConfigParam.get_param("oomusic.subsonic_format_id", 0)))
-            .exists()
-        ).name or "mp3"
+        # The parameters are read once per request, since the format is needed for every track.
+        if self._trans_disabled is None:
+            ConfigParam = request.env["ir.config_parameter"].sudo()
+            self._trans_disabled = bool(ConfigParam.get_param("oomusic.trans_disabled"))
+            if ConfigParam.get_param("oomusic.subsonic_format_name"):
+                self._format_name = ConfigParam.get_param("oomusic.subsonic_format_name")
+            elif not ConfigParam.get_param("oomusic.subsonic_format_id"):
+                self._format_name = "mp3"
+            else:
+                self._format_name = (
+                    request.env["oomusic.format"]
+                    .browse(int(ConfigParam.get_param("oomusic.subsonic_format_id", 0)))
+                    .exists()
+                ).name or "mp3"
+        if self._trans_disabled and track:
+            path = track["path"] if isinstance(track, dict) else track.path
+            return os.path.splitext(path)[1].lstrip(".")
+        return self._format_name
+
+    def _read_tracks(self, tracks):
+        """
+        Read the data needed to build the elements of the tracks, with a few queries for the whole
+        recordset. The related records are read as plain values.
+
+        :param tracks: tracks to read
+        :returns: list of dictionaries of track values, in the order of the recordset
+        """
+        tracks_data = tracks.read(
+            [
+                "folder_id",
+                "root_folder_id",
+                "album_id",
+                "artist_id",
+                "genre_id",
+                "name",
+                "path",
+                "size",
+                "duration",
+                "bitrate",
+                "track_number",
+                "disc",
+                "year",
+                "rating",
+                "star",
+                "play_count",
+                "create_date",
+                "write_date",
+                "loudness_analyzed",
+                "track_gain",
+                "true_peak",
+            ],
+            load=None,
+        )
+        albums = tracks.mapped("album_id")
+        albums_data = {a["id"]: a for a in albums.read(["name", "album_gain", "album_peak"])}
+        artists = tracks.mapped("artist_id")
+        artists_data = {a["id"]: a["name"] for a in artists.read(["name"])}
+        genres = tracks.mapped("genre_id")
+        genres_data = {g["id"]: g["name"] for g in genres.read(["name"])}
+        roots = tracks.mapped("root_folder_id")
+        roots_data = {f["id"]: f["path"] for f in roots.read(["path"])}
+        folders = tracks.mapped("folder_id")
+        covers_data = {f["id"]: f["has_image"] for f in folders.read(["has_image"])}
+
+        for track in tracks_data:
+            album = albums_data.get(track["album_id"], {})
+            track["album"] = album.get("name")
+            track["album_gain"] = album.get("album_gain", 0.0)
+            track["album_peak"] = album.get("album_peak", 0.0)
+            track["artist"] = artists_data.get(track["artist_id"])
+            track["genre"] = genres_data.get(track["genre_id"])
+            track["root_path"] = roots_data.get(track["root_folder_id"], "")
+            track["cover"] = covers_data.get(track["folder_id"], False)
+        return tracks_data
 
     def make_MusicFolders(self):
-        return etree.Element("musicFolders")
+        return self.Element("musicFolders")
 
     def make_MusicFolder(self, folder):
-        return etree.Element(
+        return self.Element(
             "musicFolder", id=str(folder.id), name=folder.name or os.path.basename(folder.path)
         )
 
     def make_Indexes(self, folder):
-        return etree.Element(
+        return self.Element(
             "indexes",
             lastModified=str(folder.last_modification * 1000),
             ignoredArticles=" ".join(IGNORED_ARTICLES),
         )
 
     def make_Index(self, index):
-        return etree.Element("index", name=index)
+        return self.Element("index", name=index)
 
     def make_Artist(self, folder, tag_name="artist"):
-        elem_artist = etree.Element(tag_name, id=str(folder.id), name=os.path.basename(folder.path))
+        elem_artist = self.Element(tag_name, id=str(folder.id), name=os.path.basename(folder.path))
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.10.2"]:
             if folder.star == "1":
@@ -232,144 +405,188 @@ class SubsonicREST:
         return elem_artist
 
     def make_Child_track(self, track, tag_name="child"):
-        elem_track = etree.Element(
+        return self.make_Child_tracks(track[:1], tag_name=tag_name)[0]
+
+    def make_Child_tracks(self, tracks, tag_name="child"):
+        """
+        Build the elements of several tracks. The data is read for the whole recordset at once,
+        which is much faster than building the elements one by one.
+
+        :param tracks: tracks
+        :param str tag_name: tag of the elements
+        :returns: list of elements, in the order of the recordset
+        """
+        return [self._make_Child_track(t, tag_name) for t in self._read_tracks(tracks)]
+
+    def _make_Child_track(self, track, tag_name="child"):
+        elem_track = self.Element(
             tag_name,
-            id=str(track.id),
-            parent=str(track.folder_id.id),
+            id=str(track["id"]),
+            parent=str(track["folder_id"]),
             isDir="false",
-            size=str(round(track.size * 1024 ** 2)),
-            contentType=mimetypes.guess_type(track.path)[0],
-            suffix=os.path.splitext(track.path)[1].lstrip("."),
+            size=str(round(track["size"] * 1024 ** 2)),
+            contentType=mimetypes.guess_type(track["path"])[0],
+            suffix=os.path.splitext(track["path"])[1].lstrip("."),
             transcodedContentType="audio/mpeg",
             transcodedSuffix=self._get_format(track),
-            duration=str(track.duration),
-            bitRate=str(track.bitrate),
-            path=track.path.replace(track.root_folder_id.path + os.sep, ""),
+            duration=str(track["duration"]),
+            bitRate=str(track["bitrate"]),
+            path=track["path"].replace(track["root_path"] + os.sep, ""),
         )
 
-        if track.name:
-            elem_track.set("title", track.name)
-        if track.album_id:
-            elem_track.set("album", track.album_id.name)
-        if track.artist_id:
-            elem_track.set("artist", track.artist_id.name)
-        if track.track_number:
+        if track["name"]:
+            elem_track.set("title", track["name"])
+        if track["album_id"]:
+            elem_track.set("album", track["album"])
+        if track["artist_id"]:
+            elem_track.set("artist", track["artist"])
+        if track["track_number"]:
             try:
-                track_number = track.track_number.split("/")[0]
+                track_number = track["track_number"].split("/")[0]
                 int(track_number)
                 elem_track.set("track", track_number)
             except ValueError:
                 _logger.warning(
                     "Could not convert track number %s of track id %s to integer",
-                    track.track_number,
-                    track.id,
+                    track["track_number"],
+                    track["id"],
                     exc_info=True,
                 )
-        if track.year:
-            elem_track.set("year", track.year[:4])
-        if track.genre_id:
-            elem_track.set("genre", track.genre_id.name)
-        # Use of [0] to make sure to fetch the image_small for this album only, not all albums of
-        # the recordset.
-        if track.folder_id.image_small_cache or track[0].folder_id.image_small:
-            elem_track.set("coverArt", str(track.folder_id.id))
+        if track["year"]:
+            elem_track.set("year", track["year"][:4])
+        if track["genre_id"]:
+            elem_track.set("genre", track["genre"])
+        if track["cover"]:
+            elem_track.set("coverArt", str(track["folder_id"]))
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.4.0"]:
             elem_track.set("isVideo", "false")
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.6.0"]:
-            if track.rating and track.rating != "0":
-                elem_track.set("userRating", track.rating)
-                elem_track.set("averageRating", track.rating)
+            if track["rating"] and track["rating"] != "0":
+                elem_track.set("userRating", track["rating"])
+                elem_track.set("averageRating", track["rating"])
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.14.0"]:
-            elem_track.set("playCount", str(track.play_count))
+            elem_track.set("playCount", str(track["play_count"]))
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.8.0"]:
-            if track.disc:
+            if track["disc"]:
                 try:
-                    disc = track.disc.split("/")[0]
+                    disc = track["disc"].split("/")[0]
                     int(disc)
                     elem_track.set("discNumber", disc)
                 except ValueError:
                     _logger.warning(
                         "Could not convert disc number %s of track id %s to integer",
-                        track.disc,
-                        track.id,
+                        track["disc"],
+                        track["id"],
                         exc_info=True,
                     )
-            elem_track.set("created", self._dt_to_string(track.create_date))
-            if track.star == "1":
-                elem_track.set("starred", self._dt_to_string(track.write_date))
-            elem_track.set("albumId", str(track.album_id.id))
-            elem_track.set("artistId", str(track.artist_id.id))
+            elem_track.set("created", self._dt_to_string(track["create_date"]))
+            if track["star"] == "1":
+                elem_track.set("starred", self._dt_to_string(track["write_date"]))
+            elem_track.set("albumId", str(track["album_id"]))
+            elem_track.set("artistId", str(track["artist_id"]))
             elem_track.set("type", "music")
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.10.2"]:
             elem_track.set("bookmarkPosition", "0.0")
+        # OpenSubsonic extension, so the clients can normalize the loudness without transcoding.
+        # The peaks are expressed as linear amplitudes. A track without album has no album gain.
+        if track["loudness_analyzed"]:
+            elem_gain = self.SubElement(
+                elem_track,
+                "replayGain",
+                trackGain=str(track["track_gain"]),
+                trackPeak=str(round(10 ** (track["true_peak"] / 20), 6)),
+            )
+            if track["album_id"]:
+                elem_gain.set("albumGain", str(track["album_gain"]))
+                elem_gain.set("albumPeak", str(round(10 ** (track["album_peak"] / 20), 6)))
 
         return elem_track
 
     def make_Child_folder(self, folder, tag_name="child"):
-        # Creates a new recordset to fetch only data of the required folder
-        folder = folder[0] if folder else folder
+        return self.make_Child_folders(folder[:1], tag_name=tag_name)[0]
+
+    def make_Child_folders(self, folders, tag_name="child"):
+        """
+        Build the elements of several folders. The data of the folders and of their tracks is read
+        for the whole recordset at once.
+
+        :param folders: folders
+        :param str tag_name: tag of the elements
+        :returns: list of elements, in the order of the recordset
+        """
+        folders_data = folders.read(
+            ["path", "parent_id", "rating", "create_date", "track_ids", "has_image"], load=None
+        )
+
+        # The first track of each folder provides the album data, the others only the play count
+        tracks = folders.mapped("track_ids")
+        tracks_data = {t["id"]: t for t in self._read_tracks(tracks)} if tracks else {}
 
-        elem_directory = etree.Element(
+        res = []
+        for folder in folders_data:
+            folder_tracks = [tracks_data[t_id] for t_id in folder["track_ids"]]
+            res.append(self._make_Child_folder(folder, folder_tracks, tag_name))
+        return res
+
+    def _make_Child_folder(self, folder, tracks, tag_name="child"):
+        elem_directory = self.Element(
             tag_name,
-            id=str(folder.id),
+            id=str(folder["id"]),
             isDir="true",
-            title=os.path.basename(folder.path),
-            path=folder.path,
+            title=os.path.basename(folder["path"]),
+            path=folder["path"],
         )
 
-        # Use of [0] to make sure to fetch the image_small for this album only, not all albums of
-        # the recordset.
-        if folder.image_small_cache or folder[0].image_small:
-            elem_directory.set("coverArt", str(folder.id))
-
-        if folder.track_ids:
-            track = folder.track_ids[0]
-            if track.album_id.name:
-                elem_directory.set("album", track.album_id.name)
-            if track.artist_id.name:
-                elem_directory.set("artist", track.artist_id.name)
-            if track.year:
-                elem_directory.set("year", track.year[:4])
-            if track.genre_id.name:
-                elem_directory.set("genre", track.genre_id.name)
+        if folder["has_image"]:
+            elem_directory.set("coverArt", str(folder["id"]))
+
+        if tracks:
+            track = tracks[0]
+            if track["album"]:
+                elem_directory.set("album", track["album"])
+            if track["artist"]:
+                elem_directory.set("artist", track["artist"])
+            if track["year"]:
+                elem_directory.set("year", track["year"][:4])
+            if track["genre"]:
+                elem_directory.set("genre", track["genre"])
             if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.8.0"]:
-                if track.disc:
+                if track["disc"]:
                     try:
-                        disc = track.disc.split("/")[0]
+                        disc = track["disc"].split("/")[0]
                         int(disc)
                         elem_directory.set("discNumber", disc)
                     except ValueError:
                         _logger.warning(
                             "Could not convert disc number %s of track id %s to integer",
-                            track.disc,
-                            track.id,
+                            track["disc"],
+                            track["id"],
                             exc_info=True,
                         )
-                if track.album_id:
-                    elem_directory.set("albumId", str(track.album_id.id))
-                if track.artist_id:
-                    elem_directory.set("artistId", str(track.artist_id.id))
+                if track["album_id"]:
+                    elem_directory.set("albumId", str(track["album_id"]))
+                if track["artist_id"]:
+                    elem_directory.set("artistId", str(track["artist_id"]))
 
-        if folder.parent_id:
-            elem_directory.set("parent", str(folder.parent_id.id))
+        if folder["parent_id"]:
+            elem_directory.set("parent", str(folder["parent_id"]))
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.6.0"]:
-            if folder.rating and folder.rating != "0":
-                elem_directory.set("userRating", folder.rating)
-                elem_directory.set("averageRating", folder.rating)
+            if folder["rating"] and folder["rating"] != "0":
+                elem_directory.set("userRating", folder["rating"])
+                elem_directory.set("averageRating", folder["rating"])
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.14.0"]:
-            play_counts = [t["play_count"] for t in folder.track_ids.read(["play_count"])]
-            elem_directory.set("playCount", str(sum(play_counts)))
+            elem_directory.set("playCount", str(sum(t["play_count"] for t in tracks)))
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.8.0"]:
-            elem_directory.set("created", self._dt_to_string(folder.create_date))
+            elem_directory.set("created", self._dt_to_string(folder["create_date"]))
 
         return elem_directory
 
     def make_Directory(self, folder):
-        elem_directory = etree.Element(
+        elem_directory = self.Element(
             "directory", id=str(folder.id), name=os.path.basename(folder.path)
         )
         if folder.parent_id:
@@ -391,10 +608,10 @@ class SubsonicREST:
         return elem_directory
 
     def make_Genres(self):
-        elem_genres = etree.Element("genres")
+        elem_genres = self.Element("genres")
 
         for k, v in self._get_genres_data().items():
-            elem_genre = etree.Element("genre")
+            elem_genre = self.Element("genre")
             elem_genre.text = k
             elem_genre.set("songCount", v.get("tracks", "0"))
             elem_genre.set("albumCount", v.get("albums", "0"))
@@ -443,7 +660,7 @@ class SubsonicREST:
         return data
 
     # def make_Genre(self, genre):
-    #     elem_genre = etree.Element('genre')
+    #     elem_genre = self.Element('genre')
     #     elem_genre.text = genre.name
     #     elem_genre.set('songCount', str(len(genre.track_ids)))
     #     elem_genre.set('albumCount', str(len(genre.album_ids)))
@@ -451,7 +668,7 @@ class SubsonicREST:
     #     return elem_genre
 
     def make_ArtistsID3(self):
-        elem_artists = etree.Element("artists")
+        elem_artists = self.Element("artists")
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.10.2"]:
             elem_artists.set("ignoredArticles", " ".join(IGNORED_ARTICLES))
@@ -459,10 +676,10 @@ class SubsonicREST:
         return elem_artists
 
     def make_IndexID3(self, index):
-        return etree.Element("index", name=index)
+        return self.Element("index", name=index)
 
     def make_ArtistID3(self, artist, tag_name="artist"):
-        elem_artist = etree.Element(
+        elem_artist = self.Element(
             tag_name, id=str(artist.id), name=artist.name, albumCount=str(len(artist.album_ids))
         )
 
@@ -488,7 +705,7 @@ class SubsonicREST:
 
     def make_AlbumID3(self, album):
         durations = [t["duration"] for t in album.track_ids.read(["duration"])]
-        elem_album = etree.Element(
+        elem_album = self.Element(
             "album",
             id=str(album.id),
             name=album.name,
@@ -502,9 +719,7 @@ class SubsonicREST:
         if album.artist_id:
             elem_album.set("artist", album.artist_id.name)
             elem_album.set("artistId", str(album.artist_id.id))
-        # Use of [0] to make sure to fetch the image_small for this album only, not all albums of
-        # the recordset.
-        if album.has_image or album[0].image_small:
+        if album.has_image:
             elem_album.set("coverArt", str(album.folder_id.id))
         if album.star == "1":
             elem_album.set("starred", self._dt_to_string(album.write_date))
@@ -522,14 +737,14 @@ class SubsonicREST:
         return elem_album
 
     def make_Videos(self):
-        return etree.Element("videos")
+        return self.Element("videos")
 
     def _make_ArtistInfoBase(self, artist):
         list_artist_info = []
 
         # Info already on artist object
         if artist.fm_getinfo_bio:
-            bio = etree.Element("biography")
+            bio = self.Element("biography")
             bio.text = artist.fm_getinfo_bio
             list_artist_info.append(bio)
 
@@ -537,12 +752,12 @@ class SubsonicREST:
         req_json = artist._lastfm_artist_getinfo()
 
         if "artist" in req_json and "mbid" in req_json["artist"]:
-            mbid = etree.Element("musicBrainzId")
+            mbid = self.Element("musicBrainzId")
             mbid.text = req_json["artist"]["mbid"]
             list_artist_info.append(mbid)
 
         if "artist" in req_json and "url" in req_json["artist"]:
-            url = etree.Element("lastFmUrl")
+            url = self.Element("lastFmUrl")
             url.text = req_json["artist"]["url"]
             list_artist_info.append(url)
 
@@ -552,7 +767,7 @@ class SubsonicREST:
             item = req_json["artists"]["items"][0] if req_json["artists"]["items"] else {}
             for image in item.get("images", []):
                 for size in ["smallImageUrl", "mediumImageUrl", "largeImageUrl"]:
-                    img = etree.Element(size)
+                    img = self.Element(size)
                     img.text = image["url"]
                     list_artist_info.append(img)
                 break
@@ -568,7 +783,7 @@ class SubsonicREST:
         return list_artist_info
 
     def make_ArtistInfo(self, folder, count=20, includeNotPresent=False):
-        elem_artist_info = etree.Element("artistInfo")
+        elem_artist_info = self.Element("artistInfo")
 
         # Stupid hack needed for AVSub which makes useless requests for folder with id '1'
         try:
@@ -588,7 +803,7 @@ class SubsonicREST:
         return elem_artist_info
 
     def make_ArtistInfo2(self, artist, count=20, includeNotPresent=False):
-        elem_artist_info = etree.Element("artistInfo2")
+        elem_artist_info = self.Element("artistInfo2")
 
         base_artist_info = self._make_ArtistInfoBase(artist)
         for elem in base_artist_info:
@@ -607,10 +822,10 @@ class SubsonicREST:
         if album:
             return self.make_AlbumInfo2(album[0])
         else:
-            return etree.Element("albumInfo")
+            return self.Element("albumInfo")
 
     def make_AlbumInfo2(self, album):
-        elem_album_info = etree.Element("albumInfo")
+        elem_album_info = self.Element("albumInfo")
         req_json = album._lastfm_album_getinfo()
 
         if (
@@ -618,42 +833,42 @@ class SubsonicREST:
             and "wiki" in req_json["album"]
             and "summary" in req_json["album"]["wiki"]
         ):
-            notes = etree.Element("notes")
+            notes = self.Element("notes")
             notes.text = req_json["album"]["wiki"]["summary"]
             elem_album_info.append(notes)
         else:
-            notes = etree.Element("notes")
+            notes = self.Element("notes")
             elem_album_info.append(notes)
 
         if "album" in req_json and "mbid" in req_json["album"]:
-            mbid = etree.Element("musicBrainzId")
+            mbid = self.Element("musicBrainzId")
             mbid.text = req_json["album"]["mbid"]
             elem_album_info.append(mbid)
 
         if "album" in req_json and "url" in req_json["album"]:
-            url = etree.Element("lastFmUrl")
+            url = self.Element("lastFmUrl")
             url.text = req_json["album"]["url"]
             elem_album_info.append(url)
 
         if "album" in req_json and "image" in req_json["album"]:
             for image in req_json["album"]["image"]:
                 if image.get("size") == "large" and image["#text"]:
-                    img = etree.Element("smallImageUrl")
+                    img = self.Element("smallImageUrl")
                     img.text = image["#text"]
                     elem_album_info.append(img)
                 elif image.get("size") == "extralarge" and image["#text"]:
-                    img = etree.Element("mediumImageUrl")
+                    img = self.Element("mediumImageUrl")
                     img.text = image["#text"]
                     elem_album_info.append(img)
                 elif image.get("size") == "mega" and image["#text"]:
-                    img = etree.Element("largeImageUrl")
+                    img = self.Element("largeImageUrl")
                     img.text = image["#text"]
                     elem_album_info.append(img)
 
         return elem_album_info
 
     def make_SimilarSongs2(self, track, count=50, tag_name="similarSongs2"):
-        elem_song_similar = etree.Element(tag_name)
+        elem_song_similar = self.Element(tag_name)
         req_json = track._lastfm_track_getsimilar(count=count)
 
         try:
@@ -666,9 +881,7 @@ class SubsonicREST:
                     ],
                     limit=1,
                 )
-            for s_track in s_tracks:
-                elem_song = self.make_Child_track(s_track, tag_name="song")
-                elem_song_similar.append(elem_song)
+            elem_song_similar.extend(self.make_Child_tracks(s_tracks, tag_name="song"))
         except KeyError:
             _logger.warning(
                 "An error occurred while searching similar songs. json contains:\n%s",
@@ -679,32 +892,32 @@ class SubsonicREST:
         return elem_song_similar
 
     def make_TopSongs(self, artist_name, count=50):
-        elem_song_info = etree.Element("topSongs")
+        elem_song_info = self.Element("topSongs")
 
         artist = request.env["oomusic.artist"].search([("name", "ilike", artist_name)])
         if artist:
-            for track in artist[0].fm_gettoptracks_track_ids[:count]:
-                elem_song_info.append(self.make_Child_track(track, tag_name="song"))
+            tracks = artist[0].fm_gettoptracks_track_ids[:count]
+            elem_song_info.extend(self.make_Child_tracks(tracks, tag_name="song"))
 
         return elem_song_info
 
     def make_AlbumList(self):
-        return etree.Element("albumList")
+        return self.Element("albumList")
 
     def make_AlbumList2(self):
-        return etree.Element("albumList2")
+        return self.Element("albumList2")
 
     def make_listSongs(self, tag_name):
-        return etree.Element(tag_name)
+        return self.Element(tag_name)
 
     def make_SearchResult(self, offset, totalHits):
-        return etree.Element("searchResult", offset=offset, totalHits=totalHits)
+        return self.Element("searchResult", offset=offset, totalHits=totalHits)
 
     def make_SearchResult2(self, tag_name="searchResult2"):
-        return etree.Element(tag_name)
+        return self.Element(tag_name)
 
     def make_Lyrics(self, artist=False, title=False):
-        elem_lyrics = etree.Element("lyrics")
+        elem_lyrics = self.Element("lyrics")
         if artist:
             elem_lyrics.set("artist", artist)
         if title:
@@ -715,7 +928,7 @@ class SubsonicREST:
         return elem_lyrics
 
     def make_User(self, user):
-        elem_user = etree.Element(
+        elem_user = self.Element(
             "user",
             username=user.login,
             adminRole="false",
@@ -748,20 +961,20 @@ class SubsonicREST:
             [("user_id", "=", user.id), ("root", "=", True)]
         )
         for folder in folders:
-            xml_folder = etree.Element("folder")
+            xml_folder = self.Element("folder")
             xml_folder.text = str(folder.id)
             elem_user.append(xml_folder)
 
         return elem_user
 
     def make_Users(self):
-        return etree.Element("users")
+        return self.Element("users")
 
     def make_Playlists(self):
-        return etree.Element("playlists")
+        return self.Element("playlists")
 
     def make_Playlist(self, playlist):
-        elem_playlist = etree.Element("playlist", id=str(playlist.id), name=playlist.name)
+        elem_playlist = self.Element("playlist", id=str(playlist.id), name=playlist.name)
 
         if API_VERSION_LIST[self.version_client] >= API_VERSION_LIST["1.8.0"]:
             if playlist.comment:
@@ -781,7 +994,7 @@ class SubsonicREST:
             )
             elem_playlist.set("created", self._dt_to_string(playlist.create_date))
 
-            elem_allowed_user = etree.Element("allowedUser")
+            elem_allowed_user = self.Element("allowedUser")
             elem_allowed_user.text = playlist.user_id.login
             elem_playlist.append(elem_allowed_user)
 
@@ -791,23 +1004,25 @@ class SubsonicREST:
         return elem_playlist
 
     def make_Shares(self):
-        return etree.Element("shares")
+        return self.Element("shares")
 
     def make_Podcasts(self, tag_name="podcasts"):
-        return etree.Element(tag_name)
+        return self.Element(tag_name)
 
     def make_InternetRadioStations(self):
-        return etree.Element("internetRadioStations")
+        return self.Element("internetRadioStations")
 
     def make_ChatMessages(self):
-        return etree.Element("chatMessages")
+        return self.Element("chatMessages")
 
     def make_Bookmarks(self):
-        return etree.Element("bookmarks")
+        return self.Element("bookmarks")
 
     def make_ScanStatus(self, folders, scan=None):
-        return etree.Element(
-            "scanStatus",
-            scanning=str(any(f.locked for f in folders) if scan is not None else scan).lower(),
-            count=str(request.env["oomusic.track"].search_count([])),
-        )
+        scanning = any(f.locked for f in folders) if scan is None else scan
+        if scanning:
+            # Live count of the ongoing scans, updated at each commit
+            count = sum(f.scan_files_parsed for f in folders if f.locked)
+        else:
+            count = request.env["oomusic.track"].search_count([])
+        return self.Element("scanStatus", scanning=str(scanning).lower(), count=str(count))
@@ -2,17 +2,44 @@
 
 import random
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
 from .common import SubsonicREST
 
 
-def _uniquify_list(seq):
-    seen = set()
-    return [x for x in seq if x not in seen and not seen.add(x)]
+def _get_played_ids(field, list_type, folder_id, limit, offset):
+    """
+    Return the IDs of the albums or folders of the tracks played by the current user. They are
+    ordered by their most recent play, or by their most played track.
+
+    :param str field: 'album_id' or 'folder_id'
+    :param str list_type: 'recent' or 'frequent'
+    :param str folder_id: ID of the root folder, if any
+    :param int limit: maximum number of IDs
+    :param int offset: number of IDs to skip
+    :return list: IDs
+    """
+    if list_type == "recent":
+        condition, order = "p.last_play IS NOT NULL", "max(p.last_play)"
+    else:
+        condition, order = "p.play_count > 0", "max(p.play_count)"
+    params = [request.env.user.id]
+    if folder_id:
+        condition += " AND t.root_folder_id = %s"
+        params.append(int(folder_id))
+    query = """
+        SELECT t.{field} FROM oomusic_track t
+        JOIN oomusic_preference AS p ON t.id = p.res_id
+        WHERE p.user_id = %s AND p.res_model = 'oomusic.track' AND t.{field} IS NOT NULL
+            AND {condition}
+        GROUP BY t.{field}
+        ORDER BY {order} DESC, t.{field}
+        LIMIT %s OFFSET %s
+    """.format(field=field, condition=condition, order=order)
+    request.env["oomusic.preference"].flush()
+    request.env.cr.execute(query, params + [limit, offset])
+    return [r[0] for r in request.env.cr.fetchall()]
 
 
 class MusicSubsonicListing(http.Controller):
@@ -29,6 +56,12 @@ class MusicSubsonicListing(http.Controller):
         if not success:
             return response
 
+        # The library did not change since the response was built. Random lists are never cached.
+        if kwargs.get("type") != "random":
+            response = rest.get_cached_response(kwargs)
+            if response:
+                return response
+
         FolderObj = request.env["oomusic.folder"]
 
         list_type_accepted = [
@@ -87,68 +120,25 @@ class MusicSubsonicListing(http.Controller):
 
             folders = FolderObj.browse(folder_ids)
 
-        elif list_type == "newest":
-            folders = FolderObj.search(domain, order="create_date desc")
-
-        elif list_type == "recent":
-            q_select = """
-                SELECT t.folder_id FROM oomusic_track t
-                JOIN oomusic_preference AS p ON t.id = p.res_id
-            """
-            q_where = """
-                WHERE p.user_id = %s AND p.last_play IS NOT NULL AND p.res_model = \'oomusic.track\'
-            """ % (
-                request.env.user.id
+        elif list_type in ["recent", "frequent"]:
+            folders = FolderObj.browse(
+                _get_played_ids("folder_id", list_type, folderId, size, offset)
             )
-            if folderId:
-                q_where += "AND t.root_folder_id = %s " % (folderId)
-            q_order = "ORDER BY p.last_play desc;"
-            query = q_select + q_where + q_order
-            request.env.cr.execute(query)
-            res = request.env.cr.fetchall()
-
-            folder_ids = _uniquify_list([r[0] for r in res if r[0] is not None])
-            folders = FolderObj.browse(folder_ids)
-
-        elif list_type == "frequent":
-            q_select = """
-                SELECT t.folder_id FROM oomusic_track t
-                JOIN oomusic_preference AS p ON t.id = p.res_id
-            """
-            q_where = """
-                WHERE p.user_id = %s AND p.play_count > 0 AND p.res_model = \'oomusic.track\'
-            """ % (
-                request.env.user.id
-            )
-            if folderId:
-                q_where += "AND t.root_folder_id = %s " % (folderId)
-            q_order = "ORDER BY p.play_count desc;"
-            query = q_select + q_where + q_order
-            request.env.cr.execute(query)
-            res = request.env.cr.fetchall()
-
-            folder_ids = _uniquify_list([r[0] for r in res if r[0] is not None])
-            folders = FolderObj.browse(folder_ids)
-
-        elif list_type == "alphabeticalByName":
-            folders = FolderObj.search(domain, order="path")
-
-        elif list_type == "alphabeticalByArtist":
-            folders = FolderObj.search(domain, order="parent_id")
 
         else:
-            folders = FolderObj.search(domain)
+            if list_type == "newest":
+                order = "create_date desc, id desc"
+            elif list_type == "alphabeticalByArtist":
+                order = "parent_id, path"
+            else:
+                order = "path"
+            folders = FolderObj.search(domain, order=order, limit=size, offset=offset)
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_folder_list = rest.make_AlbumList()
         root.append(xml_folder_list)
 
-        if folders:
-            min_val = min(offset, len(folders))
-            max_val = min_val + size
-            for folder in folders[min_val:max_val]:
-                xml_folder = rest.make_Child_folder(folder, tag_name="album")
-                xml_folder_list.append(xml_folder)
+        xml_folder_list.extend(rest.make_Child_folders(folders, tag_name="album"))
 
         return rest.make_response(root)
 
@@ -165,6 +155,12 @@ class MusicSubsonicListing(http.Controller):
         if not success:
             return response
 
+        # The library did not change since the response was built. Random lists are never cached.
+        if kwargs.get("type") != "random":
+            response = rest.get_cached_response(kwargs)
+            if response:
+                return response
+
         AlbumObj = request.env["oomusic.album"]
 
         list_type_accepted = [
@@ -212,10 +208,8 @@ class MusicSubsonicListing(http.Controller):
         # Build domain
         domain = [("folder_id", "child_of", int(folderId))] if folderId else []
         if list_type == "byYear":
-            if int(fromYear) > int(toYear):
-                domain += [("year", ">=", toYear), ("year", "<=", fromYear)]
-            else:
-                domain += [("year", ">=", fromYear), ("year", "<=", toYear)]
+            year_min, year_max = sorted([int(fromYear), int(toYear)])
+            domain += [("year_int", ">=", year_min), ("year_int", "<=", year_max)]
         elif list_type == "byGenre":
             domain += [("genre_id.name", "ilike", genre)]
         elif list_type == "starred":
@@ -229,74 +223,31 @@ class MusicSubsonicListing(http.Controller):
 
             albums = AlbumObj.browse(album_ids)
 
-        elif list_type == "newest":
-            albums = AlbumObj.search(domain, order="create_date desc")
-
-        elif list_type == "recent":
-            q_select = """
-                SELECT t.album_id FROM oomusic_track t
-                JOIN oomusic_preference AS p ON t.id = p.res_id
-            """
-            q_where = """
-                WHERE p.user_id = %s AND p.last_play IS NOT NULL AND p.res_model = \'oomusic.track\'
-            """ % (
-                request.env.user.id
-            )
-            if folderId:
-                q_where += "AND t.root_folder_id = %s " % (folderId)
-            q_order = "ORDER BY p.last_play desc;"
-            query = q_select + q_where + q_order
-            request.env.cr.execute(query)
-            res = request.env.cr.fetchall()
-
-            album_ids = _uniquify_list([r[0] for r in res if r[0] is not None])
-            albums = AlbumObj.browse(album_ids)
-
-        elif list_type == "frequent":
-            q_select = """
-                SELECT t.album_id FROM oomusic_track t
-                JOIN oomusic_preference AS p ON t.id = p.res_id
-            """
-            q_where = """
-                WHERE p.user_id = %s AND p.play_count > 0 AND p.res_model = \'oomusic.track\'
-            """ % (
-                request.env.user.id
-            )
-            if folderId:
-                q_where += "AND t.root_folder_id = %s " % (folderId)
-            q_order = "ORDER BY p.play_count desc;"
-            query = q_select + q_where + q_order
-            request.env.cr.execute(query)
-            res = request.env.cr.fetchall()
-
-            album_ids = _uniquify_list([r[0] for r in res if r[0] is not None])
-            albums = AlbumObj.browse(album_ids)
-
-        elif list_type == "alphabeticalByName":
-            albums = AlbumObj.search(domain, order="name")
-
-        elif list_type == "alphabeticalByArtist":
-            albums = AlbumObj.search(domain, order="artist_id")
-
-        elif list_type == "byYear":
-            if int(fromYear) > int(toYear):
-                albums = AlbumObj.search(domain, order="year desc")
-            else:
-                albums = AlbumObj.search(domain, order="year")
+        elif list_type in ["recent", "frequent"]:
+            albums = AlbumObj.browse(_get_played_ids("album_id", list_type, folderId, size, offset))
 
         else:
-            albums = AlbumObj.search(domain)
+            if list_type == "newest":
+                order = "create_date desc, id desc"
+            elif list_type == "alphabeticalByName":
+                order = "name, id"
+            elif list_type == "alphabeticalByArtist":
+                order = "artist_id, name, id"
+            elif list_type == "byYear" and int(fromYear) > int(toYear):
+                order = "year_int desc, name, id"
+            elif list_type == "byYear":
+                order = "year_int, name, id"
+            else:
+                order = "year_int desc, name, id"
+            albums = AlbumObj.search(domain, order=order, limit=size, offset=offset)
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_album_list = rest.make_AlbumList2()
         root.append(xml_album_list)
 
-        if albums:
-            min_val = min(offset, len(albums))
-            max_val = min_val + size
-            for album in albums[min_val:max_val]:
-                xml_album = rest.make_AlbumID3(album)
-                xml_album_list.append(xml_album)
+        for album in albums:
+            xml_album = rest.make_AlbumID3(album)
+            xml_album_list.append(xml_album)
 
         return rest.make_response(root)
 
@@ -342,13 +293,11 @@ class MusicSubsonicListing(http.Controller):
 
         tracks = TrackObj.browse(track_ids)
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song_list = rest.make_listSongs("randomSongs")
         root.append(xml_song_list)
 
-        for track in tracks:
-            xml_song = rest.make_Child_track(track, tag_name="song")
-            xml_song_list.append(xml_song)
+        xml_song_list.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
 
@@ -386,18 +335,12 @@ class MusicSubsonicListing(http.Controller):
         domain = [("id", "child_of", int(folderId))] if folderId else []
         domain += [("genre_id.name", "=", genre)]
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song_list = rest.make_listSongs("songsByGenre")
         root.append(xml_song_list)
 
-        tracks = TrackObj.search(domain)
-
-        if tracks:
-            min_val = min(offset, len(tracks))
-            max_val = min_val + size
-            for track in tracks[min_val:max_val]:
-                xml_song = rest.make_Child_track(track, tag_name="song")
-                xml_song_list.append(xml_song)
+        tracks = TrackObj.search(domain, limit=size, offset=offset)
+        xml_song_list.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
 
@@ -414,7 +357,7 @@ class MusicSubsonicListing(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_song_list = rest.make_listSongs("nowPlaying")
         root.append(xml_song_list)
 
@@ -445,23 +388,20 @@ class MusicSubsonicListing(http.Controller):
                 return rest.make_error(code="70", message="Folder not found")
         domain = [("id", "child_of", int(folderId))] if folderId else []
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_starred_list = rest.make_listSongs("starred")
         root.append(xml_starred_list)
 
-        folders = FolderObj.search(domain + [("star", "=", "1")])
+        # Folders without tracks are artists, the others are albums
+        artists = FolderObj.search(domain + [("star", "=", "1"), ("track_ids", "=", False)])
+        albums = FolderObj.search(domain + [("star", "=", "1"), ("track_ids", "!=", False)])
         tracks = TrackObj.search(domain + [("star", "=", "1")])
 
-        for folder in folders.sorted(lambda r: len(r.track_ids)):
-            if not folder.track_ids:
-                xml_folder = rest.make_Artist(folder)
-            else:
-                xml_folder = rest.make_Child_folder(folder, tag_name="album")
-            xml_starred_list.append(xml_folder)
+        for artist in artists:
+            xml_starred_list.append(rest.make_Artist(artist))
+        xml_starred_list.extend(rest.make_Child_folders(albums, tag_name="album"))
 
-        for track in tracks:
-            xml_song = rest.make_Child_track(track, tag_name="song")
-            xml_starred_list.append(xml_song)
+        xml_starred_list.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
 
@@ -489,7 +429,7 @@ class MusicSubsonicListing(http.Controller):
                 return rest.make_error(code="70", message="Folder not found")
         domain = [("id", "child_of", int(folderId))] if folderId else []
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_starred_list = rest.make_listSongs("starred2")
         root.append(xml_starred_list)
 
@@ -505,8 +445,6 @@ class MusicSubsonicListing(http.Controller):
             xml_album = rest.make_AlbumID3(album)
             xml_starred_list.append(xml_album)
 
-        for track in tracks:
-            xml_song = rest.make_Child_track(track, tag_name="song")
-            xml_starred_list.append(xml_song)
+        xml_starred_list.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
@@ -44,7 +42,7 @@ class MusicSubsonicMediaAnnotation(http.Controller):
             if artist.exists():
                 artist.write({"star": "1"})
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
 
@@ -83,7 +81,7 @@ class MusicSubsonicMediaAnnotation(http.Controller):
             if artist.exists():
                 artist.write({"star": "0"})
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
 
@@ -128,7 +126,7 @@ class MusicSubsonicMediaAnnotation(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
 
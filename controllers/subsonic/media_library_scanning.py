@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
@@ -24,7 +22,7 @@ class MusicSubsonicMediaLibraryScanning(http.Controller):
 
         folders = request.env["oomusic.folder"].search([("root", "=", True)])
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_status = rest.make_ScanStatus(folders)
         root.append(xml_status)
 
@@ -47,7 +45,7 @@ class MusicSubsonicMediaLibraryScanning(http.Controller):
         for folder in folders:
             folder.action_scan_folder()
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_status = rest.make_ScanStatus(folders, scan=True)
         root.append(xml_status)
 
@@ -6,14 +6,12 @@ import logging
 import os
 from io import BytesIO
 
-from lxml import etree
-from werkzeug.wrappers import Response
-from werkzeug.wsgi import wrap_file
-
 from odoo import http
 from odoo.exceptions import AccessError
 from odoo.http import request
 
+from ...models.oomusic_transcoder import TranscodeBusy
+from ..main import send_transcode
 from .common import SubsonicREST
 
 _logger = logging.getLogger(__name__)
@@ -71,17 +69,19 @@ class MusicSubsonicMediaRetrieval(http.Controller):
         )
         Transcoder = Transcoder[0] if Transcoder else False
         if Transcoder:
-            generator = Transcoder.transcode(int(trackId), bitrate=maxBitRate).stdout
-            mimetype = Transcoder.output_format.mimetype
+            try:
+                return send_transcode(
+                    Transcoder,
+                    int(trackId),
+                    bitrate=maxBitRate,
+                    estimate=estimateContentLength == "true",
+                )
+            except TranscodeBusy:
+                return rest.make_error(code="0", message="Too many transcoding jobs")
         else:
             _logger.warning("Could not find converter from '%s' to '%s'", fn_ext[1:], output_format)
             return http.send_file(track.path)
 
-        data = wrap_file(
-            request.httprequest.environ, generator, buffer_size=Transcoder.buffer_size * 1024
-        )
-        return Response(data, mimetype=mimetype, direct_passthrough=True)
-
     @http.route(
         ["/rest/download.view", "/rest/download"],
         type="http",
@@ -148,6 +148,12 @@ class MusicSubsonicMediaRetrieval(http.Controller):
         if not success:
             return response
 
+        # The library did not change since the image was sent. The images are too large to be
+        # kept in the payload cache.
+        response = rest.get_cached_response(kwargs, payload=False)
+        if response:
+            return response
+
         folderId = kwargs.get("id")
         if folderId:
             try:
@@ -193,7 +199,10 @@ class MusicSubsonicMediaRetrieval(http.Controller):
         image = folder[image_cache] or folder[image] or b"R0lGODlhAQABAAD/ACwAAAAAAQABAAACADs="
         image_stream = BytesIO(base64.b64decode(image))
         image_ext = "." + (imghdr.what(image_stream) or "png")
-        return http.send_file(image_stream, filename=folderId + image_ext)
+        response = http.send_file(image_stream, filename=folderId + image_ext)
+        if rest.etag:
+            response.set_etag(rest.etag)
+        return response
 
     @http.route(
         ["/rest/getLyrics.view", "/rest/getLyrics"],
@@ -211,7 +220,7 @@ class MusicSubsonicMediaRetrieval(http.Controller):
         artist = kwargs.get("artist")
         title = kwargs.get("title")
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_lyrics = rest.make_Lyrics(artist, title)
         root.append(xml_lyrics)
 
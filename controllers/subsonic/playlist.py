@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
@@ -22,7 +20,7 @@ class MusicSubsonicPlaylist(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_playlists = rest.make_Playlists()
         root.append(xml_playlists)
 
@@ -53,13 +51,15 @@ class MusicSubsonicPlaylist(http.Controller):
         else:
             return rest.make_error(code="10", message='Required int parameter "id" is not present')
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_playlist = rest.make_Playlist(playlist)
         root.append(xml_playlist)
 
-        for playlist_line in playlist.playlist_line_ids:
-            xml_playlist_line = rest.make_Child_track(playlist_line.track_id, tag_name="entry")
-            xml_playlist.append(xml_playlist_line)
+        # A track can appear several times in the playlist
+        tracks = request.env["oomusic.track"].browse(
+            [line.track_id.id for line in playlist.playlist_line_ids]
+        )
+        xml_playlist.extend(rest.make_Child_tracks(tracks, tag_name="entry"))
 
         return rest.make_response(root)
 
@@ -102,14 +102,15 @@ class MusicSubsonicPlaylist(http.Controller):
         if playlist:
             playlist._add_tracks(track)
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         if API_VERSION_LIST[rest.version_client] >= API_VERSION_LIST["1.14.0"]:
             xml_playlist = rest.make_Playlist(playlist)
             root.append(xml_playlist)
 
-            for playlist_line in playlist.playlist_line_ids:
-                xml_playlist_line = rest.make_Child_track(playlist_line.track_id, tag_name="entry")
-                xml_playlist.append(xml_playlist_line)
+            tracks = request.env["oomusic.track"].browse(
+                [line.track_id.id for line in playlist.playlist_line_ids]
+            )
+            xml_playlist.extend(rest.make_Child_tracks(tracks, tag_name="entry"))
 
         return rest.make_response(root)
 
@@ -164,7 +165,7 @@ class MusicSubsonicPlaylist(http.Controller):
         if songIdToAdd:
             playlist._add_tracks(track_add)
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
 
@@ -193,6 +194,6 @@ class MusicSubsonicPlaylist(http.Controller):
 
         playlist.unlink()
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
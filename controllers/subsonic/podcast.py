@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 
 from .common import SubsonicREST
@@ -21,7 +19,7 @@ class MusicSubsonicPodcast(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_podcasts = rest.make_Podcasts()
         root.append(xml_podcasts)
 
@@ -40,7 +38,7 @@ class MusicSubsonicPodcast(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_podcasts = rest.make_Podcasts(tag_name="newestPodcasts")
         root.append(xml_podcasts)
 
@@ -70,5 +68,5 @@ class MusicSubsonicPodcast(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         return rest.make_response(root)
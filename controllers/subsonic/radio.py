@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 
 from .common import SubsonicREST
@@ -21,7 +19,7 @@ class MusicSubsonicRadio(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_radios = rest.make_InternetRadioStations()
         root.append(xml_radios)
 
@@ -47,5 +45,5 @@ class MusicSubsonicRadio(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         return rest.make_response(root)
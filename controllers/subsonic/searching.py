@@ -1,14 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import os
-
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
 from .common import SubsonicREST
 
+# Folders containing tracks are albums, the others are artists
+FOLDER_HAS_TRACKS = 'EXISTS (SELECT 1 FROM oomusic_track t WHERE t.folder_id = "oomusic_folder".id)'
+
 
 class MusicSubsonicSearching(http.Controller):
     @http.route(
@@ -24,8 +23,6 @@ class MusicSubsonicSearching(http.Controller):
         if not success:
             return response
 
-        artists = albums = tracks = []
-
         s_artist = kwargs.get("artist", "")
         s_album = kwargs.get("album", "")
         s_title = kwargs.get("title", "")
@@ -36,83 +33,40 @@ class MusicSubsonicSearching(http.Controller):
         newerThan = int(kwargs.get("newerThan", 0)) / 1000
 
         domain = [("last_modification", ">=", newerThan)]
-
-        if s_artist or s_any:
-            domain_artist = domain
-            if s_any:
-                domain_artist += [("path", "ilike", s_any)]
-            if s_artist:
-                domain_artist += [("path", "ilike", s_artist)]
-            artists = (
-                request.env["oomusic.folder"]
-                .search(domain_artist)
-                .filtered(lambda r: len(r.track_ids) == 0)
+        Folder = request.env["oomusic.folder"]
+        Track = request.env["oomusic.track"]
+        artists = albums = Folder
+        tracks = Track
+        total = 0
+
+        queries = [q for q in [s_artist, s_any] if q]
+        if queries:
+            artists, count = Folder._search_text(
+                queries, domain=domain, where="NOT " + FOLDER_HAS_TRACKS, limit=size, offset=offset
             )
+            total += count
 
-            if s_any:
-                artists = artists.filtered(
-                    lambda r: s_any.lower() in os.path.basename(r.path).lower()
-                )
-            if s_artist:
-                artists = artists.filtered(
-                    lambda r: s_artist.lower() in os.path.basename(r.path).lower()
-                )
-
-        if s_album or s_any:
-            domain_album = domain
-            if s_any:
-                domain_album += [("path", "ilike", s_any)]
-            if s_album:
-                domain_album += [("path", "ilike", s_album)]
-            albums = (
-                request.env["oomusic.folder"]
-                .search(domain_album)
-                .filtered(lambda r: len(r.track_ids) != 0)
+        queries = [q for q in [s_album, s_any] if q]
+        if queries:
+            albums, count = Folder._search_text(
+                queries, domain=domain, where=FOLDER_HAS_TRACKS, limit=size, offset=offset
             )
+            total += count
 
-            if s_any:
-                albums = albums.filtered(
-                    lambda r: s_any.lower() in os.path.basename(r.path).lower()
-                )
-            if s_album:
-                albums = albums.filtered(
-                    lambda r: s_album.lower() in os.path.basename(r.path).lower()
-                )
-
-        if s_title or s_any:
-            domain_title = domain
-            if s_any:
-                domain_title += [("name", "ilike", s_any)]
-            if s_title:
-                domain_title += [("name", "ilike", s_title)]
-            tracks = request.env["oomusic.track"].search(domain_title)
-
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
-        xml_search = rest.make_SearchResult(
-            offset=str(offset), totalHits=str(len(artists) + len(albums) + len(tracks))
-        )
+        queries = [q for q in [s_title, s_any] if q]
+        if queries:
+            tracks, count = Track._search_text(queries, domain=domain, limit=size, offset=offset)
+            total += count
+
+        root = rest.make_root()
+        xml_search = rest.make_SearchResult(offset=str(offset), totalHits=str(total))
         root.append(xml_search)
 
-        if artists:
-            min_val = min(offset, len(artists))
-            max_val = min_val + size
-            for artist in artists[min_val:max_val]:
-                xml_artist = rest.make_Artist(artist)
-                xml_search.append(xml_artist)
-
-        if albums:
-            min_val = min(offset, len(albums))
-            max_val = min_val + size
-            for album in albums[min_val:max_val]:
-                xml_album = rest.make_Child_folder(album, tag_name="match")
-                xml_search.append(xml_album)
-
-        if tracks:
-            min_val = min(offset, len(tracks))
-            max_val = min_val + size
-            for track in tracks[min_val:max_val]:
-                xml_song = rest.make_Child_track(track, tag_name="match")
-                xml_search.append(xml_song)
+        for artist in artists:
+            xml_artist = rest.make_Artist(artist)
+            xml_search.append(xml_artist)
+        xml_search.extend(rest.make_Child_folders(albums, tag_name="match"))
+        xml_search.extend(rest.make_Child_tracks(tracks, tag_name="match"))
 
         return rest.make_response(root)
 
@@ -148,40 +102,36 @@ class MusicSubsonicSearching(http.Controller):
             if not folder.exists():
                 return rest.make_error(code="70", message="Folder not found")
 
+        domain_folder = [("id", "child_of", int(folderId))] if folderId else []
         domain = [("folder_id", "child_of", int(folderId))] if folderId else []
-        folders = (
-            request.env["oomusic.folder"]
-            .search(domain + [("path", "ilike", query)])
-            .filtered(lambda r: query.lower() in os.path.basename(r.path).lower())
+        Folder = request.env["oomusic.folder"]
+        artists, _ = Folder._search_text(
+            [query],
+            domain=domain_folder,
+            where="NOT " + FOLDER_HAS_TRACKS,
+            limit=artistCount,
+            offset=artistOffset,
+        )
+        albums, _ = Folder._search_text(
+            [query],
+            domain=domain_folder,
+            where=FOLDER_HAS_TRACKS,
+            limit=albumCount,
+            offset=albumOffset,
+        )
+        tracks, _ = request.env["oomusic.track"]._search_text(
+            [query], domain=domain, limit=songCount, offset=songOffset
         )
-        artists = folders.filtered(lambda r: len(r.track_ids) == 0)
-        albums = folders.filtered(lambda r: len(r.track_ids) != 0)
-        tracks = request.env["oomusic.track"].search(domain + [("name", "ilike", query)])
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_search = rest.make_SearchResult2()
         root.append(xml_search)
 
-        if artists:
-            min_val = min(artistOffset, len(artists))
-            max_val = min_val + artistCount
-            for artist in artists[min_val:max_val]:
-                xml_artist = rest.make_Artist(artist)
-                xml_search.append(xml_artist)
-
-        if albums:
-            min_val = min(albumOffset, len(albums))
-            max_val = min_val + albumCount
-            for album in albums[min_val:max_val]:
-                xml_album = rest.make_Child_folder(album, tag_name="album")
-                xml_search.append(xml_album)
-
-        if tracks:
-            min_val = min(songOffset, len(tracks))
-            max_val = min_val + songCount
-            for track in tracks[min_val:max_val]:
-                xml_song = rest.make_Child_track(track, tag_name="song")
-                xml_search.append(xml_song)
+        for artist in artists:
+            xml_artist = rest.make_Artist(artist)
+            xml_search.append(xml_artist)
+        xml_search.extend(rest.make_Child_folders(albums, tag_name="album"))
+        xml_search.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
 
@@ -218,33 +168,27 @@ class MusicSubsonicSearching(http.Controller):
                 return rest.make_error(code="70", message="Folder not found")
 
         domain = [("folder_id", "child_of", int(folderId))] if folderId else []
-        artists = request.env["oomusic.artist"].search(domain + [("name", "ilike", query)])
-        albums = request.env["oomusic.album"].search(domain + [("name", "ilike", query)])
-        tracks = request.env["oomusic.track"].search(domain + [("name", "ilike", query)])
+        domain_artist = [("track_ids.folder_id", "child_of", int(folderId))] if folderId else []
+        artists, _ = request.env["oomusic.artist"]._search_text(
+            [query], domain=domain_artist, limit=artistCount, offset=artistOffset
+        )
+        albums, _ = request.env["oomusic.album"]._search_text(
+            [query], domain=domain, limit=albumCount, offset=albumOffset
+        )
+        tracks, _ = request.env["oomusic.track"]._search_text(
+            [query], domain=domain, limit=songCount, offset=songOffset
+        )
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_search = rest.make_SearchResult2(tag_name="searchResult3")
         root.append(xml_search)
 
-        if artists:
-            min_val = min(artistOffset, len(artists))
-            max_val = min_val + artistCount
-            for artist in artists[min_val:max_val]:
-                xml_artist = rest.make_ArtistID3(artist)
-                xml_search.append(xml_artist)
-
-        if albums:
-            min_val = min(albumOffset, len(albums))
-            max_val = min_val + albumCount
-            for album in albums[min_val:max_val]:
-                xml_album = rest.make_AlbumID3(album)
-                xml_search.append(xml_album)
-
-        if tracks:
-            min_val = min(songOffset, len(tracks))
-            max_val = min_val + songCount
-            for track in tracks[min_val:max_val]:
-                xml_song = rest.make_Child_track(track, tag_name="song")
-                xml_search.append(xml_song)
+        for artist in artists:
+            xml_artist = rest.make_ArtistID3(artist)
+            xml_search.append(xml_artist)
+        for album in albums:
+            xml_album = rest.make_AlbumID3(album)
+            xml_search.append(xml_album)
+        xml_search.extend(rest.make_Child_tracks(tracks, tag_name="song"))
 
         return rest.make_response(root)
@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 
 from .common import SubsonicREST
@@ -21,7 +19,7 @@ class MusicSubsonicShare(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_shares = rest.make_Shares()
         root.append(xml_shares)
 
@@ -57,7 +55,7 @@ class MusicSubsonicShare(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         return rest.make_response(root)
 
     @http.route(
@@ -73,5 +71,5 @@ class MusicSubsonicShare(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         return rest.make_response(root)
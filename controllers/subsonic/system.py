@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 
 from .common import SubsonicREST
@@ -17,7 +15,7 @@ class MusicSubsonicSystem(http.Controller):
     )
     def ping(self, **kwargs):
         rest = SubsonicREST(kwargs)
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         return rest.make_response(root)
 
     @http.route(
@@ -33,8 +31,8 @@ class MusicSubsonicSystem(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
-        etree.SubElement(
+        root = rest.make_root()
+        rest.SubElement(
             root, "license", valid="true", email="foo@bar.com", licenseExpires="2099-12-31T23:59:59"
         )
         return rest.make_response(root)
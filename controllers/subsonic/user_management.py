@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-
 from odoo import http
 from odoo.http import request
 
@@ -32,7 +30,7 @@ class MusicSubsonicUserManagement(http.Controller):
         if not user:
             return rest.make_error(code="70", message="User not found")
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_user = rest.make_User(user)
         root.append(xml_user)
 
@@ -51,7 +49,7 @@ class MusicSubsonicUserManagement(http.Controller):
         if not success:
             return response
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
         xml_users = rest.make_Users()
         root.append(xml_users)
 
@@ -86,6 +84,6 @@ class MusicSubsonicUserManagement(http.Controller):
 
         # Do not support these actions on purpose, for security reason
 
-        root = etree.Element("subsonic-response", status="ok", version=rest.version_server)
+        root = rest.make_root()
 
         return rest.make_response(root)
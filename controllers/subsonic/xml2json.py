@@ -42,24 +42,40 @@ LIST_TAGS = ["album", "artist", "child", "genre", "index", "musicFolder", "playl
 # List of tags which must be converted to integer
 INT_TAGS = ["bitRate"]
 
+# List of tags which must be converted to floats
+FLOAT_TAGS = ["albumGain", "albumPeak", "trackGain", "trackPeak"]
+
 # List of tags which must be converted to booleans
 BOOL_TAGS = ["isDir"]
 
 
-def elem_to_internal(elem, strip=1, level=0):
+def attrib_to_internal(attrib):
 
-    """Convert an Element into an internal dictionary (not JSON!)."""
+    """Convert the attributes of an Element, with the typing rules of the tags."""
 
     d = {}
-    for key, value in elem.attrib.items():
+    for key, value in attrib.items():
         if key in INT_TAGS:
             try:
                 value = int(value or 0)
             except (ValueError, TypeError):
                 pass
+        if key in FLOAT_TAGS:
+            try:
+                value = float(value or 0)
+            except (ValueError, TypeError):
+                pass
         if key in BOOL_TAGS:
             value = True if value.lower() == "true" else False
         d[key] = value
+    return d
+
+
+def elem_to_internal(elem, strip=1, level=0):
+
+    """Convert an Element into an internal dictionary (not JSON!)."""
+
+    d = attrib_to_internal(elem.attrib)
 
     level += 1
     # loop over subelements to merge them
@@ -101,6 +117,91 @@ def elem_to_internal(elem, strip=1, level=0):
     return {elem.tag: d}
 
 
+class JsonElement(object):
+
+    """Element built directly for a JSON output.
+
+    It implements the subset of the lxml Element API used to build the
+    Subsonic responses, so that the same code builds both outputs. The
+    element is converted into the internal dictionary without going
+    through an XML serialization.
+    """
+
+    __slots__ = ("tag", "attrib", "text", "children")
+
+    def __init__(self, tag, attrib=None, **extra):
+        self.tag = tag
+        self.attrib = dict(attrib or {}, **extra)
+        self.text = None
+        self.children = []
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def append(self, elem):
+        self.children.append(elem)
+
+    def extend(self, elems):
+        self.children.extend(elems)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+
+def JsonSubElement(parent, tag, attrib=None, **extra):
+
+    """Create a JsonElement and append it to parent, like SubElement."""
+
+    elem = JsonElement(tag, attrib, **extra)
+    parent.append(elem)
+    return elem
+
+
+def json_elem_to_internal(elem, level=0):
+
+    """Convert a JsonElement into an internal dictionary (not JSON!).
+
+    The mapping is the same as elem_to_internal, with strip enabled.
+    """
+
+    d = attrib_to_internal(elem.attrib)
+
+    level += 1
+    for subelem in elem.children:
+        tag = subelem.tag
+        value = json_elem_to_internal(subelem, level=level)[tag]
+        try:
+            d[tag].append(value)
+        except AttributeError:
+            d[tag] = [d[tag], value]
+        except KeyError:
+            if tag in LIST_TAGS and level > 1:
+                d[tag] = [value]
+            else:
+                d[tag] = value
+    text = elem.text.strip() if elem.text else elem.text
+
+    if d:
+        if text:
+            d["value"] = text
+    else:
+        d = text or {}
+    return {elem.tag: d}
+
+
+def json_elem2json(elem):
+
+    """Convert a JsonElement into a JSON string."""
+
+    return json.dumps(json_elem_to_internal(elem))
+
+
 def internal_to_elem(pfsh, factory=ET.Element):
 
     """Convert an internal dictionary (not JSON!) into an Element.
@@ -10,11 +10,13 @@ from . import oomusic_config_settings
 from . import oomusic_converter
 from . import oomusic_folder
 from . import oomusic_folder_scan
+from . import oomusic_folder_watch
 from . import oomusic_format
 from . import oomusic_genre
 from . import oomusic_lastfm
 from . import oomusic_playlist
 from . import oomusic_remote
+from . import oomusic_search
 from . import oomusic_spotify
 from . import oomusic_suggestion
 from . import oomusic_tag
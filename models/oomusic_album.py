@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import json
+import math
+import re
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
+from .oomusic_track import get_gain
+
 
 class MusicAlbum(models.Model):
     _name = "oomusic.album"
     _description = "Music Album"
     _order = "year desc, name"
-    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin"]
+    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin", "oomusic.search.mixin"]
 
     create_date = fields.Datetime(index=True)
 
@@ -19,6 +23,14 @@ class MusicAlbum(models.Model):
     artist_id = fields.Many2one("oomusic.artist", "Artist", index=True)
     genre_id = fields.Many2one("oomusic.genre", "Genre", index=True)
     year = fields.Char("Year", index=True)
+    year_int = fields.Integer(
+        "Year (Number)",
+        compute="_compute_year_int",
+        store=True,
+        index=True,
+        help="Year as a number, used to sort and filter the albums. The year tag of the files can "
+        "be a full date.",
+    )
     folder_id = fields.Many2one("oomusic.folder", "Folder", index=True, required=True)
     user_id = fields.Many2one(
         "res.users",
@@ -62,6 +74,18 @@ class MusicAlbum(models.Model):
         "Small-sized Image", related="folder_id.image_small", related_sudo=False
     )
     has_image = fields.Boolean("Has Image", related="folder_id.has_image", related_sudo=False)
+    album_gain = fields.Float(
+        "Album Gain (dB)",
+        readonly=True,
+        help="Gain to reach the target loudness for the whole album, based on the analyzed tracks.",
+    )
+    album_peak = fields.Float("Album Peak (dBTP)", readonly=True)
+
+    @api.depends("year")
+    def _compute_year_int(self):
+        for album in self:
+            year = re.match(r"\s*(\d{1,4})", album.year or "")
+            album.year_int = int(year.group(1)) if year else 0
 
     def action_add_to_playlist(self):
         playlist = self.env["oomusic.playlist"].search([("current", "=", True)], limit=1)
@@ -83,6 +107,21 @@ class MusicAlbum(models.Model):
                 "res_name": ", ".join(self.mapped("name")[:5]),
             }
 
+    def _update_album_gain(self):
+        """
+        Compute the album gain from the loudness of the analyzed tracks. The loudness of the album
+        is the energy average of the track loudnesses, weighted by their duration.
+        """
+        for album in self:
+            tracks = album.track_ids.filtered(lambda r: r.loudness_analyzed and r.duration)
+            if not tracks:
+                album.write({"album_gain": 0.0, "album_peak": 0.0})
+                continue
+            energy = sum(t.duration * 10 ** (t.loudness / 10) for t in tracks)
+            loudness = 10 * math.log10(energy / sum(tracks.mapped("duration")))
+            peak = max(tracks.mapped("true_peak"))
+            album.write({"album_gain": get_gain(loudness, peak), "album_peak": peak})
+
     def _lastfm_album_getinfo(self):
         self.ensure_one()
         url = (
@@ -19,7 +19,7 @@ class MusicArtist(models.Model):
     _name = "oomusic.artist"
     _description = "Music Artist"
     _order = "name"
-    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin"]
+    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin", "oomusic.search.mixin"]
 
     name = fields.Char("Artist", index=True)
     track_ids = fields.One2many("oomusic.track", "artist_id", string="Tracks", readonly=True)
@@ -51,6 +51,52 @@ class MusicConfigSettings(models.TransientModel):
         help="Disable transcoding everywhere. This option bypasses any other transcoding setting. "
         "Change at your own risks!",
     )
+    trans_cache_size = fields.Integer(
+        "Transcoding Cache (MiB)",
+        config_parameter="oomusic.trans_cache_size",
+        default=500,
+        help="Maximum size of the cache of transcoded files. The least recently played files are "
+        "removed first. Set to zero to disable the cache.",
+    )
+    trans_max_jobs = fields.Integer(
+        "Max. Transcoding Jobs",
+        config_parameter="oomusic.trans_max_jobs",
+        default=8,
+        help="Maximum number of transcoding processes running at the same time. Additional jobs "
+        "are queued.",
+    )
+    trans_max_jobs_user = fields.Integer(
+        "Max. Transcoding Jobs per User",
+        config_parameter="oomusic.trans_max_jobs_user",
+        default=3,
+        help="Maximum number of transcoding processes running at the same time for a user while "
+        "playing. It does not apply to conversions.",
+    )
+    trans_prefetch = fields.Integer(
+        "Prefetched Tracks",
+        config_parameter="oomusic.trans_prefetch",
+        default=2,
+        help="Number of upcoming tracks of the current playlist transcoded in advance in the "
+        "transcoding cache. It reduces the gaps between tracks. Set to zero to disable it.",
+    )
+    zip_cache_size = fields.Integer(
+        "Archive Cache (MiB)",
+        config_parameter="oomusic.zip_cache_size",
+        default=1000,
+        help="Maximum size of the cache of the archives downloaded from shared links. The least "
+        "recently downloaded archives are removed first. Set to zero to disable the cache.",
+    )
+    analyze_loudness = fields.Boolean(
+        "Analyze Loudness",
+        help="Analyze the loudness of the tracks in the background, so that the normalized "
+        "playlists apply a static gain. Every file is decoded once, which takes a lot of CPU "
+        "time on large libraries. It does not depend on the other scheduled actions.",
+    )
+    trans_jobs_running = fields.Integer("Running Transcoding Jobs", readonly=True)
+    trans_jobs_queued = fields.Integer("Queued Transcoding Jobs", readonly=True)
+    subsonic_auth_count = fields.Integer("Subsonic Logins", readonly=True)
+    subsonic_auth_hits = fields.Integer("Subsonic Logins From Cache", readonly=True)
+    subsonic_auth_time = fields.Float("Subsonic Login Average Time (ms)", readonly=True)
     version = fields.Char("Version", readonly=True)
 
     @api.model
@@ -76,11 +122,21 @@ class MusicConfigSettings(models.TransientModel):
         res["cron"] = "active" if all([c for c in cron]) else "inactive"
         res["view"] = "tree" if all([v.split(",")[0] == "tree" for v in view]) else "kanban"
         res["folder_sharing"] = "inactive" if all([c for c in folder_sharing]) else "active"
+        res["analyze_loudness"] = self.env.ref("oomusic.oomusic_analyze_loudness").active
         res["version"] = version
+        stats = self.env["oomusic.transcoder"].get_transcode_stats()
+        res["trans_jobs_running"] = stats["running"]
+        res["trans_jobs_queued"] = stats["queued"]
+        stats = self.env["res.users"].get_subsonic_auth_stats()
+        res["subsonic_auth_count"] = stats["count"]
+        res["subsonic_auth_hits"] = stats["hits"]
+        res["subsonic_auth_time"] = stats["time"]
         return res
 
     def set_values(self):
         super(MusicConfigSettings, self).set_values()
+        # The settings change the Subsonic responses
+        self.env["res.users"]._bump_oomusic_generation()
         # Activate/deactive ir.cron
         (
             self.env.ref("oomusic.oomusic_scan_folder")
@@ -90,6 +146,9 @@ class MusicConfigSettings(models.TransientModel):
             + self.env.ref("oomusic.oomusic_build_lastfm_cache")
             + self.env.ref("oomusic.oomusic_build_spotify_cache")
         ).write({"active": bool(self.cron == "active")})
+        self.env.ref("oomusic.oomusic_analyze_loudness").write(
+            {"active": bool(self.analyze_loudness)}
+        )
         # Set view order
         if self.view == "tree":
             view_mode_album = "tree,kanban,form,graph,pivot"
@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
 import multiprocessing.dummy as mp
 import os
-import random
+import time
 from multiprocessing import cpu_count
-from shutil import copyfile, move
+from shutil import copyfile
 from tempfile import gettempdir
-from time import sleep
 
 from odoo import api, fields, models
 
+from .oomusic_transcoder import PRIORITY_BATCH
+
+_logger = logging.getLogger(__name__)
+
+# Maximum duration of a run of the conversion queue, in seconds. The scheduled action resumes the
+# conversion at its next call.
+QUEUE_TIME_LIMIT = 600
+
+# Interval between two checks of the cancellation of a conversion, in seconds
+CANCEL_CHECK_INTERVAL = 2
+
+# Manifest of the files converted in the destination folder, in sync mode
+SYNC_MANIFEST = ".koozic_manifest.json"
+
 
 class MusicConverter(models.Model):
     _name = "oomusic.converter"
@@ -68,6 +83,18 @@ class MusicConverter(models.Model):
         states={"done": [("readonly", True)], "cancel": [("readonly", True)]},
         default=cpu_count(),
     )
+    mode = fields.Selection(
+        [("convert", "Convert"), ("sync", "Sync")],
+        "Mode",
+        required=True,
+        default="convert",
+        readonly=True,
+        states={"draft": [("readonly", False)]},
+        help="- Convert: convert all the tracks.\n"
+        "- Sync: keep the destination folder as a mirror of the tracks. Only the tracks modified "
+        "since the last run are converted, and the files of the tracks removed from the list are "
+        "deleted. The converted files are listed in a manifest in the destination folder.",
+    )
     norm = fields.Boolean(
         "Normalize",
         default=False,
@@ -103,10 +130,12 @@ class MusicConverter(models.Model):
         store=False,
         help="Encoding help. When selected, the associated playlist tracks are added for conversion.",
     )
+    lines_total = fields.Integer("Tracks To Convert", readonly=True, copy=False)
+    lines_done = fields.Integer("Converted Tracks", readonly=True, copy=False)
     progress = fields.Float("Progress", compute="_compute_progress")
     show_waiting = fields.Boolean("Show Waiting", compute="_compute_show_waiting")
 
-    @api.depends("converter_line_ids.state")
+    @api.depends("state", "lines_done", "lines_total")
     def _compute_progress(self):
         for cv in self:
             if cv.state == "draft":
@@ -114,8 +143,7 @@ class MusicConverter(models.Model):
             elif cv.state == "done":
                 cv.progress = 100.0
             else:
-                lines_done = cv.converter_line_ids.filtered(lambda r: r.state == "done")
-                cv.progress = float(len(lines_done)) / float(len(cv.converter_line_ids)) * 100.0
+                cv.progress = float(cv.lines_done) / float(cv.lines_total or 1) * 100.0
 
     @api.depends("progress", "state")
     def _compute_show_waiting(self):
@@ -191,10 +219,13 @@ class MusicConverter(models.Model):
         ).sudo().unlink()
 
     def action_run(self):
-        self.write({"state": "running"})
-        self.env["oomusic.converter.line"].search([("converter_id", "in", self.ids)]).write(
-            {"state": "waiting"}
-        )
+        for cv in self:
+            lines = self.env["oomusic.converter.line"].search([("converter_id", "=", cv.id)])
+            lines_done = cv._sync_plan(lines) if cv.mode == "sync" else lines.browse()
+            lines_done.write({"state": "done"})
+            (lines - lines_done).write({"state": "waiting"})
+            cv.write({"state": "running", "lines_total": len(lines), "lines_done": len(lines_done)})
+            cv._check_done()
 
         # Activate the cron if necessary
         cron = self.env.ref("oomusic.oomusic_convert", raise_if_not_found=False)
@@ -202,30 +233,36 @@ class MusicConverter(models.Model):
             cron.sudo().try_write({"active": True})
 
     def action_draft(self):
-        self.write({"state": "draft"})
+        self.write({"state": "draft", "lines_done": 0})
         self.env["oomusic.converter.line"].search([("converter_id", "in", self.ids)]).write(
             {"state": "draft"}
         )
 
     def action_cancel(self):
         self.write({"state": "cancel"})
-        self.env["oomusic.converter.line"].search(
-            [("converter_id", "in", self.ids), ("state", "=", "waiting")]
-        ).write({"state": "cancel"})
+        # The lines being converted are locked: they are cancelled by their worker, which checks
+        # the state of the converter regularly.
+        self.flush()
+        self.env.cr.execute(
+            """
+            UPDATE oomusic_converter_line
+            SET state = 'cancel'
+            WHERE id IN (
+                SELECT id
+                FROM oomusic_converter_line
+                WHERE converter_id IN %s AND state = 'waiting'
+                FOR UPDATE SKIP LOCKED
+            )
+        """,
+            (tuple(self.ids),),
+        )
+        self.env["oomusic.converter.line"].invalidate_cache(["state"])
 
     def action_convert(self):
-        for cv in self:
-            cv_pool = mp.Pool(processes=max(cv.max_threads or 1, 1))
-            cv_lines = cv.converter_line_ids.filtered(lambda r: r.state == "waiting")
-            for i in range(len(cv_lines)):
-                cv_pool.apply_async(cv_lines[i].convert)
-
-            cv_pool.close()
-            cv_pool.join()
-            cv.write({"state": "done"})
+        self._process_queue(converter_ids=self.ids)
 
     def cron_convert(self):
-        self.search([("state", "=", "running")]).action_convert()
+        self._process_queue(time_limit=QUEUE_TIME_LIMIT)
 
     def cron_toggle(self):
         # Deactivate the cron automatically if there is no job running. This prevents unnecessary
@@ -236,6 +273,178 @@ class MusicConverter(models.Model):
                 cron.sudo().try_write({"active": False})
             return
 
+    @api.model
+    def _process_queue(self, converter_ids=None, time_limit=None):
+        """
+        Convert the waiting lines of the running converters. The lines are claimed one by one with
+        `FOR UPDATE SKIP LOCKED`, so several threads and server processes can share the queue. A
+        line is locked during its conversion: if the process crashes, the lock is released and the
+        line is converted again by the next run.
+
+        :param list converter_ids: only convert the lines of these converters
+        :param int time_limit: no line is claimed after this duration, in seconds
+        """
+        deadline = time.time() + time_limit if time_limit else None
+        domain = [("state", "=", "running")]
+        if converter_ids is not None:
+            domain.append(("id", "in", converter_ids))
+        converters = self.search(domain)
+        if not converters:
+            return
+        threads = max(max(converters.mapped("max_threads")), 1)
+
+        # In 'test_mode', the data is not committed: the lines are converted in the current
+        # transaction.
+        if self.env.context.get("test_mode"):
+            while self._convert_next(converter_ids, deadline):
+                pass
+            return
+
+        pool = mp.Pool(processes=threads)
+        for i in range(threads):
+            pool.apply_async(
+                self._process_queue_worker,
+                (converter_ids, deadline),
+                error_callback=lambda e: _logger.error("Error in conversion worker", exc_info=e),
+            )
+        pool.close()
+        pool.join()
+
+    @api.model
+    def _process_queue_worker(self, converter_ids, deadline):
+        while True:
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                converter_id = self.with_env(self.env(cr))._convert_next(converter_ids, deadline)
+            if not converter_id:
+                return
+            # A new transaction is needed to see the lines committed by the other workers
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                self.with_env(self.env(cr)).browse(converter_id)._check_done()
+
+    @api.model
+    def _convert_next(self, converter_ids, deadline):
+        """
+        Claim and convert the next waiting line. The line stays locked until the end of the
+        transaction.
+
+        :param list converter_ids: only convert the lines of these converters
+        :param float deadline: no line is claimed after this time
+        :returns: ID of the converter of the line, or False if no line was converted
+        """
+        if deadline and time.time() > deadline:
+            return False
+        query = """
+            SELECT l.id, l.converter_id
+            FROM oomusic_converter_line AS l
+            JOIN oomusic_converter AS c ON c.id = l.converter_id
+            WHERE l.state = 'waiting' AND c.state = 'running' {}
+            ORDER BY c.id, l.sequence, l.id
+            LIMIT 1
+            FOR UPDATE OF l SKIP LOCKED
+        """
+        self.flush()
+        if converter_ids is not None:
+            self.env.cr.execute(query.format("AND c.id IN %s"), (tuple(converter_ids) or (None,),))
+        else:
+            self.env.cr.execute(query.format(""))
+        res = self.env.cr.fetchone()
+        if not res:
+            return False
+
+        line = self.env["oomusic.converter.line"].browse(res[0])
+        try:
+            with self.env.cr.savepoint():
+                state = line.convert()
+        except Exception:
+            _logger.exception('Error while converting "%s"', line.track_id.path)
+            state = "error"
+        line.write({"state": state})
+        if state == "done":
+            self.env.cr.execute(
+                "UPDATE oomusic_converter SET lines_done = lines_done + 1 WHERE id = %s",
+                (res[1],),
+            )
+            self.invalidate_cache(["lines_done", "progress"], [res[1]])
+        if self.env.context.get("test_mode"):
+            self.browse(res[1])._check_done()
+        return res[1]
+
+    def _get_sync_key(self):
+        """
+        Key of the conversion parameters. A file converted with other parameters is converted
+        again.
+        """
+        self.ensure_one()
+        return "{}-{}-{}-{}".format(
+            self.transcoder_id.id, self.transcoder_id.write_date, self.bitrate, self.norm
+        )
+
+    def _sync_plan(self, lines):
+        """
+        Prepare the synchronization of the destination folder, based on the manifest of the
+        previous run:
+        - the output files up to date, i.e. converted with the same parameters after the last
+          modification of the track, are kept;
+        - the other output files of the lines are removed, so they are converted again;
+        - the output files of tracks which are not in the lines anymore are removed.
+        The manifest is then updated with the output files of all lines.
+
+        :param lines: lines of the converter
+        :returns: lines up to date
+        """
+        self.ensure_one()
+        manifest_path = os.path.join(self.dest_folder, SYNC_MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        key = self._get_sync_key()
+        new_manifest = {}
+        lines_done = lines.browse()
+        for line in lines:
+            fn = line._get_output_path()[0]
+            rel_path = os.path.relpath(fn, self.dest_folder)
+            entry = manifest.get(rel_path, {})
+            new_manifest[rel_path] = {"track_id": line.track_id.id, "key": key}
+            try:
+                mtime = os.path.getmtime(fn)
+            except OSError:
+                continue
+            if (
+                entry.get("track_id") == line.track_id.id
+                and entry.get("key") == key
+                and mtime >= line.track_id.last_modification
+            ):
+                lines_done |= line
+            else:
+                os.remove(fn)
+
+        for rel_path in set(manifest) - set(new_manifest):
+            fn = os.path.join(self.dest_folder, rel_path)
+            try:
+                os.remove(fn)
+                os.removedirs(os.path.dirname(fn))
+            except OSError:
+                pass
+
+        os.makedirs(self.dest_folder, exist_ok=True)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(new_manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return lines_done
+
+    def _check_done(self):
+        """
+        Set the running converters without waiting lines as done.
+        """
+        for cv in self.filtered(lambda r: r.state == "running"):
+            if not self.env["oomusic.converter.line"].search_count(
+                [("converter_id", "=", cv.id), ("state", "=", "waiting")]
+            ):
+                cv.write({"state": "done"})
+
 
 class MusicConverterLine(models.Model):
     _name = "oomusic.converter.line"
@@ -247,7 +456,13 @@ class MusicConverterLine(models.Model):
         "oomusic.converter", "Converter", required=True, index=True, ondelete="cascade"
     )
     state = fields.Selection(
-        [("draft", "Draft"), ("waiting", "Waiting"), ("done", "Done"), ("cancel", "Cancelled")],
+        [
+            ("draft", "Draft"),
+            ("waiting", "Waiting"),
+            ("done", "Done"),
+            ("cancel", "Cancelled"),
+            ("error", "Failed"),
+        ],
         string="State",
         required=True,
         copy=False,
@@ -270,51 +485,114 @@ class MusicConverterLine(models.Model):
         "res.users", related="converter_id.user_id", store=True, index=True, related_sudo=False
     )
 
-    def convert(self):
-        with api.Environment.manage(), self.pool.cursor() as cr:
-            if not self.env.context.get("test_mode"):
-                new_self = self.with_env(self.env(cr))
-            else:
-                new_self = self
-                sleep(random.random())
-            # In case we manually canceled the job between line selection and conversion
-            if new_self.state != "waiting":
-                return
-            transcoder = new_self.converter_id.transcoder_id
+    def _is_cancelled(self):
+        """
+        Check if the converter of the line was cancelled. A new transaction is used to see the
+        latest state, except in 'test_mode' where the data is not committed.
+        """
+        query = "SELECT state FROM oomusic_converter WHERE id = %s"
+        if self.env.context.get("test_mode"):
+            self.env.cr.execute(query, (self.converter_id.id,))
+            res = self.env.cr.fetchone()
+        else:
+            with self.pool.cursor() as cr:
+                cr.execute(query, (self.converter_id.id,))
+                res = cr.fetchone()
+        return not res or res[0] != "running"
+
+    def _get_output_path(self):
+        """
+        Path of the output file in the destination folder. The file is simply copied if it is
+        already in the output format, to avoid upsampling, except for VBR and normalization.
 
-            # Prepare folder and file
-            fn = new_self.track_id.path.replace(
-                new_self.track_id.root_folder_id.path, new_self.converter_id.dest_folder
+        :returns: path of the output file, and whether the file is copied
+        :rtype: tuple
+        """
+        self.ensure_one()
+        transcoder = self.converter_id.transcoder_id
+        fn = self.track_id.path.replace(
+            self.track_id.root_folder_id.path, self.converter_id.dest_folder
+        )
+        fn_base, fn_ext = os.path.splitext(fn)
+        if (
+            fn_ext[1:] == transcoder.output_format.name
+            and not self.converter_id.norm
+            and "-q:a" not in transcoder.command
+            and (
+                not self.converter_id.bitrate or self.converter_id.bitrate >= self.track_id.bitrate
             )
-            fn_base, fn_ext = os.path.splitext(fn)
+        ):
+            return fn, True
+        return fn_base + "." + transcoder.output_format.name, False
+
+    def convert(self):
+        """
+        Convert the track of the line. The conversion is interrupted if the converter is
+        cancelled in the meantime.
+
+        :returns: new state of the line, "done", "cancel" or "error"
+        """
+        self.ensure_one()
+        if self._is_cancelled():
+            return "cancel"
+        transcoder = self.converter_id.transcoder_id
+
+        # Prepare folder and file
+        fn_out, copy = self._get_output_path()
+        try:
+            os.makedirs(os.path.dirname(fn_out))
+        except OSError:
+            pass
+
+        # The output is written in a temporary file, so an interrupted conversion does not leave a
+        # truncated file which would be considered as up to date by the next synchronization
+        fn_tmp = fn_out + ".tmp"
+        if copy:
             try:
-                os.makedirs(os.path.dirname(fn))
-            except OSError:
-                pass
+                copyfile(self.track_id.path, fn_tmp)
+            except Exception:
+                self._remove_file(fn_tmp)
+                raise
+            os.replace(fn_tmp, fn_out)
+            return "done"
 
-            # Avoid upsampling, except for VBR and normalization
-            if (
-                fn_ext[1:] == transcoder.output_format.name
-                and not new_self.converter_id.norm
-                and "-q:a" not in transcoder.command
-                and (
-                    not new_self.converter_id.bitrate
-                    or new_self.converter_id.bitrate >= new_self.track_id.bitrate
-                )
-            ):
-                copyfile(new_self.track_id.path, fn)
-            else:
-                outdata = transcoder.transcode(
-                    new_self.track_id.id,
-                    bitrate=new_self.converter_id.bitrate,
-                    norm=new_self.converter_id.norm,
-                ).stdout
-                fn_out = fn_base + "." + transcoder.output_format.name
-                with open(fn_out + ".tmp", "wb") as outfile:
-                    for d in outdata:
-                        outfile.write(d)
-                move(fn_out + ".tmp", fn_out)
-            # In 'test_mode', the instanciation of a new registry fails on 'threading.RLock()'. We
-            # skip the state update.
-            if not self.env.context.get("test_mode"):
-                new_self.write({"state": "done"})
+        cancelled = False
+        returncode = None
+        last_check = time.time()
+        try:
+            with transcoder.transcode_job(
+                self.track_id.id,
+                bitrate=self.converter_id.bitrate,
+                norm=self.converter_id.norm,
+                priority=PRIORITY_BATCH,
+            ) as outdata, open(fn_tmp, "wb") as outfile:
+                for d in outdata:
+                    outfile.write(d)
+                    if time.time() - last_check > CANCEL_CHECK_INTERVAL:
+                        last_check = time.time()
+                        cancelled = self._is_cancelled()
+                        if cancelled:
+                            break
+                if not cancelled:
+                    returncode = outdata.wait()
+        except Exception:
+            self._remove_file(fn_tmp)
+            raise
+
+        # The output of a failed process is incomplete
+        if cancelled or returncode:
+            self._remove_file(fn_tmp)
+            if cancelled:
+                return "cancel"
+            _logger.error(
+                'Error while converting "%s": exit status %s', self.track_id.path, returncode
+            )
+            return "error"
+        os.replace(fn_tmp, fn_out)
+        return "done"
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,12 +1,194 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import os
+import struct
+import time
 import uuid
+import zlib
 from datetime import datetime, timedelta
 
 from werkzeug.urls import url_encode
 
 from odoo import api, fields, models
 
+_logger = logging.getLogger(__name__)
+
+
+class ZipStream(object):
+    """
+    ZIP archive of existing files, generated on the fly. Audio files are already compressed, so
+    the entries are stored without compression: the total length of the archive is known in
+    advance, and the memory usage is constant whatever the size of the files.
+
+    The CRC of an entry is only known once the file is read, so it is written in a data descriptor
+    after the data. ZIP64 extensions are used for the files and archives larger than 4 GiB, or
+    with more than 65535 entries.
+
+    A file modified in the meantime is truncated or padded with zeros, so the archive always has
+    the announced length.
+
+    :param list files: list of tuples (path, name in the archive)
+    """
+
+    ZIP64_LIMIT = 0xFFFFFFFF
+    ZIP64_COUNT_LIMIT = 0xFFFF
+    CHUNK_SIZE = 65536
+
+    def __init__(self, files):
+        self.entries = []
+        offset = 0
+        for path, arcname in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                _logger.warning('Could not add "%s" to the archive', path)
+                continue
+            entry = {
+                "path": path,
+                "name": arcname.encode("utf-8"),
+                "size": stat.st_size,
+                "date_time": time.localtime(stat.st_mtime)[0:6],
+                "offset": offset,
+                "zip64": stat.st_size >= self.ZIP64_LIMIT,
+            }
+            self.entries.append(entry)
+            offset += self._local_header_size(entry) + entry["size"]
+            offset += 24 if entry["zip64"] else 16
+        self.cd_offset = offset
+        self.cd_size = sum(self._central_header_size(e) for e in self.entries)
+        self.zip64 = (
+            len(self.entries) >= self.ZIP64_COUNT_LIMIT
+            or self.cd_offset >= self.ZIP64_LIMIT
+            or self.cd_size >= self.ZIP64_LIMIT
+        )
+        self.length = self.cd_offset + self.cd_size + (76 if self.zip64 else 0) + 22
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield self._local_header(entry)
+            crc = 0
+            remaining = entry["size"]
+            with open(entry["path"], "rb") as f:
+                while remaining > 0:
+                    size = min(self.CHUNK_SIZE, remaining)
+                    data = f.read(size) or b"\0" * size
+                    crc = zlib.crc32(data, crc)
+                    remaining -= len(data)
+                    yield data
+            entry["crc"] = crc
+            fmt = "<IIQQ" if entry["zip64"] else "<IIII"
+            yield struct.pack(fmt, 0x08074B50, crc, entry["size"], entry["size"])
+        for entry in self.entries:
+            yield self._central_header(entry)
+        yield self._end_records()
+
+    def _dos_date_time(self, entry):
+        dt = entry["date_time"]
+        if dt[0] < 1980:
+            dt = (1980, 1, 1, 0, 0, 0)
+        return (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2], dt[3] << 11 | dt[4] << 5 | dt[5] // 2
+
+    def _version(self, entry):
+        return 45 if entry["zip64"] or entry["offset"] >= self.ZIP64_LIMIT else 20
+
+    def _local_header_size(self, entry):
+        return 30 + len(entry["name"]) + (20 if entry["zip64"] else 0)
+
+    def _local_header(self, entry):
+        # Bit 3: sizes and CRC in the data descriptor, bit 11: UTF-8 file name
+        date, time_ = self._dos_date_time(entry)
+        size = 0xFFFFFFFF if entry["zip64"] else 0
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0) if entry["zip64"] else b""
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            self._version(entry),
+            0x0808,
+            0,
+            time_,
+            date,
+            0,
+            size,
+            size,
+            len(entry["name"]),
+            len(extra),
+        )
+        return header + entry["name"] + extra
+
+    def _central_extra(self, entry):
+        fields_64 = []
+        if entry["zip64"]:
+            fields_64 += [entry["size"], entry["size"]]
+        if entry["offset"] >= self.ZIP64_LIMIT:
+            fields_64.append(entry["offset"])
+        if not fields_64:
+            return b""
+        return struct.pack("<HH%dQ" % len(fields_64), 0x0001, 8 * len(fields_64), *fields_64)
+
+    def _central_header_size(self, entry):
+        return 46 + len(entry["name"]) + len(self._central_extra(entry))
+
+    def _central_header(self, entry):
+        date, time_ = self._dos_date_time(entry)
+        size = 0xFFFFFFFF if entry["zip64"] else entry["size"]
+        extra = self._central_extra(entry)
+        header = struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            3 << 8 | self._version(entry),
+            self._version(entry),
+            0x0808,
+            0,
+            time_,
+            date,
+            entry["crc"],
+            size,
+            size,
+            len(entry["name"]),
+            len(extra),
+            0,
+            0,
+            0,
+            0o100644 << 16,
+            min(entry["offset"], 0xFFFFFFFF),
+        )
+        return header + entry["name"] + extra
+
+    def _end_records(self):
+        records = b""
+        count = len(self.entries)
+        if self.zip64:
+            records += struct.pack(
+                "<IQHHIIQQQQ",
+                0x06064B50,
+                44,
+                3 << 8 | 45,
+                45,
+                0,
+                0,
+                count,
+                count,
+                self.cd_size,
+                self.cd_offset,
+            )
+            records += struct.pack("<IIQI", 0x07064B50, 0, self.cd_offset + self.cd_size, 1)
+        records += struct.pack(
+            "<IHHHHIIH",
+            0x06054B50,
+            0,
+            0,
+            min(count, 0xFFFF),
+            min(count, 0xFFFF),
+            min(self.cd_size, 0xFFFFFFFF),
+            min(self.cd_offset, 0xFFFFFFFF),
+            0,
+        )
+        return records
+
 
 class MusicDownload(models.Model):
 
@@ -8,7 +8,6 @@ import os
 from datetime import datetime as dt
 from random import sample
 
-from dateutil.relativedelta import relativedelta
 from mutagen import File
 from mutagen.flac import Picture
 from psycopg2 import OperationalError
@@ -23,6 +22,8 @@ class MusicFolder(models.Model):
     _name = "oomusic.folder"
     _description = "Music Folder"
     _order = "path"
+    _inherit = ["oomusic.search.mixin"]
+    _search_text_field = "path"
 
     name = fields.Char("Name")
     root = fields.Boolean("Top Level Folder", default=True)
@@ -33,9 +34,33 @@ class MusicFolder(models.Model):
         help="Exclude this folder from the automatized scheduled scan. Useful if the folder is not "
         "always accessible, e.g. linked to an external drive.",
     )
+    watch = fields.Boolean(
+        "Live Watch",
+        default=False,
+        help="Scan the folder as soon as a change is detected on the file system. Requires the "
+        "Python library watchdog and the threaded server (no workers). The scheduled scan is still "
+        "performed, unless the folder is excluded from it.",
+    )
     last_scan = fields.Datetime("Last Scanned")
     last_scan_duration = fields.Integer("Scan Duration (s)")
     last_commit = fields.Datetime("Last Commit")
+
+    # Statistics of the last scan, updated during the scan
+    scan_dirs_visited = fields.Integer("Folders Visited", readonly=True)
+    scan_dirs_skipped = fields.Integer(
+        "Folders Skipped", readonly=True, help="Folders not modified since the previous scan."
+    )
+    scan_files_parsed = fields.Integer("Files Read", readonly=True)
+    scan_files_skipped = fields.Integer(
+        "Files Skipped", readonly=True, help="Files not modified since the previous scan."
+    )
+    scan_tracks_created = fields.Integer("Tracks Created", readonly=True)
+    scan_tracks_updated = fields.Integer("Tracks Updated", readonly=True)
+    scan_errors = fields.Integer("Read Errors", readonly=True)
+    scan_time_walk = fields.Float("Folder Walk Time (s)", readonly=True)
+    scan_time_read = fields.Float("Tag Read Time (s)", readonly=True)
+    scan_time_write = fields.Float("Database Write Time (s)", readonly=True)
+    scan_time_clean = fields.Float("Cleaning Time (s)", readonly=True)
     parent_id = fields.Many2one(
         "oomusic.folder", string="Parent Folder", index=True, ondelete="cascade"
     )
@@ -49,11 +74,16 @@ class MusicFolder(models.Model):
         default=lambda self: self.env.user,
     )
     last_modification = fields.Integer("Last Modification")
+    dir_signature = fields.Char(
+        "Directory Signature",
+        help="Number of entries and hash of their names, as of the last scan. Used with the last "
+        "modification date to detect the folders which changed since the last scan.",
+    )
     locked = fields.Boolean(
         "Locked",
-        default=False,
-        help='When a folder is being scanned, it is flagged as "locked". It might be necessary to '
-        "unlock it manually if scanning has failed or has been interrupted.",
+        compute="_compute_locked",
+        help='When a folder is being scanned, it is flagged as "locked". The lock is released at '
+        "the end of the scan, or as soon as the scan is interrupted.",
     )
     use_tags = fields.Boolean("Use ID3 Tags", default=True)
     tag_analysis = fields.Selection(
@@ -63,6 +93,12 @@ class MusicFolder(models.Model):
         required=True,
         help="Choose Mutagen for better compatibility with remote mounting points, such as rclone.",
     )
+    scan_threads = fields.Integer(
+        "Scan Threads",
+        default=1,
+        help="Number of threads used to read the tags of the files during the scan. A higher value "
+        "can significantly speed up the scan of large libraries, especially on network drives.",
+    )
 
     path_name = fields.Char("Folder Name", compute="_compute_path_name")
     track_ids = fields.One2many("oomusic.track", "folder_id", "Tracks")
@@ -117,12 +153,24 @@ class MusicFolder(models.Model):
         attachment=True,
         help="Image of the folder, used in Kanban view",
     )
-    has_image = fields.Boolean("Has Image")
+    has_image = fields.Boolean(
+        "Has Image",
+        index=True,
+        help="The folder contains an image or its first track has an embedded cover art. Set by "
+        "the scan.",
+    )
 
     _sql_constraints = [
         ("oomusic_folder_path_uniq", "unique(path, user_id)", "Folder path must be unique!")
     ]
 
+    @api.model
+    def _search_text_expr(self, column, unaccent):
+        # Only the name of the folder is searched, not its full path
+        return super(MusicFolder, self)._search_text_expr(
+            "regexp_replace({}, '^.*/', '')".format(column), unaccent
+        )
+
     @api.depends("path")
     def _compute_path_name(self):
         for folder in self:
@@ -161,6 +209,24 @@ class MusicFolder(models.Model):
                 fn_paths = _("No track found")
             folder.root_preview = fn_paths
 
+    def _compute_locked(self):
+        # The scan holds an advisory lock on the pair (user_id, folder_id), see `_lock_folder`
+        folder_ids = tuple(self.filtered("id").ids)
+        locks = set()
+        if folder_ids:
+            query = """
+                SELECT classid::int, objid::int FROM pg_locks
+                WHERE locktype = 'advisory'
+                    AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                    AND objsubid = 2
+                    AND granted
+                    AND objid IN %s;
+            """
+            self.env.cr.execute(query, (folder_ids,))
+            locks = set(self.env.cr.fetchall())
+        for folder in self:
+            folder.locked = (folder.user_id.id, folder.id) in locks
+
     def _compute_root_total(self):
         folder_sharing = (
             "inactive" if self.env.ref("oomusic.oomusic_track").sudo().perm_read else "active"
@@ -205,63 +271,84 @@ class MusicFolder(models.Model):
             folder.root_total_duration = res_tracks[0][1] if res_tracks else 0
             folder.root_total_size = res_tracks[0][2] if res_tracks else 0
 
-    def _compute_image_folder(self):
+    def _get_image_file(self):
+        """
+        Return the path of the image file of the folder, i.e. an image with a name matching the
+        accepted names, or False.
+        """
+        self.ensure_one()
         accepted_names = ["folder", "cover", "front"]
+        try:
+            files = os.listdir(self.path)
+        except OSError:
+            return False
+        for f in files:
+            f_path = os.path.join(self.path, f)
+            if not any(n in f.lower() for n in accepted_names):
+                continue
+            if os.path.isfile(f_path) and imghdr.what(f_path):
+                return f_path
+        return False
+
+    def _get_embedded_image(self):
+        """
+        Return the cover art embedded in the first track of the folder, or False.
+        """
+        self.ensure_one()
+        data = False
+        try:
+            track = self.track_ids[:1]
+            track_ext = os.path.splitext(track.path)[1].lower() if track else ""
+            song = File(track.path) if track else False
+            if song:
+                if track_ext == ".mp3" and song.tags.getall("APIC"):
+                    data = song.tags.getall("APIC")[0].data
+                elif track_ext == ".flac" and song.pictures:
+                    data = song.pictures[0].data
+                elif track_ext in [".mp4", ".m4a"] and song.get("covr"):
+                    data = song["covr"][0]
+                elif track_ext in [".oga", ".ogg", ".opus"] and song.get("metadata_block_picture"):
+                    # The metadata block contains more than the picture. Indeed, it also
+                    # contains other info related to the picture such as height, width,
+                    # mimetype, etc. See for details:
+                    # https://github.com/quodlibet/mutagen/blob/caaa2c5e31d/mutagen/flac.py#L604
+                    #
+                    # Therefore, we use the 'Picture' class which handles it.
+                    b64_data = song["metadata_block_picture"][0]
+                    data = Picture(base64.b64decode(b64_data)).data
+        except:
+            _logger.debug("Error while getting embedded cover art of %s", track.path, exc_info=1)
+        return data
+
+    def _compute_image_folder(self):
         for folder in self:
             _logger.debug("Computing image folder %s...", folder.path)
 
-            # Keep image files only
-            files = [
-                f
-                for f in os.listdir(folder.path)
-                if os.path.isfile(os.path.join(folder.path, f))
-                and imghdr.what(os.path.join(folder.path, f))
-            ]
-
             # Try to find an image with a name matching the accepted names
             folder.image_folder = False
-            for f in files:
-                for n in accepted_names:
-                    if n in f.lower():
-                        with open(os.path.join(folder.path, f), "rb") as img:
-                            folder.image_folder = base64.b64encode(img.read())
-                            break
-                if folder.image_folder:
-                    break
-            if folder.image_folder:
+            f_path = folder._get_image_file()
+            if f_path:
+                with open(f_path, "rb") as img:
+                    folder.image_folder = base64.b64encode(img.read())
                 continue
 
             # Try to find an embedded cover art
-            try:
-                track = folder.track_ids[:1]
-                track_ext = os.path.splitext(track.path)[1].lower() if track else ""
-                song = File(track.path) if track else False
-                if song:
-                    data = False
-                    if track_ext == ".mp3" and song.tags.getall("APIC"):
-                        data = song.tags.getall("APIC")[0].data
-                    elif track_ext == ".flac" and song.pictures:
-                        data = song.pictures[0].data
-                    elif track_ext in [".mp4", ".m4a"] and song.get("covr"):
-                        data = song["covr"][0]
-                    elif track_ext in [".oga", ".ogg", ".opus"] and song.get(
-                        "metadata_block_picture"
-                    ):
-                        # The metadata block contains more than the picture. Indeed, it also
-                        # contains other info related to the picture such as height, width,
-                        # mimetype, etc. See for details:
-                        # https://github.com/quodlibet/mutagen/blob/caaa2c5e31d/mutagen/flac.py#L604
-                        #
-                        # Therefore, we use the 'Picture' class which handles it.
-                        b64_data = song["metadata_block_picture"][0]
-                        data = Picture(base64.b64decode(b64_data)).data
-                    if data:
-                        folder.image_folder = base64.b64encode(data)
-            except:
-                _logger.debug(
-                    "Error while getting embedded cover art of %s", track.path, exc_info=1
-                )
-                pass
+            data = folder._get_embedded_image()
+            if data:
+                folder.image_folder = base64.b64encode(data)
+
+    def _update_has_image(self):
+        """
+        Set the `has_image` flag of the folders, without reading nor resizing the images. It is
+        called by the scan, so that the listings never have to compute an image to know if it
+        exists.
+        """
+        with_image = self.browse()
+        for folder in self:
+            if folder._get_image_file() or folder._get_embedded_image():
+                with_image |= folder
+        with_image.write({"has_image": True})
+        (self - with_image).write({"has_image": False})
 
     @api.depends("image_folder")
     def _compute_image_big(self):
@@ -387,7 +474,12 @@ class MusicFolder(models.Model):
     def create(self, vals):
         if "path" in vals and vals.get("root", True):
             vals["path"] = os.path.normpath(vals["path"])
-        return super(MusicFolder, self).create(vals)
+        folder = super(MusicFolder, self).create(vals)
+        if folder.root:
+            self.env["res.users"]._bump_oomusic_generation(folder.user_id.ids)
+        if folder.watch:
+            self.env["oomusic.folder.watch"]._start_watch(folder.ids)
+        return folder
 
     def write(self, vals):
         if "path" in vals:
@@ -396,14 +488,21 @@ class MusicFolder(models.Model):
             folders.write({"last_modification": 0})
             tracks = self.env["oomusic.track"].search([("folder_id", "in", folders.ids)])
             tracks.write({"last_modification": 0})
-        return super(MusicFolder, self).write(vals)
+        res = super(MusicFolder, self).write(vals)
+        if "name" in vals or "path" in vals or "root" in vals:
+            self.env["res.users"]._bump_oomusic_generation(self.mapped("user_id").ids)
+        if "watch" in vals or "path" in vals:
+            self.env["oomusic.folder.watch"]._start_watch(self.ids)
+        return res
 
     def unlink(self):
         # Remove tracks and albums included in the folders.
         self.env["oomusic.track"].search([("folder_id", "child_of", self.ids)]).sudo().unlink()
         self.env["oomusic.album"].search([("folder_id", "child_of", self.ids)]).sudo().unlink()
         user_ids = self.mapped("user_id")
+        self.env["oomusic.folder.watch"]._stop_watch(self.ids)
         super(MusicFolder, self).unlink()
+        self.env["res.users"]._bump_oomusic_generation(user_ids.ids)
         for user_id in user_ids:
             self.env["oomusic.folder.scan"]._clean_tags(user_id.id)
 
@@ -430,9 +529,6 @@ class MusicFolder(models.Model):
             self.env.cr.commit()
             self.env["oomusic.folder.scan"].scan_folder_th(folder_id)
 
-    def action_unlock(self):
-        return self.write({"locked": False})
-
     @api.model
     def cron_scan_folder(self):
         for folder in self.search([("root", "=", True), ("exclude_autoscan", "=", False)]):
@@ -462,20 +558,6 @@ class MusicFolder(models.Model):
             folder._compute_image_small()
             self.invalidate_cache()
 
-    @api.model
-    def cron_unlock_folder(self):
-        domain = [
-            ("root", "=", True),
-            ("locked", "=", True),
-            ("last_commit", "<", dt.now() - relativedelta(seconds=300)),
-        ]
-        folders = self.search(domain)
-        if folders:
-            _logger.warning(
-                "The following folders seem locked for no reason: %s. Unlocking.", folders.ids
-            )
-            folders.action_unlock()
-
     def action_add_to_playlist(self):
         playlist = self.env["oomusic.playlist"].search([("current", "=", True)], limit=1)
         if not playlist:
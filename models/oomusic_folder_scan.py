@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
+import itertools
 import locale
 import logging
+import multiprocessing.dummy as mp
 import os
 import threading
+import time
 from datetime import datetime as dt
 
 import mutagen
 from mutagen.easyid3 import EasyID3
+from psycopg2 import OperationalError
 
 from odoo import api, fields, models
+from odoo.tools.misc import escape_psql
 
 # Pytaglib and Mutagen are supported for tag reading. Pytaglib is preferred as it seems less likely
 # to send an exception in case of incorrect file.
@@ -21,6 +28,9 @@ except ImportError:
 
 _logger = logging.getLogger(__name__)
 
+# Class of the advisory locks of `_clean_tags` ("oomu")
+CLEAN_LOCK_CLASS = 0x6F6F6D75
+
 
 class MusicFolderScan(models.TransientModel):
     _name = "oomusic.folder.scan"
@@ -60,6 +70,30 @@ class MusicFolderScan(models.TransientModel):
         "encoded_by",
     }
 
+    # Number of new tracks buffered before being inserted in the database
+    CREATE_BATCH_SIZE = 500
+
+    # Number of paths buffered before being copied in the database during the cleaning
+    COPY_BATCH_SIZE = 10000
+
+    # Number of bytes read at the beginning and at the end of a file to compute its fingerprint
+    FINGERPRINT_SIZE = 16384
+
+    # Statistics of the scan, stored on the folder
+    SCAN_STATS = [
+        "scan_dirs_visited",
+        "scan_dirs_skipped",
+        "scan_files_parsed",
+        "scan_files_skipped",
+        "scan_tracks_created",
+        "scan_tracks_updated",
+        "scan_errors",
+        "scan_time_walk",
+        "scan_time_read",
+        "scan_time_write",
+        "scan_time_clean",
+    ]
+
     MAP_ID3_FIELD = {
         "ALBUM": "album_id",
         "ALBUMARTIST": "album_artist_id",
@@ -78,24 +112,56 @@ class MusicFolderScan(models.TransientModel):
         "TRACKTOTAL": "track_total",
     }
 
-    def _lock_folder(self, folder_id):
+    def _lock_folder(self, folder_id, user_id):
         """
         Check if a folder is locked. If it is not locked, lock it. If it is locked, log an error.
 
+        The lock is a PostgreSQL advisory lock held by the connection of the current cursor. It is
+        not released by a commit, but it is released as soon as the connection is closed, e.g. if
+        the server crashes during the scan.
+
         :param int folder_id: ID of the folder to scan
+        :param int user_id: ID of the user to whom belongs the folder
         :return bool: False if the folder was already locked, True if it was not
         """
-        Folder = self.env["oomusic.folder"].browse([folder_id])
-        if Folder.locked:
+        self.env.cr.execute("SELECT pg_try_advisory_lock(%s, %s);", (user_id, folder_id))
+        res = self.env.cr.fetchone()[0]
+        if not res:
+            Folder = self.env["oomusic.folder"].browse([folder_id])
             _logger.error('"%s" is locked! It probably means that a scan is ongoing.', Folder.path)
-            res = False
         else:
-            Folder.write({"last_commit": dt.now(), "locked": True})
-            res = True
-
+            # Prevent the cleaning of the tags of the user during the scan, see `_clean_tags`
+            self.env.cr.execute(
+                "SELECT pg_advisory_lock_shared(%s);", (self._get_clean_lock_key(user_id),)
+            )
+            self.env["oomusic.folder"].browse([folder_id]).write({"last_commit": dt.now()})
         self.env.cr.commit()
         return res
 
+    def _unlock_folder(self, folder_id, user_id):
+        """
+        Release the lock of a folder. The connection of the cursor is reused once the cursor is
+        closed, so the lock must be released explicitly.
+
+        :param int folder_id: ID of the folder to scan
+        :param int user_id: ID of the user to whom belongs the folder
+        """
+        self.env.cr.execute("SELECT pg_advisory_unlock(%s, %s);", (user_id, folder_id))
+        self.env.cr.execute(
+            "SELECT pg_advisory_unlock_shared(%s);", (self._get_clean_lock_key(user_id),)
+        )
+        self.env.cr.commit()
+
+    def _get_clean_lock_key(self, user_id):
+        """
+        Key of the advisory lock protecting the tags of a user from being cleaned during a scan.
+        The single key space of the advisory locks does not overlap the one of the folder locks.
+
+        :param int user_id: ID of the user
+        :return int: key of the lock
+        """
+        return (CLEAN_LOCK_CLASS << 32) + user_id
+
     def _commit_or_flush(self):
         # Commit and close the transaction
         if not self.env.context.get("test_mode"):
@@ -110,46 +176,193 @@ class MusicFolderScan(models.TransientModel):
             ]:
                 self.env[model].flush()
 
-    def _clean_directory(self, path, user_id):
+    def _bump_generation(self, user_id):
+        """
+        Increment the library generation of the user, once the changes of the scan are committed.
+        It is done in a short transaction of its own, so that it does not conflict with the other
+        transactions of the user. If it does, the generation is incremented by the other
+        transaction anyway.
+
+        :param int user_id: ID of the user to whom belongs the folder
+        """
+        if self.env.context.get("test_mode"):
+            self.env["res.users"]._bump_oomusic_generation([user_id])
+            return
+        try:
+            self.env["res.users"]._bump_oomusic_generation([user_id])
+            self.env.cr.commit()
+        except OperationalError:
+            self.env.cr.rollback()
+
+    def _clean_directory(self, path, user_id, vanished=None):
         """
         Clean a directory. It removes folders and tracks which are not on the disk anymore. This
         can potentially deletes the folder linked to the given path if the path doesn't exist
         anymore.
 
+        The paths found on the disk are loaded in a temporary table, so the orphan records are
+        found by the database without loading all paths of the user.
+
+        If `vanished` is given, the tracks which are not on the disk anymore are not deleted but
+        added to it, so they can be matched with a moved file later in the scan (see
+        `_set_vanished`).
+
         :param str path: path of the folder to clean
         :param int user_id: ID of the user to whom belongs the folder
+        :param dict vanished: vanished tracks, by fingerprint
         """
         _logger.debug('Cleaning folder "%s"...', path)
 
         # List existing directories and files
-        filelist = set(" ")
-        folderlist = set(" ")
+        self.env["oomusic.folder"].flush(["path"])
+        self.env["oomusic.track"].flush(["path"])
+        self.env.cr.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS oomusic_scan_path (path varchar, folder boolean)
+            ON COMMIT DROP;
+            TRUNCATE oomusic_scan_path;
+            """)
+        buf = []
         for rootdir, dirnames, filenames in os.walk(path):
-            folderlist.add(rootdir)
+            buf.append((rootdir, True))
             for fn in filenames:
                 fn_ext = fn.split(".")[-1]
                 if fn_ext and fn_ext.lower() in self.ALLOWED_FILE_EXTENSIONS:
-                    filelist.add(os.path.join(rootdir, fn))
+                    buf.append((os.path.join(rootdir, fn), False))
+            if len(buf) >= self.COPY_BATCH_SIZE:
+                self._copy_paths(buf)
+                buf = []
+        self._copy_paths(buf)
+        self.env.cr.execute("ANALYZE oomusic_scan_path;")
+
+        # Cleaning part: select the records of the directory which are not on the disk anymore
+        params = (user_id, path, "{}%".format(escape_psql(os.path.join(path, ""))))
+        # The tracks are processed first, since removing a folder removes its tracks
+        for model, folder in [("oomusic.track", False), ("oomusic.folder", True)]:
+            query = """
+                SELECT r.id FROM {} r
+                WHERE r.user_id = %s
+                    AND (r.path = %s OR r.path LIKE %s)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM oomusic_scan_path p
+                        WHERE p.path = r.path AND p.folder = {}
+                    );
+            """.format(self.env[model]._table, "true" if folder else "false")
+            self.env.cr.execute(query, params)
+            to_clean = [r[0] for r in self.env.cr.fetchall()]
+            if to_clean and not folder and vanished is not None:
+                to_clean = self._set_vanished(to_clean, vanished)
+            if to_clean:
+                self.env[model].browse(to_clean).sudo().unlink()
 
-        track_data = [
-            (("id", "path"), "oomusic_folder", folderlist),
-            (("id", "path"), "oomusic_track", filelist),
-        ]
+    def _set_vanished(self, track_ids, vanished):
+        """
+        Keep the tracks which are not on the disk anymore, so a file with the same fingerprint can
+        be linked to them. They are moved to their root folder in the meantime, so they are not
+        deleted with their folder.
 
-        # Cleaning part:
-        # - select existing paths in table
-        # - compare with paths actually used
-        # - deletes the ones which are not used anymore
-        for td in track_data:
-            field_list = ",".join([x for x in td[0]])
-            query = "SELECT " + field_list + " FROM " + td[1] + " WHERE user_id = " + str(user_id)
-            self.env.cr.execute(query)
-            res = self.env.cr.fetchall()
-            to_clean = {r[1] for r in res if path in r[1]} - td[2]
+        :param list track_ids: IDs of the tracks not on the disk anymore
+        :param dict vanished: vanished tracks, by fingerprint
+        :return list: IDs of the tracks which cannot be kept, i.e. without fingerprint
+        """
+        query = """
+            SELECT t.id, t.fingerprint, al.name, ar.name, aar.name, g.name, t.year
+            FROM oomusic_track t
+                LEFT JOIN oomusic_album al ON al.id = t.album_id
+                LEFT JOIN oomusic_artist ar ON ar.id = t.artist_id
+                LEFT JOIN oomusic_artist aar ON aar.id = t.album_artist_id
+                LEFT JOIN oomusic_genre g ON g.id = t.genre_id
+            WHERE t.id IN %s;
+        """
+        self.env.cr.execute(query, (tuple(track_ids),))
+        kept = []
+        for r in self.env.cr.fetchall():
+            if not r[1] or r[1] in vanished:
+                continue
+            vanished[r[1]] = {
+                "id": r[0],
+                "album_id": r[2] or False,
+                "artist_id": r[3] or False,
+                "album_artist_id": r[4] or False,
+                "genre_id": r[5] or False,
+                "year": r[6] or "",
+            }
+            kept.append(r[0])
+        if kept:
+            query = "UPDATE oomusic_track SET folder_id = root_folder_id WHERE id IN %s;"
+            self.env.cr.execute(query, (tuple(kept),))
+            self.env["oomusic.track"].invalidate_cache(["folder_id"], kept)
+        return list(set(track_ids) - set(kept))
+
+    def _get_fingerprint(self, fn_path, size):
+        """
+        Compute a fingerprint of a file, made of its size and a hash of its first and last bytes.
+        It is cheap to compute and allows to recognize a file which was moved or renamed.
 
-            if to_clean:
-                to_clean = {r[1]: r[0] for r in res if r[1] in to_clean}.values()
-                self.env[td[1].replace("_", ".")].browse(to_clean).sudo().unlink()
+        :param str fn_path: path of the file
+        :param int size: size of the file, in bytes
+        :return str: fingerprint of the file, False if the file could not be read
+        """
+        sha = hashlib.sha1()
+        try:
+            with open(fn_path, "rb") as f:
+                sha.update(f.read(self.FINGERPRINT_SIZE))
+                if size > 2 * self.FINGERPRINT_SIZE:
+                    f.seek(-self.FINGERPRINT_SIZE, os.SEEK_END)
+                    sha.update(f.read(self.FINGERPRINT_SIZE))
+        except OSError:
+            _logger.warning('Error while reading file "%s"', fn_path, exc_info=True)
+            return False
+        return "{}:{}".format(size, sha.hexdigest())
+
+    def _match_vanished(self, fn_paths, cache):
+        """
+        Match new files with the vanished tracks having the same fingerprint. The matching tracks
+        are added to the track cache, so they are updated instead of created.
+
+        :param list fn_paths: list of tuples (path, last modification date, size, fingerprint) of
+            the files
+        :param dict cache: reading cache
+        :return tuple: (data of the matching tracks, list of the other files with their fingerprint)
+        """
+        moved = []
+        others = []
+        for fn_path, mtime, size, fingerprint in fn_paths:
+            if fn_path not in cache["track"]:
+                fingerprint = self._get_fingerprint(fn_path, size)
+                track = cache["vanished"].pop(fingerprint, False)
+                if track:
+                    _logger.debug('Track "%s" was moved to "%s"', track["id"], fn_path)
+                    cache["track"][fn_path] = (track["id"], 0, True)
+                    vals = dict(
+                        track, path=fn_path, last_modification=mtime, fingerprint=fingerprint
+                    )
+                    del vals["id"]
+                    moved.append(vals)
+                    continue
+            others.append((fn_path, mtime, size, fingerprint))
+        return moved, others
+
+    def _copy_paths(self, paths):
+        """
+        Load paths in the temporary table of `_clean_directory`.
+
+        :param list paths: list of tuples (path, is a folder)
+        """
+        if not paths:
+            return
+        data = io.StringIO(
+            "".join(
+                "{}\t{}\n".format(
+                    p.replace("\\", "\\\\")
+                    .replace("\t", "\\t")
+                    .replace("\n", "\\n")
+                    .replace("\r", "\\r"),
+                    "t" if folder else "f",
+                )
+                for p, folder in paths
+            )
+        )
+        self.env.cr.copy_from(data, "oomusic_scan_path", columns=("path", "folder"))
 
     def _clean_tags(self, user_id):
         """
@@ -158,41 +371,50 @@ class MusicFolderScan(models.TransientModel):
 
         :param int user_id: ID of the user to whom belongs the folder
         """
-        _logger.debug('Cleaning tags for user_id "%s"...', user_id)
+        # The artists, albums and genres created by the scans in progress are kept in their cache,
+        # but the tracks using them might not be committed yet. The cleaning is then left to the
+        # last scan.
+        self.env.cr.execute(
+            "SELECT pg_try_advisory_xact_lock(%s);", (self._get_clean_lock_key(user_id),)
+        )
+        if not self.env.cr.fetchone()[0]:
+            _logger.debug('Scan ongoing for user_id "%s", tags not cleaned.', user_id)
+            return
 
-        # Select relevant data from oomusic tracks
-        params = (user_id,)
-        query = """
-        SELECT artist_id, album_artist_id, performer_id, album_id, genre_id, id
-            FROM oomusic_track
-            WHERE user_id = %s;
-        """
-        self.env.cr.execute(query, params)
-        res = self.env.cr.fetchall()
-        artist_track = {r[0] for r in res} | {r[1] for r in res} | {r[2] for r in res}
-        album_track = {r[3] for r in res}
-        genre_track = {r[4] for r in res}
-        track_id_track = {r[5] for r in res}
+        _logger.debug('Cleaning tags for user_id "%s"...', user_id)
+        self.env["oomusic.track"].flush()
 
         track_data = [
-            ("id", "oomusic_artist", artist_track),
-            ("id", "oomusic_album", album_track),
-            ("id", "oomusic_genre", genre_track),
-            ("track_id", "oomusic_playlist_line", track_id_track),
+            ("oomusic.artist", ["artist_id", "album_artist_id", "performer_id"]),
+            ("oomusic.album", ["album_id"]),
+            ("oomusic.genre", ["genre_id"]),
         ]
 
         # Cleaning part:
-        # - select existing ids in table
-        # - compare with ids actually used in tracks
-        # - deletes the ones which are not used anymore
-        for td in track_data:
-            query = "SELECT " + td[0] + " FROM " + td[1] + " WHERE user_id = " + str(user_id)
-            self.env.cr.execute(query)
-            res = self.env.cr.fetchall()
-            to_clean = {r[0] for r in res} - td[2]
-
+        # - select the records of the user which are not used anymore in tracks. The records locked
+        #   by another transaction, e.g. reused by a concurrent scan, are left untouched.
+        # - deletes them
+        for model, fields_track in track_data:
+            query = "SELECT r.id FROM {} r WHERE r.user_id = %s ".format(self.env[model]._table)
+            for field in fields_track:
+                query += "AND NOT EXISTS (SELECT 1 FROM oomusic_track t WHERE t.{} = r.id) ".format(
+                    field
+                )
+            query += "FOR UPDATE OF r SKIP LOCKED;"
+            self.env.cr.execute(query, (user_id,))
+            to_clean = [r[0] for r in self.env.cr.fetchall()]
             if to_clean:
-                self.env[td[1].replace("_", ".")].browse(to_clean).sudo().unlink()
+                self.env[model].browse(to_clean).sudo().unlink()
+
+        query = """
+            SELECT l.id FROM oomusic_playlist_line l
+            WHERE l.user_id = %s
+                AND NOT EXISTS (SELECT 1 FROM oomusic_track t WHERE t.id = l.track_id);
+        """
+        self.env.cr.execute(query, (user_id,))
+        to_clean = [r[0] for r in self.env.cr.fetchall()]
+        if to_clean:
+            self.env["oomusic.playlist.line"].browse(to_clean).sudo().unlink()
 
     def _build_cache_global(self, folder_id, user_id):
         """
@@ -220,35 +442,55 @@ class MusicFolderScan(models.TransientModel):
         res = self.env.cr.fetchall()
         cache["artist"] = {r[0]: r[1] for r in res}
 
-        query = "SELECT path, id, last_modification FROM oomusic_folder WHERE user_id = %s;"
+        query = """
+            SELECT path, id, last_modification, dir_signature, has_image IS NULL
+            FROM oomusic_folder WHERE user_id = %s;
+        """
         self.env.cr.execute(query, params)
         res = self.env.cr.fetchall()
-        cache["folder"] = {r[0]: (r[1], r[2] or 0) for r in res}
+        cache["folder"] = {r[0]: (r[1], r[2] or 0, r[3] or "") for r in res}
+
+        # Folders of which the image flag must be updated. It includes the folders never checked,
+        # e.g. the ones created before the flag was set by the scan.
+        path = self.env["oomusic.folder"].browse(folder_id).path
+        cache["folder_image"] = {
+            r[1] for r in res if r[4] and (r[0] == path or r[0].startswith(os.path.join(path, "")))
+        }
 
         query = "SELECT name, id FROM oomusic_genre WHERE user_id = %s;"
         self.env.cr.execute(query, params)
         res = self.env.cr.fetchall()
         cache["genre"] = {r[0]: r[1] for r in res}
 
+        # Folders containing tracks without fingerprint, e.g. the ones scanned before it was
+        # computed. They are not skipped, so the fingerprint of their tracks is filled in.
+        query = """
+            SELECT DISTINCT folder_id FROM oomusic_track
+            WHERE root_folder_id = %s AND fingerprint IS NULL;
+        """
+        self.env.cr.execute(query, (folder_id,))
+        cache["folder_fingerprint"] = {r[0] for r in self.env.cr.fetchall()}
+
         return cache
 
     def _build_cache_folder(self, folder_id, user_id, cache):
         """
         Builds the cache for a given folder. This avoids using the ORM cache which does not show
-        the required performances for a large number of files. It caches information about tracks.
-        Only the necessary data is set in cache.
+        the required performances for a large number of files. It caches information about tracks,
+        i.e. their ID, last modification date and whether their fingerprint is known. Only the
+        necessary data is set in cache.
 
         :param int folder_id: ID of the folder to scan
         :param int user_id: ID of the user to whom belongs the folder
         """
         params = (user_id, folder_id)
         query = """
-            SELECT path, id, last_modification FROM oomusic_track
+            SELECT path, id, last_modification, fingerprint IS NOT NULL FROM oomusic_track
             WHERE user_id = %s AND folder_id = %s;
         """
         self.env.cr.execute(query, params)
         res = self.env.cr.fetchall()
-        cache["track"] = {r[0]: (r[1], r[2]) for r in res}
+        cache["track"] = {r[0]: (r[1], r[2], r[3]) for r in res}
 
     def _build_cache_write(self):
         """
@@ -268,52 +510,147 @@ class MusicFolderScan(models.TransientModel):
 
         return cache_write
 
-    def _manage_dir(self, rootdir, cache):
+    def _walk(self, path):
+        """
+        Walk the directory tree of path, in the same way than os.walk would do (symbolic links to
+        directories are not followed). The directory entries are returned, so that the stat results
+        cached by os.scandir can be reused instead of calling os.path.getmtime on every file.
+
+        The signature of a directory is made of the number of entries and a hash of their names.
+        It allows detecting a change when the modification date of the directory is not reliable,
+        e.g. on some network file systems.
+
+        :param str path: path of the directory to walk
+        :return: generator of tuples (rootdir, mtime, signature, file entries)
+        """
+        stack = [(path, int(os.stat(path).st_mtime))]
+        while stack:
+            rootdir, mtime = stack.pop()
+            try:
+                with os.scandir(rootdir) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                _logger.warning('Error while listing folder "%s"', rootdir, exc_info=True)
+                continue
+
+            subdirs = []
+            files = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry)
+                elif not entry.is_symlink():
+                    try:
+                        subdirs.append((entry.path, int(entry.stat().st_mtime)))
+                    except OSError:
+                        continue
+
+            names = "\n".join(e.name for e in entries).encode("utf-8", "surrogateescape")
+            signature = "{}:{}".format(len(entries), hashlib.sha1(names).hexdigest())
+            yield rootdir, mtime, signature, files
+
+            # Reversed, so that the sub-directories are popped in alphabetical order
+            stack.extend(reversed(subdirs))
+
+    def _get_subpaths(self, path, subpaths):
+        """
+        Return the directories to scan, without the ones contained in another directory of the
+        list, nor the ones outside of the folder.
+
+        :param str path: path of the root folder
+        :param list subpaths: directories to scan. If empty, the root folder is returned.
+        :return list: directories to scan
+        """
+        if not subpaths:
+            return [path]
+        res = []
+        for subpath in sorted({os.path.normpath(p) for p in subpaths}):
+            if subpath != path and not subpath.startswith(os.path.join(path, "")):
+                continue
+            if res and (subpath == res[-1] or subpath.startswith(os.path.join(res[-1], ""))):
+                continue
+            res.append(subpath)
+        return res
+
+    def _get_walk_paths(self, subpaths, path, cache):
+        """
+        Return the directories from which the walk must start. A directory not existing in the
+        cache can only be created if its parent exists, so we go up the tree until it is the case.
+
+        :param list subpaths: directories to scan
+        :param str path: path of the root folder
+        :param dict cache: reading cache
+        :return list: directories to walk
+        """
+        res = set()
+        for subpath in subpaths:
+            if not os.path.isdir(subpath):
+                continue
+            while subpath != path and os.path.dirname(subpath) not in cache["folder"]:
+                subpath = os.path.dirname(subpath)
+            res.add(subpath)
+        return self._get_subpaths(path, res) if res else []
+
+    def _manage_dir(self, rootdir, cache, mtime, signature):
         """
         For a given directory, checks that it is already in the cache.
         - If not in the cache, create the associated folder
-        - If in the cache, check the last modification date
-        If the last modification date is older than the one recorded, the folder is skipped
+        - If in the cache, check the last modification date and the signature
+        If the last modification date is older than the one recorded and the signature did not
+        change, the folder is skipped
 
         :param str rootdir: folder to check
         :param dict cache: reading cache
+        :param int mtime: last modification date of the folder
+        :param str signature: signature of the folder content
         :return bool: indicates if the folder scanning can be skipped
         """
         skip = False
         folder = cache["folder"].get(rootdir)
-        mtime = int(os.path.getmtime(rootdir))
 
         if not folder:
-            self._create_folder(rootdir, cache)
-        elif folder[1] >= mtime:
+            self._create_folder(rootdir, cache, mtime, signature)
+        elif folder[1] >= mtime and (not folder[2] or folder[2] == signature):
             skip = True
         else:
             parent_dir = os.sep.join(rootdir.split(os.sep)[:-1])
             parent_dir = cache["folder"].get(parent_dir, [False])
             Folder = self.env["oomusic.folder"].browse(folder[0])
-            Folder.write({"last_modification": mtime, "parent_id": parent_dir[0]})
+            Folder.write(
+                {
+                    "last_modification": mtime,
+                    "dir_signature": signature,
+                    "parent_id": parent_dir[0],
+                }
+            )
+            cache["folder"][rootdir] = (folder[0], mtime, signature)
         return skip
 
-    def _create_folder(self, rootdir, cache):
+    def _create_folder(self, rootdir, cache, mtime, signature):
         """
         Create the directory rootdir, and updates the cache.
 
         :param str rootdir: path of the folder to create
         :param dict cache: reading cache
+        :param int mtime: last modification date of the folder
+        :param str signature: signature of the folder content
         """
         parent_dir = os.sep.join(rootdir.split(os.sep)[:-1])
         parent_dir = cache["folder"].get(parent_dir)
         if parent_dir:
-            mtime = int(os.path.getmtime(rootdir))
             vals = {
                 "root": False,
                 "path": rootdir,
                 "parent_id": parent_dir[0],
                 "last_modification": mtime,
+                "dir_signature": signature,
                 "user_id": cache["user_id"],
             }
             Folder = self.env["oomusic.folder"].create(vals)
-            cache["folder"][rootdir] = (Folder.id, mtime)
+            cache["folder"][rootdir] = (Folder.id, mtime, signature)
 
     def _get_tags(self, file_path, tag=taglib):
         tag = tag or mutagen
@@ -336,46 +673,123 @@ class MusicFolderScan(models.TransientModel):
             song_tags = {k.upper(): v for k, v in song_tags.items()}
             return song, song_tags
 
-    def _create_related(self, vals, cache, rootdir):
+    def _read_file(self, fn_path, mtime, size, fingerprint, tag, use_tags):
+        """
+        Read the tags and the file data of a track. This method doesn't access the database nor the
+        cache, so it can safely be called from several threads at the same time.
+
+        :param str fn_path: path of the file to read
+        :param int mtime: last modification date of the file
+        :param int size: size of the file, in bytes
+        :param str fingerprint: fingerprint of the file, computed if None
+        :param module tag: library used to read the tags (taglib or mutagen)
+        :param bool use_tags: use the tags of the file
+        :return dict: data of the track, False if the file could not be read
+        """
+        song, song_tags = self._get_tags(fn_path, tag=tag)
+        if song is False:
+            return False
+        vals = {f: False if "_id" in f else "" for f in self.FIELDS_TO_CLEAN}
+        if use_tags:
+            vals.update(
+                {
+                    self.MAP_ID3_FIELD[k]: v[0]
+                    for k, v in song_tags.items()
+                    if v and k in self.MAP_ID3_FIELD.keys()
+                }
+            )
+
+        if tag.__name__ == "taglib":
+            vals["duration"] = song.length
+            vals["bitrate"] = song.bitrate
+        else:
+            vals["duration"] = int(song.info.length)
+            # 'bitrate' is not available for all file types
+            if hasattr(song.info, "bitrate"):
+                vals["bitrate"] = round((song.info.bitrate or 0) / 1000.0)
+            else:
+                vals["bitrate"] = 0
+        vals["duration_min"] = float(vals["duration"]) / 60
+        vals["size"] = (size or 0.0) / (1024.0 * 1024.0)
+        if fingerprint is None:
+            fingerprint = self._get_fingerprint(fn_path, size)
+        vals["fingerprint"] = fingerprint
+        vals["path"] = fn_path
+        vals["last_modification"] = mtime
+        if not vals["name"]:
+            vals["name"] = os.path.basename(fn_path)
+        try:
+            vals["track_number_int"] = (
+                int(vals["track_number"].split("/")[0]) if vals["track_number"] else 0
+            )
+        except ValueError:
+            _logger.warning("Could not convert track number '%s' to integer", vals["track_number"])
+            vals["track_number_int"] = 0
+        return vals
+
+    def _create_related(self, vals_list, cache, rootdir):
         """
-        Create the related objects of the track: album, artist and genre. Updates the cache
+        Create the related objects of the tracks: album, artist and genre. Updates the cache
         accordingly.
 
-        :param dict vals: data of the track
+        The missing names are first collected for all the tracks, then created with a single query
+        per model. Artists and genres are inserted with an upsert on the `unique(name, user_id)`
+        constraint, so a name created in the meantime by another scan is simply reused.
+
+        :param list vals_list: data of the tracks
         :param dict cache: reading cache
         :param str rootdir: path of the folder being scanned
         """
-        MusicAlbum = self.env["oomusic.album"]
-        MusicArtist = self.env["oomusic.artist"]
-        MusicGenre = self.env["oomusic.genre"]
+        folder_id = cache["folder"][rootdir][0]
+        albums = set()
+        artists = set()
+        genres = set()
+        for vals in vals_list:
+            if vals.get("album_id") and (vals["album_id"], folder_id) not in cache["album"]:
+                albums.add(vals["album_id"])
+            for field in ["artist_id", "album_artist_id", "performer_id"]:
+                if vals.get(field) and vals[field] not in cache["artist"]:
+                    artists.add(vals[field])
+            if vals.get("genre_id") and vals["genre_id"] not in cache["genre"]:
+                genres.add(vals["genre_id"])
+
+        if albums:
+            albums = sorted(albums)
+            Albums = self.env["oomusic.album"].create(
+                [
+                    {"name": album, "user_id": cache["user_id"], "folder_id": folder_id}
+                    for album in albums
+                ]
+            )
+            cache["album"].update(
+                {(album, folder_id): Albums[i].id for i, album in enumerate(albums)}
+            )
+        if artists:
+            cache["artist"].update(self._upsert_names("oomusic_artist", artists, cache["user_id"]))
+        if genres:
+            cache["genre"].update(self._upsert_names("oomusic_genre", genres, cache["user_id"]))
 
-        if (
-            vals.get("album_id")
-            and (vals["album_id"], cache["folder"][rootdir][0]) not in cache["album"].keys()
-        ):
-            cache["album"][(vals["album_id"], cache["folder"][rootdir][0])] = MusicAlbum.create(
-                {
-                    "name": vals["album_id"],
-                    "user_id": cache["user_id"],
-                    "folder_id": cache["folder"][rootdir][0],
-                }
-            ).id
-        if vals.get("artist_id") and vals["artist_id"] not in cache["artist"].keys():
-            cache["artist"][vals["artist_id"]] = MusicArtist.create(
-                {"name": vals["artist_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("album_artist_id") and vals["album_artist_id"] not in cache["artist"].keys():
-            cache["artist"][vals["album_artist_id"]] = MusicArtist.create(
-                {"name": vals["album_artist_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("performer_id") and vals["performer_id"] not in cache["artist"].keys():
-            cache["artist"][vals["performer_id"]] = MusicArtist.create(
-                {"name": vals["performer_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("genre_id") and vals["genre_id"] not in cache["genre"].keys():
-            cache["genre"][vals["genre_id"]] = MusicGenre.create(
-                {"name": vals["genre_id"], "user_id": cache["user_id"]}
-            ).id
+    def _upsert_names(self, table, names, user_id):
+        """
+        Insert the given names in a table with a `unique(name, user_id)` constraint. Existing names
+        are not duplicated.
+
+        :param str table: name of the table (oomusic_artist or oomusic_genre)
+        :param set names: names to insert
+        :param int user_id: ID of the user to whom belongs the names
+        :return dict: mapping between the names and the corresponding IDs
+        """
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        params = [(name, user_id, uid, now, uid, now) for name in sorted(names)]
+        query = """
+            INSERT INTO {} (name, user_id, create_uid, create_date, write_uid, write_date)
+            VALUES {}
+            ON CONFLICT (name, user_id) DO UPDATE SET write_date = EXCLUDED.write_date
+            RETURNING name, id;
+        """.format(table, ",".join(["%s"] * len(params)))
+        self.env.cr.execute(query, params)
+        return {r[0]: r[1] for r in self.env.cr.fetchall()}
 
     def _replace_related_by_id(self, vals, cache, rootdir):
         """
@@ -422,7 +836,105 @@ class MusicFolderScan(models.TransientModel):
         for album_id in cache_write["album"].keys():
             MusicFolder.browse([album_id]).write(cache_write["album"][album_id])
 
-    def _scan_folder(self, folder_id):
+    def _create_tracks(self, vals_list):
+        """
+        Create the tracks in a single batch. The ORM inserts all the records at once, instead of
+        one query per track.
+
+        :param list vals_list: data of the tracks to create
+        """
+        if not vals_list:
+            return
+        Tracks = self.env["oomusic.track"].create(vals_list)
+        if self.env.context.get("test_mode"):
+            Tracks.flush()
+
+    def _get_scan_stats(self, stats):
+        """
+        Return the values to write on the folder for the statistics of the scan.
+
+        :param dict stats: statistics of the scan
+        :return dict: values to write
+        """
+        return {k: round(v, 1) if isinstance(v, float) else v for k, v in stats.items()}
+
+    def _move_paths(self, moves, user_id):
+        """
+        Apply the renaming and moves of files and directories reported by the folder watcher. The
+        paths are updated in place, so the tracks keep their ID, and therefore their preferences
+        and playlist lines.
+
+        A moved directory keeps its albums, since they are linked to the folder record. A moved
+        file is flagged to be read again, so its folder and album are updated by the scan. The moves
+        of the children of a moved directory, and the moves of paths which are not recorded, are
+        ignored.
+
+        :param list moves: list of tuples (source path, destination path, is directory)
+        :param int user_id: ID of the user to whom belongs the folder
+        """
+        MusicFolder = self.env["oomusic.folder"]
+        MusicTrack = self.env["oomusic.track"]
+        moved_dirs = []
+        for src, dest, is_dir in moves:
+            # The children of a moved directory were moved along with it
+            if any(src.startswith(os.path.join(d, "")) for d in moved_dirs):
+                continue
+
+            # Nothing recorded at the source, e.g. the move was already applied
+            src_like = "{}%".format(escape_psql(os.path.join(src, "")))
+            domain_src = [("user_id", "=", user_id), ("path", "=", src)]
+            if is_dir:
+                domain_src = [
+                    ("user_id", "=", user_id),
+                    "|",
+                    ("path", "=", src),
+                    ("path", "=like", src_like),
+                ]
+            Tracks = MusicTrack.search(domain_src)
+            Folders = MusicFolder.search(domain_src) if is_dir else MusicFolder
+            if not Tracks and not Folders:
+                continue
+            _logger.debug('Moving "%s" to "%s"...', src, dest)
+            if is_dir:
+                moved_dirs.append(src)
+
+            # Anything else recorded at the destination is outdated
+            dest_like = "{}%".format(escape_psql(os.path.join(dest, "")))
+            domain = [
+                ("user_id", "=", user_id),
+                "|",
+                ("path", "=", dest),
+                ("path", "=like", dest_like),
+            ]
+            (MusicTrack.search(domain) - Tracks).sudo().unlink()
+            if is_dir:
+                (MusicFolder.search(domain + [("root", "=", False)]) - Folders).sudo().unlink()
+
+            if not is_dir:
+                Tracks.write({"path": dest, "last_modification": 0})
+                continue
+
+            # Update the paths in SQL, since the ORM would force a rescan of the moved folders
+            MusicFolder.flush()
+            MusicTrack.flush()
+            for table in ["oomusic_folder", "oomusic_track"]:
+                query = """
+                    UPDATE {}
+                    SET path = %s || substr(path, %s)
+                    WHERE user_id = %s AND (path = %s OR path LIKE %s);
+                """.format(table)
+                self.env.cr.execute(query, (dest, len(src) + 1, user_id, src, src_like))
+            MusicFolder.invalidate_cache(["path"])
+            MusicTrack.invalidate_cache(["path"])
+
+            Folder = MusicFolder.search([("user_id", "=", user_id), ("path", "=", dest)])
+            Parent = MusicFolder.search(
+                [("user_id", "=", user_id), ("path", "=", os.path.dirname(dest))]
+            )
+            if Folder and Parent:
+                Folder.write({"parent_id": Parent.id})
+
+    def _scan_folder(self, folder_id, subpaths=None, moves=None):
         """
         The folder scanning method. It walks in all sub-directories of the folder. If the
         modification date is more recent than the recorded date, the directory is scanned.
@@ -434,9 +946,15 @@ class MusicFolderScan(models.TransientModel):
         During the scan, any new album or artists will be created as well.
 
         There is an arbitrary commit every 1000 tracks or 2 minutes, which should allow a regular
-        update of the database.
+        update of the database. New tracks are inserted by batches of `CREATE_BATCH_SIZE`.
+
+        The folder watcher restricts the scan to the directories which were touched, and provides
+        the moves to apply beforehand (see `_move_paths`).
 
         :param int folder_id: ID of the folder to scan
+        :param list subpaths: directories to scan. By default, the whole folder is scanned.
+        :param list moves: list of tuples (source path, destination path, is directory)
+        :return: False if the folder is already locked by another scan
         """
         if locale.getlocale() == (None, None):
             _logger.warning(
@@ -444,45 +962,90 @@ class MusicFolderScan(models.TransientModel):
                 + "It might be resolved by setting the system variable LC_ALL to UTF-8."
             )
         with api.Environment.manage(), self.pool.cursor() as cr:
-            time_start = dt.now()
             # As this function is in a new thread, open a new cursor because the existing one may be
             # closed
-            if not self.env.context.get("test_mode"):
-                self = self.with_env(self.env(cr))
+            if self.env.context.get("test_mode"):
+                return self._scan_folder_run(folder_id, subpaths=subpaths, moves=moves)
 
-                # Lock the folder. A new cursor is necessary right after since it is closed
-                # explicitly. If the folder is locked, do nothing
-                if not self._lock_folder(folder_id):
-                    return {}
+            self = self.with_env(self.env(cr))
 
-            MusicFolder = self.env["oomusic.folder"]
-            MusicTrack = self.env["oomusic.track"]
+            # Lock the folder. If the folder is locked, do nothing. The lock is held by the
+            # connection, so it is released at the end of the scan, or if the connection is lost.
+            user_id = self.env["oomusic.folder"].browse([folder_id]).user_id.id
+            if not self._lock_folder(folder_id, user_id):
+                return False
+            try:
+                return self._scan_folder_run(folder_id, subpaths=subpaths, moves=moves)
+            except Exception:
+                self.env.cr.rollback()
+                raise
+            finally:
+                self._unlock_folder(folder_id, user_id)
 
-            Folder = MusicFolder.browse([folder_id])
-            if Folder.tag_analysis == "taglib" and taglib:
-                tag = taglib
-            else:
-                tag = mutagen
-
-            # Clean-up the DB before actual scan
-            self._clean_directory(Folder.path, Folder.user_id.id)
-            if not Folder.exists():
-                if not self.env.context.get("test_mode"):
-                    self.env.cr.commit()
-                return {}
-
-            # Build the cache
-            # - cache is used for read/search, i.e. avoid reading/searching same info several times
-            # - cache_write is used for writing tracks info on other models and avoid stored
-            #   related/computed fields
-            cache = self._build_cache_global(Folder.id, Folder.user_id.id)
-            cache_write = self._build_cache_write()
-            i = 0
+    def _scan_folder_run(self, folder_id, subpaths=None, moves=None):
+        """
+        Scan the folder, once it is locked. See `_scan_folder`.
+
+        :param int folder_id: ID of the folder to scan
+        :param list subpaths: directories to scan. By default, the whole folder is scanned.
+        :param list moves: list of tuples (source path, destination path, is directory)
+        """
+        time_start = dt.now()
+        MusicFolder = self.env["oomusic.folder"]
+        MusicTrack = self.env["oomusic.track"]
+
+        Folder = MusicFolder.browse([folder_id])
+        if Folder.tag_analysis == "taglib" and taglib:
+            tag = taglib
+        else:
+            tag = mutagen
+        use_tags = Folder.use_tags
+
+        # Statistics of the scan, reset at the beginning
+        stats = dict.fromkeys(self.SCAN_STATS, 0)
+        mark = time.perf_counter()
+
+        # Apply the moves, then clean-up the DB before actual scan
+        if moves:
+            self._move_paths(moves, Folder.user_id.id)
+        subpaths = self._get_subpaths(Folder.path, subpaths)
+        vanished = {}
+        for subpath in subpaths:
+            self._clean_directory(subpath, Folder.user_id.id, vanished=vanished)
+        if not Folder.exists():
+            if not self.env.context.get("test_mode"):
+                self.env.cr.commit()
+            return {}
+
+        # Build the cache
+        # - cache is used for read/search, i.e. avoid reading/searching same info several times
+        # - cache_write is used for writing tracks info on other models and avoid stored
+        #   related/computed fields
+        stats["scan_time_clean"] += time.perf_counter() - mark
+        Folder.write(self._get_scan_stats(stats))
+        self._commit_or_flush()
+
+        cache = self._build_cache_global(Folder.id, Folder.user_id.id)
+        cache["vanished"] = vanished
+        cache_write = self._build_cache_write()
+        walk = itertools.chain.from_iterable(
+            self._walk(p) for p in self._get_walk_paths(subpaths, Folder.path, cache)
+        )
+        vals_create = []
+        i = 0
 
+        # Tag reading pool. Only the tag reading is performed in parallel, the database writes
+        # are all done sequentially in the current thread since they rely on the cache.
+        threads = max(Folder.scan_threads, 1)
+        pool = mp.Pool(processes=threads) if threads > 1 else False
+
+        try:
             # Start scanning
             time_commit = time_start
-            for rootdir, dirnames, filenames in os.walk(Folder.path):
+            mark = time.perf_counter()
+            for rootdir, dir_mtime, signature, entries in walk:
                 _logger.debug('Scanning folder "%s"...', rootdir)
+                stats["scan_dirs_visited"] += 1
 
                 # If the folder is in cache, it means we'll have to fetch the track data. We check
                 # now since _manage_dir will add a missing folder in the cache.
@@ -490,85 +1053,100 @@ class MusicFolderScan(models.TransientModel):
                 if rootdir in cache["folder"]:
                     build_cache_folder = True
 
-                skip = self._manage_dir(rootdir, cache)
-                if skip:
+                skip = self._manage_dir(rootdir, cache, dir_mtime, signature)
+                if skip and cache["folder"][rootdir][0] not in cache["folder_fingerprint"]:
+                    stats["scan_dirs_skipped"] += 1
                     continue
+                if rootdir in cache["folder"]:
+                    cache["folder_image"].add(cache["folder"][rootdir][0])
 
                 # Complete the cache with track data
                 if build_cache_folder:
                     self._build_cache_folder(cache["folder"][rootdir][0], Folder.user_id.id, cache)
 
-                for fn in filenames:
+                # List the files to scan, and the unchanged tracks without fingerprint
+                fn_paths = []
+                fn_backfill = []
+                for entry in entries:
                     # Check file extension
-                    fn_ext = fn.split(".")[-1]
+                    fn_ext = entry.name.split(".")[-1]
                     if fn_ext and fn_ext.lower() not in self.ALLOWED_FILE_EXTENSIONS:
                         continue
 
-                    # Skip file if already in DB
-                    fn_path = os.path.join(rootdir, fn)
-                    mtime = int(os.path.getmtime(fn_path))
-                    if fn_path in cache["track"].keys() and cache["track"][fn_path][1] >= mtime:
+                    # Skip file if already in DB. The stat result is cached by the directory entry.
+                    fn_path = entry.path
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        _logger.warning('Error while reading file "%s"', fn_path, exc_info=True)
                         continue
-
-                    # Get tags
-                    song, song_tags = self._get_tags(os.path.join(rootdir, fn), tag=tag)
-                    if song is False:
+                    mtime = int(stat.st_mtime)
+                    if fn_path in cache["track"].keys() and cache["track"][fn_path][1] >= mtime:
+                        stats["scan_files_skipped"] += 1
+                        if not cache["track"][fn_path][2]:
+                            fn_backfill.append((cache["track"][fn_path][0], fn_path, stat.st_size))
                         continue
-                    vals = {f: False if "_id" in f else "" for f in self.FIELDS_TO_CLEAN}
-                    if Folder.use_tags:
-                        vals.update(
-                            {
-                                self.MAP_ID3_FIELD[k]: v[0]
-                                for k, v in song_tags.items()
-                                if v and k in self.MAP_ID3_FIELD.keys()
-                            }
-                        )
-
-                    # Create new album, artist or genre, and update the cache
-                    self._create_related(vals, cache, rootdir)
+                    fn_paths.append((fn_path, mtime, stat.st_size, None))
+
+                # Link the new files to the vanished tracks with the same fingerprint. They are
+                # updated without reading the tags again. The fingerprints computed for the other
+                # files are reused when reading them.
+                moved = []
+                if cache["vanished"]:
+                    moved, fn_paths = self._match_vanished(fn_paths, cache)
+
+                now = time.perf_counter()
+                stats["scan_time_walk"] += now - mark
+                mark = now
+
+                # Read the tags. The files are read in the pool, while the database is only
+                # accessed from the current thread.
+                if pool:
+                    res = pool.map(lambda f: self._read_file(*f, tag, use_tags), fn_paths)
+                    fingerprints = pool.map(lambda f: self._get_fingerprint(*f[1:]), fn_backfill)
+                else:
+                    res = [self._read_file(*f, tag, use_tags) for f in fn_paths]
+                    fingerprints = [self._get_fingerprint(*f[1:]) for f in fn_backfill]
+                res = [vals for vals in res if vals]
+                for f, fingerprint in zip(fn_backfill, fingerprints):
+                    if fingerprint:
+                        MusicTrack.browse(f[0]).write({"fingerprint": fingerprint})
+                stats["scan_files_parsed"] += len(fn_paths)
+                stats["scan_errors"] += len(fn_paths) - len(res)
+                res += moved
+
+                now = time.perf_counter()
+                stats["scan_time_read"] += now - mark
+                mark = now
+
+                # Create new albums, artists or genres of the directory, and update the cache
+                self._create_related(res, cache, rootdir)
+
+                for vals in res:
+                    fn_path = vals["path"]
 
                     # Replace album, artist or genre by ID
                     self._replace_related_by_id(vals, cache, rootdir)
 
                     # Add missing fields
-                    if tag.__name__ == "taglib":
-                        vals["duration"] = song.length
-                        vals["bitrate"] = song.bitrate
-                    else:
-                        vals["duration"] = int(song.info.length)
-                        # 'bitrate' is not available for all file types
-                        if hasattr(song.info, "bitrate"):
-                            vals["bitrate"] = round((song.info.bitrate or 0) / 1000.0)
-                        else:
-                            vals["bitrate"] = 0
-                    vals["duration_min"] = float(vals["duration"]) / 60
-                    vals["size"] = (os.path.getsize(fn_path) or 0.0) / (1024.0 * 1024.0)
-                    vals["path"] = fn_path
-                    vals["last_modification"] = mtime
                     vals["root_folder_id"] = folder_id
                     vals["folder_id"] = cache["folder"][rootdir][0]
                     vals["user_id"] = cache["user_id"]
-                    if not vals["name"]:
-                        vals["name"] = fn
-                    try:
-                        vals["track_number_int"] = (
-                            int(vals["track_number"].split("/")[0]) if vals["track_number"] else 0
-                        )
-                    except ValueError:
-                        _logger.warning(
-                            "Could not convert track number '%s' to integer", vals["track_number"]
-                        )
-                        vals["track_number_int"] = 0
 
                     # Create the track. No need to insert a new track in the cache, since we won't
-                    # scan it during the process.
+                    # scan it during the process. New tracks are buffered and created by batch.
                     if fn_path in cache["track"].keys():
                         Track = MusicTrack.browse(cache["track"][fn_path][0])
                         Track.write(vals)
                         if self.env.context.get("test_mode"):
                             Track.flush()
+                        stats["scan_tracks_updated"] += 1
                     else:
-                        Track = MusicTrack.create(vals)
+                        vals_create.append(vals)
+                        stats["scan_tracks_created"] += 1
+                        if len(vals_create) >= self.CREATE_BATCH_SIZE:
+                            self._create_tracks(vals_create)
+                            vals_create = []
 
                     # Update writing cache
                     self._update_cache_write(vals, cache_write)
@@ -576,39 +1154,88 @@ class MusicFolderScan(models.TransientModel):
                     # Commit every 1000 tracks or 2 minutes
                     i = i + 1
                     if i % 1000 == 0 or (dt.now() - time_commit).total_seconds() > 120:
+                        # Create the pending tracks
+                        self._create_tracks(vals_create)
+                        vals_create = []
+
                         # Empty cache_write, so user already sees the album-related additional info
                         self._write_cache_write(cache_write)
                         cache_write = self._build_cache_write()
                         time_commit = dt.now()
-                        Folder.write({"last_commit": time_commit, "locked": True})
+                        stats["scan_time_write"] += time.perf_counter() - mark
+                        mark = time.perf_counter()
+                        Folder.write(dict(self._get_scan_stats(stats), last_commit=time_commit))
 
                         # Commit and close the transaction
                         self._commit_or_flush()
-
-            # Final stuff to write and tags cleaning
-            self._write_cache_write(cache_write)
-            if Folder.exists():
-                if Folder.last_scan:
-                    self._commit_or_flush()
-                    self._clean_tags(Folder.user_id.id)
-                Folder.write(
-                    {
-                        "last_scan": fields.Datetime.now(),
-                        "last_scan_duration": round((dt.now() - time_start).total_seconds()),
-                        "last_commit": dt.now(),
-                        "locked": False,
-                    }
-                )
-            self._commit_or_flush()
-            if self.env.context.get("test_mode"):
-                self.invalidate_cache()
-            _logger.debug('Scan of folder_id "%s" completed!', folder_id)
-            return {}
+                        self._bump_generation(cache["user_id"])
+
+                now = time.perf_counter()
+                stats["scan_time_write"] += now - mark
+                mark = now
+        finally:
+            # The threads of the pool are released, even if the scan failed
+            if pool:
+                pool.close()
+                pool.join()
+
+        # Final stuff to write and tags cleaning. The vanished tracks which were not found
+        # elsewhere are removed.
+        mark = time.perf_counter()
+        self._create_tracks(vals_create)
+        self._write_cache_write(cache_write)
+        now = time.perf_counter()
+        stats["scan_time_write"] += now - mark
+        mark = now
+        if cache["vanished"]:
+            MusicTrack.browse([v["id"] for v in cache["vanished"].values()]).sudo().unlink()
+        MusicFolder.browse(cache["folder_image"]).exists()._update_has_image()
+        if Folder.exists():
+            if Folder.last_scan:
+                self._commit_or_flush()
+                self._clean_tags(Folder.user_id.id)
+            stats["scan_time_clean"] += time.perf_counter() - mark
+            vals = self._get_scan_stats(stats)
+            vals.update(
+                {
+                    "last_scan": fields.Datetime.now(),
+                    "last_scan_duration": round((dt.now() - time_start).total_seconds()),
+                    "last_commit": dt.now(),
+                }
+            )
+            Folder.write(vals)
+        self._commit_or_flush()
+        if moves or stats["scan_dirs_visited"] > stats["scan_dirs_skipped"]:
+            self._bump_generation(cache["user_id"])
+        if self.env.context.get("test_mode"):
+            self.invalidate_cache()
+        duration = (dt.now() - time_start).total_seconds()
+        _logger.info(
+            'Scan of folder_id "%s" completed: %s files in %ss (%.1f files/s, %s threads)',
+            folder_id,
+            i,
+            round(duration),
+            i / duration if duration else 0.0,
+            threads,
+        )
+        _logger.debug(
+            'Scan of folder_id "%s": walk %.1fs, tag read %.1fs, write %.1fs, cleaning %.1fs',
+            folder_id,
+            stats["scan_time_walk"],
+            stats["scan_time_read"],
+            stats["scan_time_write"],
+            stats["scan_time_clean"],
+        )
+        return {}
 
     def scan_folder_th(self, folder_id):
         """
-        This is the method used to scan a oomusic folder with a new thread. Only one folder should be
-        scanned at a time, since different folders can share album, artist and genre data.
+        This is the method used to scan a oomusic folder with a new thread. Several root folders can
+        be scanned at the same time: each folder is locked separately, and the shared artists and
+        genres are created with upserts.
+
+        The tags of the files can be read by several threads, see the field `scan_threads` of the
+        folder.
 
         To improve scanning speed, two parameters are set in the context:
         - `recompute`: prevents calculating non-stored calculated fields
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+from odoo import SUPERUSER_ID, api, models, registry
+from odoo.tools import config
+
+# Watchdog is optional. Without it, the folders are only scanned by the scheduled action.
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+_logger = logging.getLogger(__name__)
+
+# Running watchers, by database name and folder ID
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+class FolderEventHandler(FileSystemEventHandler):
+    """
+    Collect the file system events of a root folder. The events are coalesced: the scan is only
+    triggered once no event was received for `WATCH_DELAY` seconds, or at most `WATCH_MAX_DELAY`
+    seconds after the first event.
+    """
+
+    WATCH_DELAY = 10
+    WATCH_MAX_DELAY = 60
+
+    def __init__(self, dbname, folder_id, path, extensions):
+        super(FolderEventHandler, self).__init__()
+        self.dbname = dbname
+        self.folder_id = folder_id
+        self.path = path
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self.timer = None
+        self.first_event = None
+        self.subpaths = set()
+        self.moves = []
+
+    def _in_folder(self, path):
+        return path == self.path or path.startswith(os.path.join(self.path, ""))
+
+    def _is_audio(self, path):
+        fn_ext = path.split(".")[-1]
+        return fn_ext and fn_ext.lower() in self.extensions
+
+    def _in_moved_dir(self, src_path, dest_path):
+        """
+        Check if a move is the consequence of the move of a parent directory already queued.
+        """
+        for src, dest, is_dir in self.moves:
+            if not is_dir:
+                continue
+            src, dest = os.path.join(src, ""), os.path.join(dest, "")
+            if src_path.startswith(src) and dest_path == dest + src_path[len(src) :]:
+                return True
+        return False
+
+    def on_any_event(self, event):
+        if event.event_type not in ("created", "deleted", "modified", "moved", "closed"):
+            return
+        if not event.is_directory and not self._is_audio(event.src_path):
+            if event.event_type != "moved" or not self._is_audio(event.dest_path):
+                return
+
+        # When a directory is moved, the observer also sends a moved event for each of its
+        # children. They are already covered by the move of the directory.
+        if getattr(event, "is_synthetic", False):
+            return
+
+        with self.lock:
+            src_path = event.src_path
+            if event.event_type == "moved":
+                dest_path = event.dest_path
+                if self._in_folder(src_path) and self._in_folder(dest_path):
+                    if not self._in_moved_dir(src_path, dest_path):
+                        self.moves.append((src_path, dest_path, event.is_directory))
+                if self._in_folder(dest_path):
+                    self.subpaths.add(os.path.dirname(dest_path))
+                    if event.is_directory:
+                        self.subpaths.add(dest_path)
+            elif event.is_directory:
+                self.subpaths.add(src_path)
+            self.subpaths.add(os.path.dirname(src_path))
+            self._schedule()
+
+    def _schedule(self, delay=None):
+        if self.timer:
+            self.timer.cancel()
+        now = time.time()
+        self.first_event = self.first_event or now
+        if delay is None:
+            delay = min(self.WATCH_DELAY, self.first_event + self.WATCH_MAX_DELAY - now)
+        self.timer = threading.Timer(max(delay, 0), self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+
+    def flush(self):
+        with self.lock:
+            subpaths, moves = self.subpaths, self.moves
+            self.subpaths, self.moves = set(), []
+            self.first_event = None
+            self.timer = None
+        if not subpaths and not moves:
+            return
+
+        _logger.debug('Changes detected in folder "%s"', self.path)
+        try:
+            with api.Environment.manage(), registry(self.dbname).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                Folder = env["oomusic.folder"].browse(self.folder_id).exists()
+                if not Folder:
+                    return
+                if not Folder.locked:
+                    res = (
+                        env["oomusic.folder.scan"]
+                        .with_context(recompute=False, prefetch_fields=False)
+                        ._scan_folder(self.folder_id, subpaths=list(subpaths), moves=moves)
+                    )
+                    # A scan might have started in the meantime
+                    if res is not False:
+                        return
+        except Exception:
+            _logger.exception('Error while scanning folder "%s"', self.path)
+            return
+
+        # A scan is ongoing, try again later
+        with self.lock:
+            self.subpaths |= subpaths
+            self.moves = moves + self.moves
+            self._schedule(delay=self.WATCH_MAX_DELAY)
+
+
+class MusicFolderWatch(models.AbstractModel):
+    _name = "oomusic.folder.watch"
+    _description = "Music Folder Live Watcher"
+
+    def _register_hook(self):
+        super(MusicFolderWatch, self)._register_hook()
+        self._start_watch()
+
+    def _can_watch(self):
+        """
+        The watchers are threads of the server process. With several workers, each of them would
+        start its own watchers, so they are only available with the threaded server.
+        """
+        return Observer is not None and not config["workers"]
+
+    @api.model
+    def _start_watch(self, folder_ids=None):
+        """
+        Start the watchers of the root folders flagged to be watched. Watchers which are not needed
+        anymore are stopped.
+
+        :param list folder_ids: IDs of the folders to update. By default, all folders are updated.
+        """
+        if not self._can_watch():
+            return
+        domain = [("root", "=", True)]
+        if folder_ids is not None:
+            domain.append(("id", "in", folder_ids))
+        folders = self.env["oomusic.folder"].sudo().search(domain)
+        dbname = self.env.cr.dbname
+        extensions = self.env["oomusic.folder.scan"].ALLOWED_FILE_EXTENSIONS
+
+        with _watchers_lock:
+            for folder in folders:
+                key = (dbname, folder.id)
+                current = _watchers.get(key)
+                if current and (not folder.watch or current[1].path != folder.path):
+                    self._stop_watch_unlocked(key)
+                    current = False
+                if current or not folder.watch or not os.path.isdir(folder.path):
+                    continue
+
+                handler = FolderEventHandler(dbname, folder.id, folder.path, extensions)
+                observer = Observer()
+                try:
+                    observer.schedule(handler, folder.path, recursive=True)
+                    observer.daemon = True
+                    observer.start()
+                except Exception:
+                    _logger.warning(
+                        'Could not watch folder "%s", it will only be scanned by the scheduled '
+                        "action.",
+                        folder.path,
+                        exc_info=True,
+                    )
+                    continue
+                _watchers[key] = (observer, handler)
+                _logger.info('Watching folder "%s"', folder.path)
+
+    @api.model
+    def _stop_watch(self, folder_ids):
+        """
+        Stop the watchers of the given folders.
+
+        :param list folder_ids: IDs of the folders
+        """
+        with _watchers_lock:
+            for folder_id in folder_ids:
+                self._stop_watch_unlocked((self.env.cr.dbname, folder_id))
+
+    @api.model
+    def _stop_watch_unlocked(self, key):
+        observer, handler = _watchers.pop(key, (False, False))
+        if observer:
+            handler.cancel()
+            observer.stop()
+            _logger.info('Stopped watching folder "%s"', handler.path)
@@ -38,7 +38,8 @@ class MusicPlaylist(models.Model):
         "requires FFmpeg >=3.2.1 which includes by default the appropriate library "
         "(libebur128).\n"
         "Transcoding will be significantly slower when activated, implying larger gaps between"
-        " songs.",
+        " songs. Once the loudness of a track is analyzed, a static gain is applied instead, "
+        "which is as fast as the standard transcoding.",
     )
     audio = fields.Selection(
         [("html", "HTML5 Audio"), ("web", "Web Audio API")],
@@ -355,6 +356,9 @@ class MusicPlaylistLine(models.Model):
         "oomusic.playlist", "Playlist", required=True, index=True, ondelete="cascade"
     )
     playing = fields.Boolean("Playing", default=False)
+    shuffle_key = fields.Float(
+        "Shuffle Key", default=lambda s: random.random(), readonly=True, copy=False
+    )
     track_id = fields.Many2one("oomusic.track", "Track", required=True, ondelete="cascade")
     track_number = fields.Char(
         "Track #", related="track_id.track_number", readonly=True, related_sudo=False
@@ -380,7 +384,62 @@ class MusicPlaylistLine(models.Model):
     )
     last_play = fields.Datetime("Last Played", readonly=True)
 
-    def oomusic_set_current(self):
+    def init(self):
+        # When the column is created, the existing lines all receive the same shuffle key
+        self.env.cr.execute(
+            """
+            UPDATE oomusic_playlist_line
+            SET shuffle_key = random()
+            WHERE shuffle_key IN (
+                SELECT shuffle_key
+                FROM oomusic_playlist_line
+                GROUP BY shuffle_key
+                HAVING count(*) > 1
+            )
+        """
+        )
+
+    def _get_next_lines(self, count, shuffle=False):
+        """
+        Return the lines following the current one in the playlist, going back to the beginning
+        at the end of the playlist. In shuffle mode, the lines are ordered by their shuffle key, so
+        the order is known in advance.
+
+        :param int count: maximum number of lines to return
+        :param bool shuffle: use the shuffle order
+        :returns: following lines, in order
+        """
+        self.ensure_one()
+        lines = self.playlist_id.playlist_line_ids
+        if shuffle:
+            lines = lines.sorted(key=lambda r: (r.shuffle_key, r.id))
+        try:
+            idx = lines._ids.index(self.id)
+        except ValueError:
+            return self.browse()
+        return self.browse(
+            [lines._ids[(idx + i) % len(lines)] for i in range(1, min(count, len(lines)) + 1)]
+        )
+
+    def _prefetch(self, shuffle=False):
+        """
+        Transcode the next tracks of the playlist in advance, so they are available in the
+        transcoding cache when played.
+
+        :param bool shuffle: use the shuffle order
+        :returns: paths of the cached files to prefetch
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        count = int(ConfigParam.get_param("oomusic.trans_prefetch", 2))
+        audio_mode = self.playlist_id.audio_mode
+        if not count or ConfigParam.get_param("oomusic.trans_disabled") or audio_mode == "raw":
+            return []
+        lines = self._get_next_lines(count, shuffle=shuffle)
+        return self.env["oomusic.transcoder"].prefetch(
+            lines.mapped("track_id").ids, norm=audio_mode == "norm"
+        )
+
+    def oomusic_set_current(self, shuffle=False):
         now = fields.Datetime.now()
         res = {}
         if not self.id:
@@ -397,6 +456,17 @@ class MusicPlaylistLine(models.Model):
 
         # Specific case of a dynamic playlist
         self.playlist_id._update_dynamic()
+
+        # Draw a new shuffle order once the last track of the current one is reached
+        if shuffle and self.exists():
+            lines = self.playlist_id.playlist_line_ids
+            if max(lines.mapped(lambda r: (r.shuffle_key, r.id))) == (self.shuffle_key, self.id):
+                for line in lines:
+                    line.shuffle_key = random.random()
+
+        # Transcode the next tracks in advance
+        if self.exists():
+            self._prefetch(shuffle=shuffle)
         return json.dumps(res)
 
     def oomusic_play_skip(self, play=False):
@@ -483,8 +553,11 @@ class MusicPlaylistLine(models.Model):
         return json.dumps(res)
 
     def oomusic_shuffle(self):
-        lines = self.playlist_id.playlist_line_ids
-        return lines[random.randint(0, len(lines) - 1)].oomusic_play()
+        line = self._get_next_lines(1, shuffle=True)
+        if not line:
+            lines = self.playlist_id.playlist_line_ids
+            line = lines[random.randint(0, len(lines) - 1)]
+        return line.oomusic_play()
 
     def oomusic_last_track(self):
         playlist = self.env["oomusic.playlist"].search([("current", "=", True)], limit=1)
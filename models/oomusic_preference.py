@@ -49,6 +49,15 @@ class MusicPreference(models.Model):
     )
     tag_ids = fields.Many2many("oomusic.tag", string="Custom Tags")
 
+    def init(self):
+        # The last change of the preferences of a user is part of the Subsonic ETags
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS oomusic_preference_user_id_write_date_index
+            ON oomusic_preference (user_id, write_date)
+        """
+        )
+
 
 class MusicPreferenceMixin(models.AbstractModel):
     _name = "oomusic.preference.mixin"
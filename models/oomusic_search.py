@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from psycopg2 import Error
+
+from odoo import api, models, tools
+from odoo.tools.misc import escape_psql
+
+_logger = logging.getLogger(__name__)
+
+
+class MusicSearchMixin(models.AbstractModel):
+    _name = "oomusic.search.mixin"
+    _description = "Search Mixin"
+
+    # Column searched by `_search_text`
+    _search_text_field = "name"
+
+    def init(self):
+        super(MusicSearchMixin, self).init()
+        if self._abstract:
+            return
+
+        cr = self.env.cr
+        # The extensions are optional: creating them requires enough privileges on the database
+        for ext in ["pg_trgm", "unaccent"]:
+            try:
+                with cr.savepoint(), tools.mute_logger("odoo.sql_db"):
+                    cr.execute("CREATE EXTENSION IF NOT EXISTS {}".format(ext))
+            except Error:
+                _logger.info('Extension "%s" is not available, search will be slower.', ext)
+        cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'unaccent'")
+        if cr.fetchone():
+            # unaccent() is only STABLE, so it cannot be used in an index without this wrapper
+            cr.execute(
+                """
+                CREATE OR REPLACE FUNCTION oomusic_unaccent(text) RETURNS text AS $$
+                    SELECT unaccent('unaccent'::regdictionary, $1)
+                $$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+            """
+            )
+        self.clear_caches()
+
+        trgm, unaccent = self._get_search_text_features()
+        if not trgm:
+            return
+        # The first index is used by the ORM 'ilike' searches of the web client, the second one by
+        # `_search_text`
+        indexes = {
+            "{}_{}_trgm_index".format(self._table, self._search_text_field): '"{}"'.format(
+                self._search_text_field
+            ),
+            "{}_search_trgm_index".format(self._table): self._search_text_expr(
+                '"{}"'.format(self._search_text_field), unaccent
+            ),
+        }
+        for name, expr in indexes.items():
+            cr.execute(
+                "CREATE INDEX IF NOT EXISTS {} ON {} USING gin (({}) gin_trgm_ops)".format(
+                    name, self._table, expr
+                )
+            )
+
+    @api.model
+    @tools.ormcache()
+    def _get_search_text_features(self):
+        """
+        Check which of the optional database features are available.
+
+        :return tuple: (pg_trgm is installed, the unaccent wrapper exists)
+        """
+        self.env.cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        trgm = bool(self.env.cr.fetchone())
+        self.env.cr.execute("SELECT 1 FROM pg_proc WHERE proname = 'oomusic_unaccent'")
+        unaccent = bool(self.env.cr.fetchone())
+        return trgm, unaccent
+
+    @api.model
+    def _search_text_expr(self, column, unaccent):
+        """
+        SQL expression of the searched text. It must stay IMMUTABLE, since it is indexed.
+
+        :param str column: quoted, and possibly qualified, name of the column
+        :param bool unaccent: remove the accents
+        :return str: SQL expression
+        """
+        return "oomusic_unaccent({})".format(column) if unaccent else column
+
+    @api.model
+    def _search_text(self, queries, domain=None, where=None, limit=None, offset=0):
+        """
+        Search the records whose text contains all the queries, case and accent-insensitively. The
+        results are ranked by relevance: the records starting with the first query come first,
+        then the most similar ones and the shortest ones.
+
+        :param list queries: strings to search
+        :param list domain: additional domain
+        :param str where: additional SQL condition on the table of the model
+        :param int limit: maximum number of records
+        :param int offset: number of records to skip
+        :return tuple: (found records, total number of matching records)
+        """
+        trgm, unaccent = self._get_search_text_features()
+        column = '"{}"."{}"'.format(self._table, self._search_text_field)
+        expr = self._search_text_expr(column, unaccent)
+
+        def _text(value):
+            return "oomusic_unaccent({})".format(value) if unaccent else value
+
+        self.flush()
+        query = self._where_calc(domain or [])
+        self._apply_ir_rules(query, "read")
+        from_clause, where_clause, where_params = query.get_sql()
+
+        conditions = [where_clause] if where_clause else []
+        params = list(where_params)
+        for q in queries:
+            conditions.append("{} ILIKE {}".format(expr, _text("%s")))
+            params.append("%{}%".format(escape_psql(q)))
+        if where:
+            conditions.append(where)
+
+        order = ["{} ILIKE {} DESC".format(expr, _text("%s"))]
+        order_params = ["{}%".format(escape_psql(queries[0]))]
+        if trgm:
+            order.append("similarity({}, {}) DESC".format(expr, _text("%s")))
+            order_params.append(queries[0])
+        order += ["length({})".format(expr), '"{}".id'.format(self._table)]
+
+        sql = """
+            SELECT "{table}".id, count(*) OVER ()
+            FROM {from_clause}
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT %s OFFSET %s
+        """.format(
+            table=self._table,
+            from_clause=from_clause,
+            where=" AND ".join(conditions),
+            order=", ".join(order),
+        )
+        self.env.cr.execute(sql, params + order_params + [limit, offset])
+        res = self.env.cr.fetchall()
+        if res:
+            return self.browse([r[0] for r in res]), res[0][1]
+        if not offset:
+            return self.browse(), 0
+
+        # Beyond the last result, the total must be counted separately
+        self.env.cr.execute(
+            "SELECT count(*) FROM {} WHERE {}".format(from_clause, " AND ".join(conditions)),
+            params,
+        )
+        return self.browse(), self.env.cr.fetchone()[0]
@@ -1,40 +1,105 @@
 # -*- coding: utf-8 -*-
 
+import fcntl
 import json
+import logging
+import math
 import os
+import subprocess
+import time
 from hashlib import sha1
-from shutil import copyfile
-from tempfile import gettempdir
-from time import sleep
+from multiprocessing import dummy as mp
 from urllib.parse import urlencode
-from zipfile import ZipFile
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models
 from odoo.exceptions import MissingError, UserError
+from odoo.tools import config
+
+from .oomusic_download import ZipStream
+from .oomusic_transcoder import evict_cache
+
+_logger = logging.getLogger(__name__)
+
+# Target loudness of the normalization, in LUFS, and maximum true peak after normalization, in dBTP
+LOUDNESS_TARGET = -18
+PEAK_LIMIT = -1
+
+# Maximum waiting time for an archive built by another request, in seconds
+ZIP_BUILD_TIMEOUT = 300
+
+
+def analyze_loudness(path):
+    """
+    Measure the loudness of a file according to EBU R128, thanks to the "loudnorm" filter of
+    FFmpeg.
+
+    :param str path: path of the file
+    :return: integrated loudness (LUFS), true peak (dBTP) and loudness range (LU), or False if the
+        file could not be analyzed
+    :rtype: tuple
+    :raises OSError: if FFmpeg is not available
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostats",
+        "-hide_banner",
+        "-i",
+        path,
+        "-map",
+        "0:a:0",
+        "-af",
+        "loudnorm=I={}:print_format=json".format(LOUDNESS_TARGET),
+        "-f",
+        "null",
+        "-",
+    ]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=600)
+    except subprocess.TimeoutExpired:
+        return False
+    # The measures are printed at the end of the output, as a JSON object
+    output = proc.stderr.decode("utf-8", "replace")
+    try:
+        res = json.loads(output[output.rindex("{") : output.rindex("}") + 1])
+        measures = (float(res["input_i"]), float(res["input_tp"]), float(res["input_lra"]))
+    except (ValueError, KeyError):
+        return False
+    return measures if all(math.isfinite(m) for m in measures) else False
+
+
+def get_gain(loudness, peak):
+    """
+    Gain to apply to reach the target loudness, limited to avoid clipping.
+
+    :param float loudness: integrated loudness, in LUFS
+    :param float peak: true peak, in dBTP
+    :return float: gain in dB
+    """
+    return round(min(LOUDNESS_TARGET - loudness, PEAK_LIMIT - peak), 2)
 
 
 class MusicTrack(models.Model):
     _name = "oomusic.track"
     _description = "Music Track"
     _order = "album_id, disc, track_number_int, track_number, path"
-    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin"]
+    _inherit = ["oomusic.download.mixin", "oomusic.preference.mixin", "oomusic.search.mixin"]
 
     create_date = fields.Datetime(index=True)
 
     # ID3 Tags
     name = fields.Char("Title", required=True, index=True)
     artist_id = fields.Many2one("oomusic.artist", string="Artist", index=True)
-    album_artist_id = fields.Many2one("oomusic.artist", string="Album Artist")
+    album_artist_id = fields.Many2one("oomusic.artist", string="Album Artist", index=True)
     album_id = fields.Many2one("oomusic.album", string="Album", index=True)
     disc = fields.Char("Disc", index=True)
     year = fields.Char("Year")
     track_number = fields.Char("Track #", index=True)
     track_number_int = fields.Integer("Track # (int)", index=True)
     track_total = fields.Char("Total Tracks")
-    genre_id = fields.Many2one("oomusic.genre", string="Genre")
+    genre_id = fields.Many2one("oomusic.genre", string="Genre", index=True)
     description = fields.Char("Description")
     composer = fields.Char("Composer")
-    performer_id = fields.Many2one("oomusic.artist", string="Original Artist")
+    performer_id = fields.Many2one("oomusic.artist", string="Original Artist", index=True)
     copyright = fields.Char("Copyright")
     contact = fields.Char("Contact")
     encoded_by = fields.Char("Encoder")
@@ -44,7 +109,27 @@ class MusicTrack(models.Model):
     duration_min = fields.Float("Duration (min)", readonly=True)
     bitrate = fields.Integer("Bitrate (kbps)", readonly=True)
     path = fields.Char("Path", required=True, index=True, readonly=True)
+    fingerprint = fields.Char(
+        "Fingerprint",
+        readonly=True,
+        help="Size and hash of the file, used to recognize a file which was moved or renamed.",
+    )
     size = fields.Float("File Size (MiB)", readonly=True)
+    loudness = fields.Float("Integrated Loudness (LUFS)", readonly=True)
+    true_peak = fields.Float("True Peak (dBTP)", readonly=True)
+    loudness_range = fields.Float("Loudness Range (LU)", readonly=True)
+    track_gain = fields.Float(
+        "Track Gain (dB)",
+        readonly=True,
+        help="Gain applied to reach the target loudness when the loudness is normalized.",
+    )
+    loudness_analyzed = fields.Boolean("Loudness Analyzed", readonly=True)
+    loudness_mtime = fields.Integer(
+        "Loudness Analysis Modification",
+        readonly=True,
+        help="Last modification of the file when its loudness was analyzed. The file is analyzed "
+        "again if it is modified.",
+    )
     play_count = fields.Integer(
         "Play Count",
         readonly=True,
@@ -154,34 +239,96 @@ class MusicTrack(models.Model):
     def _get_track_ids(self):
         return self
 
-    def _build_zip(self, flatten=False, name=False):
-        # Name is build using track ids, to avoid creating the same archive twice
-        name = "-".join([str(id) for id in self.ids]) + ("-1" if flatten else "-0")
-        name = sha1(name.encode("utf-8")).hexdigest()
-        tmp_dir = gettempdir()
-        z_name = os.path.join(tmp_dir, "{}.zip".format(name))
+    def _get_zip_files(self, flatten=False):
+        """
+        Files of the tracks and their names in a ZIP archive.
 
-        # If file exists return it instead of creating a new archive
-        if os.path.isfile(z_name):
-            return z_name
-
-        # Create the ZIP file
-        seq = 1
-        with ZipFile(z_name, "w") as z_file:
+        :param bool flatten: put all the files at the root of the archive
+        :returns: list of tuples (path, name in the archive)
+        """
+        if flatten:
             base_arcname = "{:0%sd}-{}" % len(str(len(self)))
-            for track in self:
-                if flatten:
-                    arcname = base_arcname.format(seq, os.path.split(track.path)[1])
-                    path = os.path.join(tmp_dir, arcname)
-                    copyfile(track.path, path)
-                    z_file.write(path, arcname=arcname)
-                    os.remove(path)
-                    seq += 1
-                else:
-                    path = track.path
-                    arcname = track.path.replace(track.root_folder_id.path, "")
-                    z_file.write(path, arcname=arcname)
-        sleep(0.2)
+            return [
+                (track.path, base_arcname.format(seq, os.path.split(track.path)[1]))
+                for seq, track in enumerate(self, 1)
+            ]
+        return [
+            (track.path, track.path.replace(track.root_folder_id.path, "").lstrip(os.sep))
+            for track in self
+        ]
+
+    def _zip_stream(self, flatten=False):
+        """
+        ZIP archive of the tracks, generated while it is sent.
+
+        :param bool flatten: put all the files at the root of the archive
+        :rtype: ZipStream
+        """
+        return ZipStream(self._get_zip_files(flatten=flatten))
+
+    def _get_zip_cache_size(self):
+        """
+        Maximum size of the archive cache, in bytes. A size of zero disables the cache.
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        return int(ConfigParam.get_param("oomusic.zip_cache_size", 1000)) * 1024 * 1024
+
+    def _build_zip(self, flatten=False):
+        """
+        Build the ZIP archive of the tracks in the archive cache. The archive is shared by all
+        users, and built again if a track is modified.
+        - The archive is written under a temporary name, and renamed once complete.
+        - If the archive is being built by another request, it waits for the end of the build. The
+          temporary file is locked during the build, so the one of a crashed process is reused.
+        - The least recently used archives are removed when the cache is full.
+
+        :param bool flatten: put all the files at the root of the archive
+        :returns: path of the archive, or False if the cache is disabled, the archive is larger
+            than the cache, or the build by another request lasts too long
+        """
+        stream = self._zip_stream(flatten=flatten)
+        max_size = self._get_zip_cache_size()
+        if len(stream) > max_size:
+            return False
+
+        key = "-".join(["{}:{}".format(t.id, t.last_modification) for t in self])
+        key += "-1" if flatten else "-0"
+        cache_dir = os.path.join(config["data_dir"], "oomusic_zip", self.env.cr.dbname)
+        os.makedirs(cache_dir, exist_ok=True)
+        z_name = os.path.join(cache_dir, "{}.zip".format(sha1(key.encode("utf-8")).hexdigest()))
+
+        part_name = z_name + ".part"
+        deadline = time.time() + ZIP_BUILD_TIMEOUT
+        while not os.path.isfile(z_name):
+            # The partial file is locked while it is written. The lock is released by the system
+            # if the process dies, so a partial file left by a crashed worker is built again.
+            z_file = open(part_name, "ab")
+            try:
+                fcntl.flock(z_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another request is building the archive
+                z_file.close()
+                if time.time() > deadline:
+                    return False
+                time.sleep(0.5)
+                continue
+            with z_file:
+                # The file may have been renamed by the previous owner of the lock
+                try:
+                    if os.stat(part_name).st_ino != os.fstat(z_file.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                try:
+                    z_file.truncate(0)
+                    for data in stream:
+                        z_file.write(data)
+                    z_file.flush()
+                    os.replace(part_name, z_name)
+                except Exception:
+                    os.remove(part_name)
+                    raise
+            evict_cache(cache_dir, max_size)
         return z_name
 
     def action_add_to_playlist(self):
@@ -214,6 +361,77 @@ class MusicTrack(models.Model):
             return
         return
 
+    @api.model
+    def cron_analyze_loudness(self, limit=1000, threads=None):
+        """
+        Analyze the loudness of the tracks which were not analyzed yet, or were modified since
+        their analysis. The files are analyzed in parallel, and the results are committed by
+        batches, so an interrupted run does not lose the analyses already done.
+
+        :param int limit: maximum number of tracks to analyze
+        :param int threads: number of files analyzed in parallel. By default, the highest number of
+            scan threads of the folders of the tracks (see `scan_threads` of `oomusic.folder`).
+        """
+        size_step = 50
+        self.flush(["last_modification", "loudness_mtime", "root_folder_id"])
+        self.env["oomusic.folder"].flush(["scan_threads"])
+        self.env.cr.execute(
+            """
+            SELECT t.id, t.path, t.last_modification, f.scan_threads
+            FROM oomusic_track t
+                LEFT JOIN oomusic_folder f ON f.id = t.root_folder_id
+            WHERE t.loudness_mtime IS DISTINCT FROM t.last_modification
+            ORDER BY t.id
+            LIMIT %s
+        """,
+            (limit,),
+        )
+        res = self.env.cr.fetchall()
+        if not res:
+            return
+        if threads is None:
+            threads = max(r[3] or 1 for r in res)
+        pool = mp.Pool(processes=max(threads, 1))
+        try:
+            for i in range(0, len(res), size_step):
+                rows = res[i : i + size_step]
+                measures = pool.map(analyze_loudness, [r[1] for r in rows])
+                tracks = self.browse()
+                for (track_id, path, mtime, _), measure in zip(rows, measures):
+                    vals = {"loudness_mtime": mtime, "loudness_analyzed": bool(measure)}
+                    if measure:
+                        vals.update(
+                            {
+                                "loudness": measure[0],
+                                "true_peak": measure[1],
+                                "loudness_range": measure[2],
+                                "track_gain": get_gain(measure[0], measure[1]),
+                            }
+                        )
+                    else:
+                        _logger.warning('Could not analyze the loudness of "%s"', path)
+                    track = self.browse(track_id)
+                    track.write(vals)
+                    tracks |= track
+                tracks.mapped("album_id")._update_album_gain()
+                if self.env.context.get("test_mode"):
+                    self.flush()
+                else:
+                    self.env.cr.commit()
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_norm_filter(self):
+        """
+        FFmpeg filter used to normalize the loudness of the track. If the loudness was analyzed, a
+        static gain is applied, which is much faster than the single-pass "loudnorm" filter.
+        """
+        self.ensure_one()
+        if self.loudness_analyzed and self.loudness_mtime == self.last_modification:
+            return "-af volume={:.2f}dB".format(self.track_gain)
+        return "-af loudnorm=I={}".format(LOUDNESS_TARGET)
+
     def _oomusic_info(self, seek=0, mode="standard"):
         self.ensure_one()
         params = {"seek": seek, "mode": mode}
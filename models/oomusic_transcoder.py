@@ -1,11 +1,378 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import heapq
+import itertools
+import logging
 import os
 import subprocess
+import threading
+import time
+from hashlib import sha1
 
-from odoo import fields, models
-from odoo.tools import OrderedSet
+from odoo import api, fields, models, registry
+from odoo.tools import OrderedSet, config
+
+_logger = logging.getLogger(__name__)
+
+# Serialize the eviction of the transcoding cache
+_cache_lock = threading.Lock()
+
+
+def evict_cache(cache_dir, max_size):
+    """
+    Remove the least recently used files of the transcoding cache, until its size is lower than
+    max_size. The modification date of a file is updated each time it is used. Partial files older
+    than an hour are removed as well.
+
+    :param str cache_dir: directory of the cache
+    :param int max_size: maximum size of the cache, in bytes
+    """
+    with _cache_lock:
+        entries = []
+        now = time.time()
+        for entry in os.scandir(cache_dir):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+                # Partial files left by an interrupted process would block the cache of a track
+                if entry.name.endswith(".part"):
+                    if now - stat.st_mtime > 3600:
+                        os.remove(entry.path)
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+# Priorities of the transcoding jobs. The lower the value, the higher the priority.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 5
+PRIORITY_BATCH = 10
+
+# Margin for the headers written by FFmpeg in an estimated output (ID3 tag, Xing frame)
+ESTIMATE_HEADER_SIZE = 4096
+
+
+class TranscodeBusy(Exception):
+    """
+    Raised when a transcoding job could not be started before the timeout.
+    """
+
+
+class TranscodeScheduler(object):
+    """
+    Limit the number of transcoding processes running at the same time, globally and per user.
+    The jobs which cannot be started are queued, and started by order of priority, then by order of
+    arrival. A job waiting for a user who reached their own limit does not block the other users.
+
+    The limits apply to the current server process.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.running = {}
+        self.queue = []
+        self.seq = itertools.count()
+
+    def _can_start_user(self, ticket):
+        return not ticket[3] or self.running.get(ticket[2], 0) < ticket[3]
+
+    def _can_start(self, ticket, max_jobs):
+        if sum(self.running.values()) >= max_jobs or not self._can_start_user(ticket):
+            return False
+        for other in sorted(self.queue):
+            if other is ticket:
+                return True
+            # A job of higher priority which could be started goes first
+            if self._can_start_user(other):
+                return False
+        return True
+
+    def acquire(self, user_id, priority, max_jobs, max_jobs_user=0, timeout=None):
+        """
+        Wait for a free slot, and reserve it.
+
+        :param int user_id: ID of the user requesting the job
+        :param int priority: priority of the job
+        :param int max_jobs: maximum number of jobs
+        :param int max_jobs_user: maximum number of jobs of the user. No limit if 0.
+        :param float timeout: maximum waiting time, in seconds. No limit if None.
+        :raises TranscodeBusy: if no slot was free before the timeout
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            ticket = (priority, next(self.seq), user_id, max_jobs_user)
+            heapq.heappush(self.queue, ticket)
+            try:
+                while not self._can_start(ticket, max_jobs):
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise TranscodeBusy()
+                    self.cond.wait(remaining)
+            finally:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()
+            self.running[user_id] = self.running.get(user_id, 0) + 1
+
+    def release(self, user_id):
+        """
+        Free a slot reserved with `acquire`.
+
+        :param int user_id: ID of the user who requested the job
+        """
+        with self.cond:
+            self.running[user_id] -= 1
+            if not self.running[user_id]:
+                del self.running[user_id]
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        :return dict: number of running and queued jobs
+        """
+        with self.cond:
+            return {"running": sum(self.running.values()), "queued": len(self.queue)}
+
+
+scheduler = TranscodeScheduler()
+
+
+class TranscodeJob(object):
+    """
+    File-like object reading the output of a transcoding process started by the scheduler. Closing
+    the object kills the process if it is still running, e.g. when the client disconnects, and
+    frees the slot of the scheduler.
+    """
+
+    def __init__(self, proc, user_id):
+        self.proc = proc
+        self.user_id = user_id
+        self.closed = False
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def wait(self):
+        return self.proc.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+        finally:
+            scheduler.release(self.user_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CacheWriter(object):
+    """
+    File-like object reading the output of a transcoding job, and writing it in the transcoding
+    cache at the same time. The cached file is only kept if the whole output was read and the
+    process succeeded. Only one process can write a given cached file: if it is already being
+    written, the output is simply streamed.
+    """
+
+    def __init__(self, job, path, max_size):
+        self.job = job
+        self.path = path
+        self.tmp_path = path + ".part"
+        self.max_size = max_size
+        self.done = False
+        try:
+            self.cache = open(self.tmp_path, "xb")
+        except OSError:
+            self.cache = None
+
+    def read(self, size=-1):
+        data = self.job.read(size)
+        if self.cache:
+            if data:
+                self.cache.write(data)
+            else:
+                self._finalize()
+        return data
+
+    def _finalize(self):
+        self.cache.close()
+        self.cache = None
+        if self.job.wait() == 0:
+            os.replace(self.tmp_path, self.path)
+            self.done = True
+            evict_cache(os.path.dirname(self.path), self.max_size)
+        else:
+            os.remove(self.tmp_path)
+
+    def close(self):
+        # The client may disconnect before the end, the partial output is not kept
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+        self.job.close()
+
+
+class PartReader(object):
+    """
+    File-like object reading a file of the transcoding cache while it is still being written by a
+    `CacheWriter`. When the end of the file is reached, it waits for more data as long as the
+    partial file exists.
+    """
+
+    def __init__(self, part_path, offset, timeout=10):
+        self.part_path = part_path
+        self.timeout = timeout
+        self.file = open(part_path, "rb")
+        self.file.seek(offset)
+
+    def read(self, size=-1):
+        waited = 0.0
+        while True:
+            data = self.file.read(size)
+            if data:
+                return data
+            # Once renamed or removed, the file descriptor still allows reading the remaining data
+            if not os.path.exists(self.part_path) or waited >= self.timeout:
+                return self.file.read(size)
+            time.sleep(0.1)
+            waited += 0.1
+
+    def close(self):
+        self.file.close()
+
+
+class FixedLengthStream(object):
+    """
+    File-like object returning exactly `length` bytes of another file-like object: the output is
+    truncated, or padded with zeros. It is used to announce an estimated length for a transcoded
+    output. If `drain` is set and the whole length was read, the rest of the output is read when
+    closing, so that the transcoding cache can be completed.
+    """
+
+    def __init__(self, fileobj, length, drain=False):
+        self.fileobj = fileobj
+        self.remaining = length
+        self.drain = drain
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.fileobj.read(size) or b"\0" * size
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if self.drain and self.remaining <= 0:
+            while self.fileobj.read(65536):
+                pass
+        self.fileobj.close()
+
+
+# Cached files being prefetched in the current server process
+_prefetching = set()
+# Jobs waiting to be prefetched, by database and user. A user has at most one prefetching thread,
+# and the jobs not started yet are replaced by the ones of the next request.
+_prefetch_jobs = {}
+_prefetch_lock = threading.Lock()
+
+
+def start_transcode(cmd):
+    """
+    Start a transcoding process, with its output redirected to stdout.
+
+    :param list cmd: command line, see `MusicTranscoder._get_command`
+    :rtype: subprocess.Popen
+    """
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+
+
+def prefetch_track(dbname, uid, transcoder_id, track_id, norm, cache_path):
+    """
+    Transcode a track in the transcoding cache. The database is only accessed to prepare the job,
+    so no connection is held while waiting for the scheduler and transcoding.
+
+    :param str dbname: name of the database
+    :param int uid: ID of the user requesting the track
+    :param int transcoder_id: ID of the transcoder
+    :param int track_id: ID of the track
+    :param bool norm: normalization of the output
+    :param str cache_path: path of the cached file
+    :raises TranscodeBusy: if no slot was free before the timeout
+    """
+    with api.Environment.manage(), registry(dbname).cursor() as cr:
+        env = api.Environment(cr, uid, {})
+        Transcoder = env["oomusic.transcoder"].browse(transcoder_id)
+        cmd = Transcoder._get_command(track_id, norm=norm)
+        max_jobs, max_jobs_user, timeout = Transcoder._get_scheduler_params(PRIORITY_PREFETCH)
+        max_size = Transcoder._get_cache_size()
+
+    scheduler.acquire(uid, PRIORITY_PREFETCH, max_jobs, max_jobs_user, timeout=timeout)
+    try:
+        proc = start_transcode(cmd)
+    except Exception:
+        scheduler.release(uid)
+        raise
+    output = CacheWriter(TranscodeJob(proc, uid), cache_path, max_size)
+    try:
+        while output.read(65536):
+            pass
+    finally:
+        output.close()
+
+
+def prefetch_tracks(dbname, uid):
+    """
+    Transcode the tracks waiting to be prefetched for a user, one after the other. It is executed
+    in a separate thread, see `MusicTranscoder.prefetch`.
+
+    :param str dbname: name of the database
+    :param int uid: ID of the user requesting the tracks
+    """
+    key = (dbname, uid)
+    while True:
+        with _prefetch_lock:
+            jobs = _prefetch_jobs[key]
+            if not jobs:
+                del _prefetch_jobs[key]
+                return
+            transcoder_id, track_id, norm, cache_path = jobs.pop(0)
+        try:
+            prefetch_track(dbname, uid, transcoder_id, track_id, norm, cache_path)
+        except TranscodeBusy:
+            _logger.debug("No transcoding slot to prefetch track %s", track_id)
+        except Exception:
+            _logger.warning("Could not prefetch track %s", track_id, exc_info=True)
+        finally:
+            with _prefetch_lock:
+                _prefetching.discard(cache_path)
 
 
 class MusicTranscoder(models.Model):
@@ -67,19 +434,257 @@ class MusicTranscoder(models.Model):
         :rtype: subprocess.Popen
         """
         self.ensure_one()
+        return start_transcode(self._get_command(track_id, bitrate=bitrate, seek=seek, norm=norm))
+
+    def _get_command(self, track_id, bitrate=0, seek=0, norm=False):
+        """
+        Command line of a transcoding, with the specific keywords replaced. See `transcode`.
 
+        :param track_id: ID of the track to transcode
+        :param bitrate: value of the bitrate for the output file
+        :param seek: start time for the encoding
+        :param norm: normalization of the output
+        :returns: command line
+        :rtype: list
+        """
+        self.ensure_one()
         Track = self.env["oomusic.track"].browse([track_id])
         cmd = (
             self.command.replace("%s", "%s" % (str(datetime.timedelta(seconds=seek))))
             .replace("%b", "%d" % (bitrate or self.bitrate))
-            .replace("%n", "-af loudnorm=I=-18" if norm else "")
+            .replace("%n", Track._get_norm_filter() if norm else "")
             .replace("%f", "%s" % os.path.splitext(Track.path)[1][1:])
         )
         cmd = [c for c in cmd.split(" ") if c]
         cmd[cmd.index("%i")] = Track.path
+        return cmd
+
+    def _get_cache_path(self, track_id, bitrate=0, norm=False):
+        """
+        Return the path of the transcoding cache file for a given track. The key takes into account
+        the file (path and last modification date), the transcoder and its parameters.
+
+        :param track_id: ID of the track to transcode
+        :param bitrate: value of the bitrate for the output file
+        :param norm: normalization of the output
+        :returns: path of the cached file, or False if the cache is disabled
+        """
+        self.ensure_one()
+        max_size = self._get_cache_size()
+        if not max_size:
+            return False
+        Track = self.env["oomusic.track"].sudo().browse([track_id])
+        key = "{}-{}-{}-{}-{}-{}".format(
+            Track.path,
+            Track.last_modification,
+            self.id,
+            self.write_date,
+            bitrate or self.bitrate,
+            norm and Track._get_norm_filter(),
+        )
+        cache_dir = os.path.join(config["data_dir"], "oomusic_transcode", self.env.cr.dbname)
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(
+            cache_dir,
+            "{}.{}".format(sha1(key.encode("utf-8")).hexdigest(), self.output_format.name),
+        )
+
+    def _estimate_length(self, track_id, bitrate=0):
+        """
+        Estimate the length of the output, for constant bitrate transcoders only, i.e. the ones
+        using the "-b:a" option of FFmpeg. Only MP3 is supported: since it is made of independent
+        frames, the output can be padded or started at any time offset.
+
+        The recorded duration is rounded down and FFmpeg adds headers, so the length is
+        over-estimated: padding the output is harmless, while truncating it would cut the end of
+        the track.
+
+        :param track_id: ID of the track to transcode
+        :param bitrate: value of the bitrate for the output file
+        :returns: estimated length in bytes, or False if it cannot be estimated
+        """
+        self.ensure_one()
+        if "-b:a %b" not in self.command or self.output_format.name != "mp3":
+            return False
+        Track = self.env["oomusic.track"].sudo().browse([track_id])
+        if not Track.duration:
+            return False
+        length = int((Track.duration + 1) * (bitrate or self.bitrate) * 1000 / 8)
+        return length + ESTIMATE_HEADER_SIZE
+
+    def _open_part(self, cache_path, offset):
+        """
+        Open the file of the transcoding cache being written, if the requested offset is already
+        available.
 
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
-        return proc
+        :param str cache_path: path of the cached file, see `_get_cache_path`
+        :param int offset: position to read from
+        :returns: file-like object, or False if not available
+        """
+        part_path = cache_path + ".part"
+        try:
+            if os.path.getsize(part_path) > offset:
+                return PartReader(part_path, offset)
+        except OSError:
+            pass
+        return False
+
+    def _get_cache_size(self):
+        """
+        Maximum size of the transcoding cache, in bytes. A size of zero disables the cache.
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        return int(ConfigParam.get_param("oomusic.trans_cache_size", 500)) * 1024 * 1024
+
+    def transcode_stream(self, track_id, bitrate=0, seek=0, norm=False):
+        """
+        Transcode a track, and return a file-like object to read the output. Unless the track is
+        seeked, the output is written in the transcoding cache at the same time, see
+        `_get_cache_path`.
+
+        :param track_id: ID of the track to transcode
+        :param bitrate: value of the bitrate for the output file. Optional field aimed to override
+            the default value
+        :param seek: start time for the encoding
+        :param norm: normalization of the output
+        :returns: file-like object with the transcoding output
+        """
+        self.ensure_one()
+        job = self.transcode_job(track_id, bitrate=bitrate, seek=seek, norm=norm)
+        cache_path = not seek and self._get_cache_path(track_id, bitrate=bitrate, norm=norm)
+        if not cache_path:
+            return job
+        return CacheWriter(job, cache_path, self._get_cache_size())
+
+    def transcode_job(self, track_id, bitrate=0, seek=0, norm=False, priority=None):
+        """
+        Transcode a track through the scheduler, which limits the number of processes running at
+        the same time. If the limit is reached, the job waits for a free slot, see
+        `_get_scheduler_params`.
+
+        :param track_id: ID of the track to transcode
+        :param bitrate: value of the bitrate for the output file. Optional field aimed to override
+            the default value
+        :param seek: start time for the encoding
+        :param norm: normalization of the output
+        :param priority: priority of the job, PRIORITY_INTERACTIVE by default
+        :returns: transcoding job, to close once done
+        :rtype: TranscodeJob
+        :raises TranscodeBusy: if no slot was free before the timeout
+        """
+        self.ensure_one()
+        priority = PRIORITY_INTERACTIVE if priority is None else priority
+        max_jobs, max_jobs_user, timeout = self._get_scheduler_params(priority)
+
+        scheduler.acquire(self.env.uid, priority, max_jobs, max_jobs_user, timeout=timeout)
+        try:
+            proc = self.transcode(track_id, bitrate=bitrate, seek=seek, norm=norm)
+        except Exception:
+            scheduler.release(self.env.uid)
+            raise
+        return TranscodeJob(proc, self.env.uid)
+
+    @api.model
+    def _get_scheduler_params(self, priority):
+        """
+        Limits of a transcoding job in the scheduler. Interactive and prefetch jobs wait at most
+        `oomusic.trans_queue_timeout` seconds, while batch jobs wait without limit. The limit per
+        user only applies to interactive jobs, so a conversion can use all the available slots
+        when nobody is listening.
+
+        :param int priority: priority of the job
+        :returns: maximum number of jobs, maximum number of jobs of the user, timeout
+        :rtype: tuple
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        max_jobs = int(ConfigParam.get_param("oomusic.trans_max_jobs", 8))
+        max_jobs_user = 0
+        timeout = None
+        if priority in (PRIORITY_INTERACTIVE, PRIORITY_PREFETCH):
+            timeout = float(ConfigParam.get_param("oomusic.trans_queue_timeout", 30))
+        if priority == PRIORITY_INTERACTIVE:
+            max_jobs_user = int(ConfigParam.get_param("oomusic.trans_max_jobs_user", 3))
+        return max_jobs, max_jobs_user, timeout
+
+    @api.model
+    def prefetch(self, track_ids, norm=False):
+        """
+        Transcode tracks in advance in the transcoding cache, in a background thread. The tracks
+        are transcoded in the first format available for browsers, with the lowest priority for
+        interactive usage. Tracks already cached or being transcoded are skipped.
+
+        Each user has at most one prefetching thread. If it is already running, the tracks it did
+        not start yet are replaced by the new ones, since the user moved in the playlist.
+
+        :param list track_ids: IDs of the tracks to transcode, by order of priority
+        :param norm: normalization of the output
+        :returns: paths of the cached files to prefetch
+        :rtype: list
+        """
+        output_formats = self._get_browser_output_formats()
+        if not output_formats or not self._get_cache_size():
+            return []
+        output_format = list(output_formats)[0]
+
+        candidates = []
+        for Track in self.env["oomusic.track"].browse(track_ids):
+            fn_ext = os.path.splitext(Track.path)[1][1:]
+            Transcoder = self._get_transcoder(output_format, fn_ext)
+            if not Transcoder:
+                continue
+            cache_path = Transcoder._get_cache_path(Track.id, norm=norm)
+            if os.path.isfile(cache_path) or os.path.isfile(cache_path + ".part"):
+                continue
+            candidates.append((Transcoder.id, Track.id, norm, cache_path))
+
+        # The thread would not see the data of the test transaction
+        testing = getattr(threading.currentThread(), "testing", False)
+        if testing or self.env.context.get("test_mode"):
+            with _prefetch_lock:
+                return [j[3] for j in candidates if j[3] not in _prefetching]
+
+        key = (self.env.cr.dbname, self.env.uid)
+        with _prefetch_lock:
+            pending = _prefetch_jobs.get(key)
+            if pending is not None:
+                _prefetching.difference_update(j[3] for j in pending)
+                del pending[:]
+            jobs = [j for j in candidates if j[3] not in _prefetching]
+            _prefetching.update(j[3] for j in jobs)
+            if pending is not None:
+                pending.extend(jobs)
+            elif jobs:
+                _prefetch_jobs[key] = list(jobs)
+        if jobs and pending is None:
+            thread = threading.Thread(
+                target=prefetch_tracks, args=key, name="oomusic_prefetch_{}".format(key[1])
+            )
+            thread.daemon = True
+            thread.start()
+        return [j[3] for j in jobs]
+
+    @api.model
+    def _get_transcoder(self, output_format, fn_ext):
+        """
+        Return the transcoder with the highest priority to convert a file into a given format.
+
+        :param str output_format: name of the output format
+        :param str fn_ext: extension of the input file
+        :returns: transcoder, or an empty recordset if none is available
+        """
+        Transcoder = self.search([("output_format.name", "=", output_format)]).filtered(
+            lambda r: fn_ext not in r.mapped("black_formats.name")
+        )
+        return Transcoder[:1]
+
+    @api.model
+    def get_transcode_stats(self):
+        """
+        Return the number of transcoding jobs running and queued in the current server process.
+
+        :return dict: number of running and queued jobs
+        """
+        return scheduler.stats()
 
     def _get_browser_output_formats(self):
         return OrderedSet(
@@ -1,6 +1,43 @@
 # -*- coding: utf-8 -*-
 
-from odoo import _, api, fields, models
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from odoo import _, api, fields, models, tools
+
+# Time spent checking the Subsonic credentials in the current server process
+_subsonic_auth_stats = {"count": 0, "hits": 0, "time": 0.0}
+_subsonic_auth_lock = threading.Lock()
+
+# Credentials checked by the Subsonic API in the current server process, by database and login.
+# Only a keyed digest of the passwords is kept, the key being specific to the process.
+SUBSONIC_CREDENTIAL_TTL = 300
+SUBSONIC_CREDENTIAL_SIZE = 1024
+_subsonic_credentials = OrderedDict()
+_subsonic_credential_key = os.urandom(32)
+
+# User whose credentials were just checked by the Subsonic API, in the current thread
+_subsonic_checked = threading.local()
+
+
+@contextmanager
+def subsonic_credential_checked(uid):
+    """
+    Skip the check of the password of a user during the standard authentication, since it was
+    already checked.
+
+    :param int uid: ID of the user
+    """
+    _subsonic_checked.uid = uid
+    try:
+        yield
+    finally:
+        _subsonic_checked.uid = False
 
 
 class ResUsers(models.Model):
@@ -13,6 +50,12 @@ class ResUsers(models.Model):
         help="Display events located at this maximum distance from your location. "
         "Set to zero to show all events.",
     )
+    oomusic_generation = fields.Integer(
+        "Library Generation",
+        readonly=True,
+        help="Incremented when the library of the user changes. It is used to validate the "
+        "responses cached by the Subsonic clients.",
+    )
 
     def __init__(self, pool, cr):
         """Override of __init__ to add access rights on latitude, longitude and max_distance.
@@ -36,10 +79,153 @@ class ResUsers(models.Model):
         )
         return User
 
+    def write(self, vals):
+        res = super(ResUsers, self).write(vals)
+        if "password" in vals or "active" in vals or "login" in vals:
+            self._clear_subsonic_credentials()
+        return res
+
     def unlink(self):
         # Manually unlink the root folder to trigger the deletion of all children and tracks. This
         # is really necessary, but performance-wise this has a major impact.
         self.env["oomusic.folder"].sudo().search(
             [("root", "=", True), ("user_id", "in", self.ids)]
         ).unlink()
+        self._clear_subsonic_credentials()
         super(ResUsers, self).unlink()
+
+    @api.model
+    def _bump_oomusic_generation(self, user_ids=None):
+        """
+        Increment the library generation of the users. The responses cached by the Subsonic
+        clients are then built again.
+
+        :param list user_ids: IDs of the users. By default, all users.
+        """
+        if user_ids is None:
+            self.env.cr.execute(
+                "UPDATE res_users SET oomusic_generation = COALESCE(oomusic_generation, 0) + 1"
+            )
+        elif user_ids:
+            self.env.cr.execute(
+                """
+                UPDATE res_users SET oomusic_generation = COALESCE(oomusic_generation, 0) + 1
+                WHERE id IN %s
+            """,
+                (tuple(user_ids),),
+            )
+        self.invalidate_cache(["oomusic_generation"], user_ids)
+
+    @api.model
+    @tools.ormcache()
+    def _get_oomusic_folder_sharing(self):
+        """
+        Check if the folders are shared amongst all users, see `oomusic.config.settings`. The cache
+        is cleared when the record rules are modified.
+
+        :return bool: the folders are shared
+        """
+        return not self.env.ref("oomusic.oomusic_track").sudo().perm_read
+
+    def _check_credentials(self, password):
+        # Already checked by the Subsonic API, see `subsonic_credential_checked`
+        if getattr(_subsonic_checked, "uid", False) == self.env.uid:
+            return
+        return super(ResUsers, self)._check_credentials(password)
+
+    @api.model
+    def _get_subsonic_credential_digest(self, password, stored):
+        """
+        Keyed digest of a password checked by the Subsonic API. It also depends on the password
+        stored in the database, so that a change of password invalidates it in all the server
+        processes.
+
+        :param password: password sent by the client
+        :param str stored: password stored in the database
+        :return str: digest
+        """
+        if not isinstance(password, bytes):
+            password = password.encode("utf-8")
+        msg = (stored or "").encode("utf-8") + b"\0" + password
+        return hmac.new(_subsonic_credential_key, msg, hashlib.sha256).hexdigest()
+
+    @api.model
+    def _get_subsonic_credential(self, login, password, stored):
+        """
+        Return the user whose credentials were already checked by the Subsonic API, if the entry
+        did not expire.
+
+        :param str login: login of the user
+        :param password: password sent by the client
+        :param str stored: password stored in the database
+        :return int: ID of the user, or False
+        """
+        key = (self.env.cr.dbname, login)
+        digest = self._get_subsonic_credential_digest(password, stored)
+        with _subsonic_auth_lock:
+            entry = _subsonic_credentials.get(key)
+            if not entry or entry[2] < time.time():
+                return False
+            _subsonic_credentials.move_to_end(key)
+            return hmac.compare_digest(entry[0], digest) and entry[1]
+
+    @api.model
+    def _set_subsonic_credential(self, login, password, stored, uid):
+        """
+        Record credentials checked by the Subsonic API. The least recently used entries are
+        evicted once the cache is full.
+
+        :param str login: login of the user
+        :param password: password sent by the client
+        :param str stored: password stored in the database
+        :param int uid: ID of the user
+        """
+        key = (self.env.cr.dbname, login)
+        digest = self._get_subsonic_credential_digest(password, stored)
+        with _subsonic_auth_lock:
+            _subsonic_credentials[key] = (digest, uid, time.time() + SUBSONIC_CREDENTIAL_TTL)
+            _subsonic_credentials.move_to_end(key)
+            while len(_subsonic_credentials) > SUBSONIC_CREDENTIAL_SIZE:
+                _subsonic_credentials.popitem(last=False)
+
+    def _clear_subsonic_credentials(self):
+        """
+        Remove the credentials of the users from the cache of the current server process. In the
+        other processes, the entries are invalidated by the change of the stored password, or
+        expire.
+        """
+        dbname = self.env.cr.dbname
+        uids = set(self.ids)
+        with _subsonic_auth_lock:
+            for key in [
+                k for k, v in _subsonic_credentials.items() if k[0] == dbname and v[1] in uids
+            ]:
+                del _subsonic_credentials[key]
+
+    @api.model
+    def _add_subsonic_auth_stats(self, duration, hit):
+        """
+        Record a check of the Subsonic credentials.
+
+        :param float duration: duration of the check, in seconds
+        :param bool hit: the credentials were found in the cache
+        """
+        with _subsonic_auth_lock:
+            _subsonic_auth_stats["count"] += 1
+            _subsonic_auth_stats["hits"] += int(hit)
+            _subsonic_auth_stats["time"] += duration
+
+    @api.model
+    def get_subsonic_auth_stats(self):
+        """
+        Return the statistics of the Subsonic credential checks in the current server process.
+
+        :return dict: number of checks, number of cache hits and average duration in ms
+        """
+        with _subsonic_auth_lock:
+            count = _subsonic_auth_stats["count"]
+            return {
+                "count": count,
+                "hits": _subsonic_auth_stats["hits"],
+                "time": count and _subsonic_auth_stats["time"] * 1000 / count,
+            }
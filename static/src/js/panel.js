@@ -339,7 +339,7 @@ var Panel = Widget.extend({
             return this._rpc({
                     model: 'oomusic.playlist.line',
                     method: 'oomusic_set_current',
-                    args: [[this.current_playlist_line_id]],
+                    args: [[this.current_playlist_line_id], this.shuffle],
                 })
                 .then(function () {
                     core.bus.trigger(
@@ -419,7 +419,7 @@ var Panel = Widget.extend({
 
     _infLoadNext: function () {
         var self = this;
-        var skip = !this.sound || !this.sound.playing() || this.repeat || this.shuffle ||
+        var skip = !this.sound || !this.sound.playing() || this.repeat ||
                    Math.ceil(this.user_seek + this.sound.seek()) + 30.0 < this.duration;
         if (skip) {
             return;
@@ -427,7 +427,7 @@ var Panel = Widget.extend({
         return this._rpc({
                 model: 'oomusic.playlist.line',
                 method: 'oomusic_next',
-                args: [[this.current_playlist_line_id], false],
+                args: [[this.current_playlist_line_id], this.shuffle],
             }, {
                 shadow: true,
             })
@@ -491,12 +491,14 @@ var Panel = Widget.extend({
 
     _onClickShuffle: function () {
         this.shuffle = true;
+        this.next_playlist_line_id = undefined;
         this.$el.find('.oom_shuffle_off').show();
         this.$el.find('.oom_shuffle').hide();
     },
 
     _onClickShuffleOff: function () {
         this.shuffle = false;
+        this.next_playlist_line_id = undefined;
         this.$el.find('.oom_shuffle').show();
         this.$el.find('.oom_shuffle_off').hide();
     },
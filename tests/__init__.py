@@ -8,3 +8,7 @@ from . import test_folder
 from . import test_playlist
 from . import test_sub_bookmark
 from . import test_sub_browsing
+from . import test_sub_listing
+from . import test_sub_searching
+from . import test_sub_system
+from . import test_transcoder
@@ -41,3 +41,52 @@ class TestOomusicAlbum(test_common.TestOomusicCommon):
         )
 
         self.cleanUp()
+
+    def test_10_loudness(self):
+        """
+        Test the loudness analysis and the album gain
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+
+        album1 = self.AlbumObj.search([("name", "=", "Album1")])
+        self.TrackObj.with_context(test_mode=True).cron_analyze_loudness()
+        album1.invalidate_cache()
+        for track in album1.track_ids:
+            self.assertEqual(track.loudness_mtime, track.last_modification)
+            if track.loudness_analyzed:
+                self.assertTrue(track._get_norm_filter().startswith("-af volume="))
+            else:
+                self.assertTrue(track._get_norm_filter().startswith("-af loudnorm="))
+
+        # Nothing left to analyze
+        track = album1.track_ids[0]
+        track.write({"loudness": -30.0})
+        self.TrackObj.with_context(test_mode=True).cron_analyze_loudness()
+        self.assertEqual(track.loudness, -30.0)
+
+        # The gain is limited by the true peak
+        album1.track_ids.write({"loudness_analyzed": True, "loudness": -20.0, "true_peak": -5.0})
+        album1._update_album_gain()
+        self.assertAlmostEqual(album1.album_gain, 2.0)
+        self.assertAlmostEqual(album1.album_peak, -5.0)
+        album1.track_ids.write({"true_peak": -2.0})
+        album1._update_album_gain()
+        self.assertAlmostEqual(album1.album_gain, 1.0)
+
+        self.cleanUp()
+
+    def test_20_loudness_settings(self):
+        """
+        Test the loudness analysis is activated independently of the other scheduled actions
+        """
+        cron = self.env.ref("oomusic.oomusic_analyze_loudness")
+        Settings = self.env["oomusic.config.settings"]
+        Settings.create({"cron": "inactive", "analyze_loudness": True}).execute()
+        self.assertTrue(cron.active)
+        self.assertFalse(self.env.ref("oomusic.oomusic_scan_folder").active)
+        self.assertTrue(Settings.create({}).analyze_loudness)
+
+        Settings.create({"cron": "active", "analyze_loudness": False}).execute()
+        self.assertFalse(cron.active)
+        self.assertFalse(Settings.create({}).analyze_loudness)
+        self.cleanUp()
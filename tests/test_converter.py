@@ -123,7 +123,7 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
         conv.with_context(test_mode=True).action_convert()
 
         self.assertEqual(conv.state, u"done")
-        # self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
         path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
         file1 = os.path.join(path, u"song1.mp3")
         file2 = os.path.join(path, u"song2.mp3")
@@ -162,7 +162,7 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
         conv.with_context(test_mode=True).action_convert()
 
         self.assertEqual(conv.state, u"done")
-        # self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
         path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
         file1 = os.path.join(path, u"song1.mp3")
         file2 = os.path.join(path, u"song2.mp3")
@@ -181,6 +181,107 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
                         break
                     sha1[path].update(data)
         self.assertEqual(len(set(sha1.values())), 2)
+        # No temporary file is left
+        self.assertFalse([f for f in os.listdir(os.path.dirname(file1)) if f.endswith(".tmp")])
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_30_queue(self):
+        """
+        Test the conversion queue: progress and cancellation
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create({})
+
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv.bitrate = 320
+        conv._onchange_album_id()
+        conv.action_run()
+        self.assertEqual((conv.lines_total, conv.lines_done, conv.progress), (2, 0, 0.0))
+
+        # Nothing is converted once cancelled
+        conv.action_cancel()
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"cancel")
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"cancel", u"cancel"])
+        self.assertEqual(conv.lines_done, 0)
+
+        # Run again
+        conv.action_draft()
+        conv.action_run()
+        conv.with_context(test_mode=True)._convert_next([conv.id], None)
+        self.assertEqual(conv.lines_done, 1)
+        self.assertEqual(conv.progress, 50.0)
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"waiting"])
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(conv.lines_done, 2)
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_40_sync(self):
+        """
+        Test the sync mode: only modified tracks are converted
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create({"mode": "sync"})
+
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv.bitrate = 320
+        conv._onchange_album_id()
+        conv.action_run()
+        self.assertEqual(conv.lines_done, 0)
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"done")
+        path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
+        file1 = os.path.join(path, u"song1.mp3")
+        file2 = os.path.join(path, u"song2.mp3")
+        self.assertTrue(os.path.isfile(file1))
+        self.assertTrue(os.path.isfile(file2))
+
+        # Nothing to convert
+        conv.action_run()
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(conv.lines_done, 2)
+
+        # A track modified after its conversion is converted again
+        os.utime(file1, (0, 0))
+        conv.action_run()
+        self.assertEqual(conv.state, u"running")
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"waiting", u"done"])
+        self.assertFalse(os.path.isfile(file1))
+        conv.with_context(test_mode=True).action_convert()
+        self.assertTrue(os.path.isfile(file1))
+
+        # The file of a removed track is deleted
+        conv.converter_line_ids.filtered(lambda r: r.track_id.name == "Song2").unlink()
+        conv.action_run()
+        self.assertEqual(conv.state, u"done")
+        self.assertFalse(os.path.isfile(file2))
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_50_convert_error(self):
+        """
+        Test a failed conversion does not leave a partial file
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create({"mode": "sync"})
+
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv._onchange_album_id()
+        track = conv.converter_line_ids.mapped("track_id").filtered(lambda r: r.name == "Song1")
+        with open(track.path, "wb") as f:
+            f.write(b"\0" * 1024)
+        conv.action_run()
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"error", u"done"])
+        path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
+        self.assertFalse(os.path.exists(os.path.join(path, u"song1.mp3")))
+        self.assertFalse(os.path.exists(os.path.join(path, u"song1.mp3.tmp")))
 
         self.cleanUp()
         shutil.rmtree(conv.dest_folder, True)
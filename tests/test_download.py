@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+import io
+import os
+import zipfile
+from unittest.mock import patch
+
+from odoo.addons.oomusic.models.oomusic_download import ZipStream
+from odoo.addons.oomusic.models.oomusic_track import MusicTrack
 
 from . import test_common, test_sub_common
 
@@ -28,6 +35,74 @@ class TestOomusicDownload(test_common.TestOomusicCommon):
             self.assertEqual(len(link), 1)
         self.cleanUp()
 
+    def test_10_zip_stream(self):
+        """
+        Test the generation of ZIP archives
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album = self.AlbumObj.search([("name", "=", "Album1")])
+        tracks = album._get_track_ids()
+
+        for flatten, names in [
+            (False, ["Artist1/Album1/song1.mp3", "Artist1/Album1/song2.mp3"]),
+            (True, ["1-song1.mp3", "2-song2.mp3"]),
+        ]:
+            stream = tracks._zip_stream(flatten=flatten)
+            data = b"".join(stream)
+            self.assertEqual(len(data), len(stream))
+            z_file = zipfile.ZipFile(io.BytesIO(data))
+            self.assertEqual(z_file.namelist(), names)
+            self.assertIsNone(z_file.testzip())
+            with open(tracks[0].path, "rb") as f:
+                self.assertEqual(z_file.read(names[0]), f.read())
+
+        # ZIP64 extensions
+        class ZipStream64(ZipStream):
+            ZIP64_LIMIT = 0
+            ZIP64_COUNT_LIMIT = 0
+
+        stream = ZipStream64(tracks._get_zip_files())
+        data = b"".join(stream)
+        self.assertEqual(len(data), len(stream))
+        self.assertIsNone(zipfile.ZipFile(io.BytesIO(data)).testzip())
+
+        self.cleanUp()
+
+    def test_20_zip_cache(self):
+        """
+        Test the archive cache
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album = self.AlbumObj.search([("name", "=", "Album1")])
+        tracks = album._get_track_ids()
+
+        # The archive is built once, then reused
+        z_name = tracks._build_zip()
+        self.assertTrue(os.path.isfile(z_name))
+        self.assertEqual(tracks._build_zip(), z_name)
+        self.assertNotEqual(tracks._build_zip(flatten=True), z_name)
+        with open(z_name, "rb") as f:
+            self.assertEqual(f.read(), b"".join(tracks._zip_stream()))
+
+        # The partial file left by a crashed process is built again
+        os.remove(z_name)
+        with open(z_name + ".part", "wb") as f:
+            f.write(b"partial")
+        self.assertEqual(tracks._build_zip(), z_name)
+        self.assertFalse(os.path.isfile(z_name + ".part"))
+        with open(z_name, "rb") as f:
+            self.assertEqual(f.read(), b"".join(tracks._zip_stream()))
+
+        # A modified track leads to a new archive
+        tracks[0].last_modification += 1
+        self.assertNotEqual(tracks._build_zip(), z_name)
+
+        # Cache disabled
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.zip_cache_size", 0)
+        self.assertFalse(tracks._build_zip())
+
+        self.cleanUp()
+
 
 class TestOomusicDownloadController(test_sub_common.TestOomusicSubCommon):
     def test_00_url_access(self):
@@ -47,8 +122,27 @@ class TestOomusicDownloadController(test_sub_common.TestOomusicSubCommon):
         self.assertEqual(len(link), 1)
         res = self.url_open(link.url)
         self.assertEqual(res.status_code, 200)
+        self.assertEqual(int(res.headers["Content-Length"]), len(res.content))
+        self.assertIsNone(zipfile.ZipFile(io.BytesIO(res.content)).testzip())
 
         # Too many accesses
         res = self.url_open(link.url)
         self.assertEqual(res.status_code, 403)
         self.cleanUp()
+
+    def test_10_evicted_archive(self):
+        """
+        Test an archive evicted from the cache before being sent is streamed
+        """
+        track = self.TrackObj.search([("name", "=", "Song1")])
+        track.action_create_download_link()
+        link = self.env["oomusic.download"].search(
+            [("res_model", "=", track._name), ("res_id", "=", track.id)]
+        )
+        z_name = os.path.join(self.Folder.path, "evicted.zip")
+        with patch.object(MusicTrack, "_build_zip", return_value=z_name):
+            res = self.url_open(link.url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(int(res.headers["Content-Length"]), len(res.content))
+        self.assertIsNone(zipfile.ZipFile(io.BytesIO(res.content)).testzip())
+        self.cleanUp()
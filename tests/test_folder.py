@@ -76,3 +76,20 @@ class TestOomusicFolder(test_common.TestOomusicCommon):
         self.assertEqual(len(res2["track_ids"]), 2)
 
         self.cleanUp()
+
+    def test_30_locked(self):
+        """
+        Test the lock of a folder during a scan
+        """
+        self.assertFalse(self.Folder.locked)
+
+        params = (self.Folder.user_id.id, self.Folder.id)
+        self.env.cr.execute("SELECT pg_advisory_lock(%s, %s);", params)
+        self.Folder.invalidate_cache(["locked"])
+        self.assertTrue(self.Folder.locked)
+
+        self.env.cr.execute("SELECT pg_advisory_unlock(%s, %s);", params)
+        self.Folder.invalidate_cache(["locked"])
+        self.assertFalse(self.Folder.locked)
+
+        self.cleanUp()
@@ -6,8 +6,16 @@ import time
 
 import taglib
 
+from odoo.addons.oomusic.models.oomusic_folder_watch import FolderEventHandler
+
 from . import test_common
 
+# Watchdog is optional
+try:
+    from watchdog.events import DirMovedEvent, generate_sub_moved_events
+except ImportError:
+    DirMovedEvent = None
+
 
 class TestOomusicFolderScan(test_common.TestOomusicCommon):
     def test_00_initial_scan(self):
@@ -229,3 +237,257 @@ class TestOomusicFolderScan(test_common.TestOomusicCommon):
         self.assertEqual(0, len(Folder))
 
         self.cleanUp()
+
+    def test_40_scan_threads(self):
+        """
+        Test a scan of the folder with several threads
+        """
+        self.Folder.scan_threads = 4
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+
+        # Verify the music.track data
+        ref_data = {
+            "Song1": (u"01", u"Artist1", u"Album1", u"Genre1", u"2001"),
+            "Song2": (u"02", u"Artist1", u"Album1", u"Genre1", u"2001"),
+            "Song3": (u"01", u"Artist1", u"Album2", u"Genre2", u"2002"),
+            "Song4": (u"02", u"Artist1", u"Album2", u"Genre2", u"2002"),
+            "Song5": (u"01", u"Artist2", u"Album3", u"Genre3", u"2003"),
+            "Song6": (u"02", u"Artist2", u"Album3", u"Genre3", u"2003"),
+        }
+        self.assertEqual(set(Tracks.mapped("name")), set(ref_data.keys()))
+        for Track in Tracks:
+            self.assertEqual(
+                ref_data[Track.name],
+                (
+                    Track.track_number,
+                    Track.artist_id.name,
+                    Track.album_id.name,
+                    Track.genre_id.name,
+                    Track.year,
+                ),
+            )
+
+        self.cleanUp()
+
+    def test_50_create_related(self):
+        """
+        Test the batch creation of related objects, when a name is missing from the cache
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        artist = self.ArtistObj.search([("name", "=", "Artist1")])
+        genre = self.GenreObj.search([("name", "=", "Genre1")])
+
+        # Simulate a cache built before the creation of the artist and genre by another scan
+        cache = self.FolderScanObj._build_cache_global(self.Folder.id, self.Folder.user_id.id)
+        del cache["artist"]["Artist1"]
+        del cache["genre"]["Genre1"]
+        vals_list = [
+            {"album_id": "Album4", "artist_id": "Artist1", "genre_id": "Genre1"},
+            {"album_id": "Album4", "artist_id": "Artist4", "genre_id": "Genre1"},
+        ]
+        self.FolderScanObj._create_related(vals_list, cache, self.Folder.path)
+
+        self.assertEqual(cache["artist"]["Artist1"], artist.id)
+        self.assertEqual(cache["genre"]["Genre1"], genre.id)
+        self.assertEqual(len(self.ArtistObj.search([("name", "=", "Artist4")])), 1)
+        self.assertEqual(len(self.AlbumObj.search([("name", "=", "Album4")])), 1)
+
+        self.cleanUp()
+
+    def test_60_dir_signature(self):
+        """
+        Test the detection of a changed folder when its modification date is not reliable
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+
+        # The walk lists the same folders than os.walk
+        rootdirs = [w[0] for w in self.FolderScanObj._walk(self.Folder.path)]
+        self.assertEqual(set(rootdirs), {w[0] for w in os.walk(self.Folder.path)})
+        Folders = self.FolderObj.search([("path", "in", rootdirs)])
+        self.assertEqual(len(Folders), 6)
+        self.assertTrue(all(Folders.mapped("dir_signature")))
+
+        # Add a file without changing the modification date of the folder
+        album_dir = os.path.join(self.Folder.path, "Artist2", "Album3")
+        stat = os.stat(album_dir)
+        shutil.copy(os.path.join(album_dir, "song5.mp3"), os.path.join(album_dir, "song7.mp3"))
+        os.utime(album_dir, (stat.st_atime, stat.st_mtime))
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("path", "=", os.path.join(album_dir, "song7.mp3"))])
+        self.assertEqual(len(Tracks), 1)
+
+        self.cleanUp()
+
+    def test_70_watch_moves(self):
+        """
+        Test a scan restricted to the directories reported by the folder watcher, with moves
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album_dir = os.path.join(self.Folder.path, "Artist2", "Album3")
+        Tracks = self.TrackObj.search([("path", "=like", album_dir + "%")])
+        Track5 = Tracks.filtered(lambda t: t.name == "Song5")
+
+        # Move a directory and rename a file
+        new_dir = os.path.join(self.Folder.path, "Artist1", "Album3")
+        shutil.move(album_dir, new_dir)
+        os.rename(os.path.join(new_dir, "song5.mp3"), os.path.join(new_dir, "song7.mp3"))
+        moves = [
+            (album_dir, new_dir, True),
+            (os.path.join(new_dir, "song5.mp3"), os.path.join(new_dir, "song7.mp3"), False),
+        ]
+        subpaths = [os.path.dirname(album_dir), os.path.dirname(new_dir), new_dir]
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, subpaths=subpaths, moves=moves
+        )
+
+        # The tracks and the album are kept
+        self.assertEqual(set(Tracks.exists().ids), set(Tracks.ids))
+        self.assertEqual(Track5.path, os.path.join(new_dir, "song7.mp3"))
+        self.assertEqual(Track5.album_id.name, "Album3")
+        self.assertEqual(Track5.folder_id.path, new_dir)
+        self.assertEqual(Track5.folder_id.parent_id.path, os.path.dirname(new_dir))
+        self.assertEqual(len(self.AlbumObj.search([("name", "=", "Album3")])), 1)
+        self.assertEqual(len(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])), 6)
+
+        self.cleanUp()
+
+    def test_75_watch_dir_events(self):
+        """
+        Test the moves of a directory, as reported by the observer of the folder watcher
+        """
+        if DirMovedEvent is None:
+            self.skipTest("watchdog is not installed")
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        artist_dir = os.path.join(self.Folder.path, "Artist1")
+        new_dir = os.path.join(self.Folder.path, "Artist3")
+        Tracks = self.TrackObj.search([("path", "=like", artist_dir + os.sep + "%")])
+
+        # The observer reports the move of the directory, then the moves of all its children
+        os.rename(artist_dir, new_dir)
+        events = [DirMovedEvent(artist_dir, new_dir)]
+        events += list(generate_sub_moved_events(artist_dir, new_dir))
+        self.assertTrue(len(events) > 1)
+
+        # The watcher only keeps the move of the directory
+        handler = FolderEventHandler(self.env.cr.dbname, self.Folder.id, self.Folder.path, ["mp3"])
+        for event in events:
+            handler.on_any_event(event)
+        handler.cancel()
+        self.assertEqual(handler.moves, [(artist_dir, new_dir, True)])
+
+        # The scan keeps the tracks, even if all the moves are applied
+        moves = [(e.src_path, e.dest_path, e.is_directory) for e in events]
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, subpaths=[self.Folder.path, new_dir], moves=moves
+        )
+        self.assertEqual(set(Tracks.exists().ids), set(Tracks.ids))
+        for Track in Tracks:
+            self.assertTrue(Track.path.startswith(new_dir + os.sep))
+        self.assertEqual(len(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])), 6)
+
+        self.cleanUp()
+
+    def test_80_clean_directory(self):
+        """
+        Test the cleaning of a directory does not affect the directories sharing a common prefix
+        """
+        artist_dir = os.path.join(self.Folder.path, "Artist2")
+        shutil.copytree(artist_dir, artist_dir + "b")
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(len(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])), 8)
+
+        shutil.rmtree(os.path.join(artist_dir, "Album3"))
+        self.FolderScanObj._clean_directory(artist_dir, self.Folder.user_id.id)
+        self.FolderScanObj._clean_tags(self.Folder.user_id.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.assertEqual(len(Tracks), 6)
+        self.assertFalse(Tracks.filtered(lambda t: t.path.startswith(artist_dir + os.sep)))
+        self.assertEqual(len(self.FolderObj.search([("path", "=like", artist_dir + "%")])), 3)
+        self.assertEqual(len(self.AlbumObj.search([("name", "=", "Album3")])), 1)
+
+        self.cleanUp()
+
+    def test_90_move_fingerprint(self):
+        """
+        Test a moved file is recognized by its fingerprint, and the track is kept. The missing
+        fingerprints are filled in by the scan.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        old_path = os.path.join(self.Folder.path, "Artist1", "Album1", "song1.mp3")
+        new_dir = os.path.join(self.Folder.path, "Artist2", "Album3")
+        Track = self.TrackObj.search([("path", "=", old_path)])
+        fingerprint = Track.fingerprint
+        self.assertTrue(fingerprint)
+
+        # The fingerprint of an unchanged track is filled in if it is missing
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.env.cr.execute(
+            "UPDATE oomusic_track SET fingerprint = NULL WHERE id IN %s", (tuple(Tracks.ids),)
+        )
+        Tracks.invalidate_cache(["fingerprint"])
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(Track.fingerprint, fingerprint)
+        self.assertTrue(all(Tracks.mapped("fingerprint")))
+
+        shutil.move(old_path, os.path.join(new_dir, "song9.mp3"))
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+
+        self.assertTrue(Track.exists())
+        self.assertEqual(Track.path, os.path.join(new_dir, "song9.mp3"))
+        self.assertEqual(Track.folder_id.path, new_dir)
+        self.assertEqual(Track.album_id.name, "Album1")
+        self.assertEqual(Track.album_id.folder_id.path, new_dir)
+        self.assertEqual(len(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])), 6)
+
+        self.cleanUp()
+
+    def test_95_scan_stats(self):
+        """
+        Test the statistics of the scan
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.Folder.scan_dirs_visited, 6)
+        self.assertEqual(self.Folder.scan_dirs_skipped, 0)
+        self.assertEqual(self.Folder.scan_files_parsed, 6)
+        self.assertEqual(self.Folder.scan_tracks_created, 6)
+        self.assertEqual(self.Folder.scan_tracks_updated, 0)
+        self.assertEqual(self.Folder.scan_errors, 0)
+
+        # Nothing changed, all folders are skipped
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.Folder.scan_dirs_visited, 6)
+        self.assertEqual(self.Folder.scan_dirs_skipped, 6)
+        self.assertEqual(self.Folder.scan_files_parsed, 0)
+        self.assertEqual(self.Folder.scan_tracks_created, 0)
+
+        self.cleanUp()
+
+    def test_96_has_image(self):
+        """
+        Test the image flag of the folders is set by the scan
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album_dir = os.path.join(self.Folder.path, "Artist1", "Album1")
+        Folder = self.FolderObj.search([("path", "=", album_dir)])
+        Folders = self.FolderObj.search([("id", "child_of", self.Folder.id)])
+        self.assertEqual(Folders.mapped("has_image"), [False] * len(Folders))
+
+        # Add a cover
+        with open(os.path.join(album_dir, "cover.png"), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertTrue(Folder.has_image)
+
+        # Folders never checked are updated, even if they did not change
+        Folders.flush()
+        self.env.cr.execute(
+            "UPDATE oomusic_folder SET has_image = NULL WHERE id IN %s", (tuple(Folders.ids),)
+        )
+        Folders.invalidate_cache(["has_image"])
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.Folder.scan_dirs_skipped, 6)
+        self.assertEqual(Folders.filtered("has_image"), Folder)
+
+        self.cleanUp()
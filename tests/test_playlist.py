@@ -319,3 +319,41 @@ class TestOomusicPlaylist(test_common.TestOomusicCommon):
         playlist.playlist_line_ids[3].with_context(test_mode=True).oomusic_set_current()
         playlist.invalidate_cache()
         self.assertEqual(last_track, playlist.playlist_line_ids[1].track_id)
+
+    def test_50_next_lines(self):
+        """
+        Test the order of the next lines and their prefetching
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+
+        playlist = self.PlaylistObj.create({"name": "crotte"})
+        playlist.artist_id = self.ArtistObj.search([("name", "=", "Artist1")])
+        playlist._onchange_artist_id()
+        lines = playlist.playlist_line_ids
+
+        # Regular order
+        self.assertEqual(lines[1]._get_next_lines(2), lines[2:4])
+        self.assertEqual(lines[3]._get_next_lines(2), lines[0:2])
+        self.assertEqual(lines[0]._get_next_lines(10), lines[1:] + lines[0])
+
+        # Shuffle order is known in advance
+        shuffled = lines.sorted(key=lambda r: (r.shuffle_key, r.id))
+        self.assertEqual(shuffled[0]._get_next_lines(3, shuffle=True), shuffled[1:])
+        res = json.loads(shuffled[0].with_context(test_mode=True).oomusic_shuffle())
+        self.assertEqual(res["track_id"], shuffled[1].track_id.id)
+
+        # A new shuffle order is drawn at the end of the current one
+        keys = lines.mapped("shuffle_key")
+        shuffled[-1].with_context(test_mode=True).oomusic_set_current(shuffle=True)
+        self.assertNotEqual(lines.mapped("shuffle_key"), keys)
+
+        # Prefetch the next tracks, in the first format available for browsers
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.trans_prefetch", 2)
+        paths = lines[0].with_context(test_mode=True)._prefetch()
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_1")
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(paths[0], Transcoder._get_cache_path(lines[1].track_id.id))
+        playlist.audio_mode = "raw"
+        self.assertEqual(lines[0].with_context(test_mode=True)._prefetch(), [])
+
+        self.cleanUp()
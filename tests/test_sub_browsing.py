@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import os
 
 from . import test_sub_common
@@ -18,6 +19,72 @@ class TestOomusicSubBrowsing(test_sub_common.TestOomusicSubCommon):
             '    <musicFolder id="{}" name="folder_scan_test"/>'
             "  </musicFolders>".format(self.Folder.id),
         )
+
+        # JSON format
+        url = "/rest/getMusicFolders.view" + self.cred + "&f=json"
+        res = json.loads(self.url_open(url).content.decode("utf-8"))
+        self.assertEqual(
+            res["subsonic-response"]["musicFolders"],
+            {"musicFolder": [{"id": str(self.Folder.id), "name": "folder_scan_test"}]},
+        )
+        self.cleanUp()
+
+    def test_01_etag(self):
+        """
+        Test the conditional responses of the browsing endpoints
+        """
+        url = "/rest/getMusicFolders.view" + self.cred
+        res = self.url_open(url)
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers["ETag"]
+        self.assertTrue(etag)
+
+        # Not modified, then served from the payload cache
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        res_cached = self.url_open(url)
+        self.assertEqual(res_cached.status_code, 200)
+        self.assertEqual(res_cached.headers["ETag"], etag)
+
+        # A change of the library changes the ETag
+        self.Folder.write({"name": "Music"})
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        self.assertIn('name="Music"', res.content.decode("utf-8"))
+
+        # A change of a preference of the user changes the ETag, without a library generation
+        etag = res.headers["ETag"]
+        generation = self.env.user.oomusic_generation
+        self.TrackObj.search([], limit=1).write({"star": "1"})
+        self.assertEqual(self.env.user.oomusic_generation, generation)
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        self.cleanUp()
+
+    def test_02_etag_sharing(self):
+        """
+        Test the conditional responses when the folders are shared amongst all users
+        """
+        url = "/rest/getMusicFolders.view" + self.cred
+        user = self.env["res.users"].create({"name": "Other User", "login": "oomusic_other"})
+
+        # A change of the library of another user does not matter if the folders are private
+        etag = self.url_open(url).headers["ETag"]
+        self.env["res.users"]._bump_oomusic_generation(user.ids)
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        # It does if the folders are shared
+        self.env["oomusic.config.settings"].create({"folder_sharing": "active"}).execute()
+        etag = self.url_open(url).headers["ETag"]
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.env["res.users"]._bump_oomusic_generation(user.ids)
+        res = self.url_open(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
         self.cleanUp()
 
     def test_05_getIndexes(self):
@@ -215,3 +282,25 @@ class TestOomusicSubBrowsing(test_sub_common.TestOomusicSubCommon):
             "  </genres>".format(**data),
         )
         self.cleanUp()
+
+    def test_20_getSong_replay_gain(self):
+        """
+        Test the replay gain of the songs, with and without album
+        """
+        track = self.TrackObj.search([("name", "=", "Song1")])
+        track.write(
+            {"loudness_analyzed": True, "track_gain": -2.5, "true_peak": 0.0, "loudness": -15.5}
+        )
+        track.album_id.write({"album_gain": -3.0, "album_peak": 0.0})
+        url = "/rest/getSong.view" + self.cred + "&f=json&id={}".format(track.id)
+        res = json.loads(self.url_open(url).content.decode("utf-8"))["subsonic-response"]
+        self.assertEqual(
+            res["song"]["replayGain"],
+            {"trackGain": "-2.5", "trackPeak": "1.0", "albumGain": "-3.0", "albumPeak": "1.0"},
+        )
+
+        # A track without album only has a track gain
+        track.album_id = False
+        res = json.loads(self.url_open(url).content.decode("utf-8"))["subsonic-response"]
+        self.assertEqual(res["song"]["replayGain"], {"trackGain": "-2.5", "trackPeak": "1.0"})
+        self.cleanUp()
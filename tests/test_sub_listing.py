@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime as dt, timedelta
+
+from . import test_sub_common
+
+
+class TestOomusicSubListing(test_sub_common.TestOomusicSubCommon):
+    def _get_album_list2(self, params):
+        url = "/rest/getAlbumList2.view" + self.cred + "&f=json&" + params
+        res = json.loads(self.url_open(url).content.decode("utf-8"))["subsonic-response"]
+        albums = res["albumList2"].get("album", [])
+        return [a["name"] for a in (albums if isinstance(albums, list) else [albums])]
+
+    def test_00_year_int(self):
+        """
+        Test the numeric year of the albums
+        """
+        album = self.AlbumObj.search([("name", "=", "Album1")])
+        self.assertEqual(album.year_int, 2001)
+        album.year = "1999-05-03"
+        self.assertEqual(album.year_int, 1999)
+        album.year = "Unknown"
+        self.assertEqual(album.year_int, 0)
+        album.year = "1234567890123"
+        self.assertEqual(album.year_int, 1234)
+        self.cleanUp()
+
+    def test_10_getAlbumList2(self):
+        """
+        Test getAlbumList2 method
+        """
+        # Pagination
+        names = self._get_album_list2("type=alphabeticalByName&size=2")
+        self.assertEqual(names, ["Album1", "Album2"])
+        names = self._get_album_list2("type=alphabeticalByName&size=2&offset=2")
+        self.assertEqual(names, ["Album3"])
+
+        # Years are compared as numbers, in the requested direction
+        names = self._get_album_list2("type=byYear&fromYear=2003&toYear=2002")
+        self.assertEqual(names, ["Album3", "Album2"])
+        names = self._get_album_list2("type=byYear&fromYear=2002&toYear=10000")
+        self.assertEqual(names, ["Album2", "Album3"])
+
+        # An album appears once, ordered by its most recent play
+        now = dt.now()
+        for i, name in enumerate(["Song1", "Song5", "Song2"]):
+            track = self.TrackObj.search([("name", "=", name)])
+            track.last_play = now - timedelta(minutes=i)
+        names = self._get_album_list2("type=recent")
+        self.assertEqual(names, ["Album1", "Album3"])
+        names = self._get_album_list2("type=recent&offset=1")
+        self.assertEqual(names, ["Album3"])
+        self.cleanUp()
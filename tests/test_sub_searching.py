@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from . import test_sub_common
+
+
+class TestOomusicSubSearching(test_sub_common.TestOomusicSubCommon):
+    def _search(self, endpoint, params):
+        url = "/rest/{}.view".format(endpoint) + self.cred + "&f=json&" + params
+        return json.loads(self.url_open(url).content.decode("utf-8"))["subsonic-response"]
+
+    def test_00_search_text(self):
+        """
+        Test the search engine shared by the search methods
+        """
+        tracks, total = self.TrackObj._search_text(["SONG"], limit=2, offset=5)
+        self.assertEqual(len(tracks), 1)
+        self.assertEqual(total, 6)
+        tracks, total = self.TrackObj._search_text(["song"], limit=2, offset=10)
+        self.assertFalse(tracks)
+        self.assertEqual(total, 6)
+
+        # All queries must match
+        tracks, total = self.TrackObj._search_text(["song", "5"])
+        self.assertEqual(tracks.mapped("name"), ["Song5"])
+        self.assertEqual(total, 1)
+        albums, _ = self.AlbumObj._search_text(["album"])
+        self.assertEqual(sorted(albums.mapped("name")), ["Album1", "Album2", "Album3"])
+
+        # Only the name of a folder is searched
+        folders, _ = self.FolderObj._search_text(["folder_scan"])
+        self.assertEqual(folders, self.Folder)
+        self.cleanUp()
+
+    def test_10_search2(self):
+        """
+        Test search2 method
+        """
+        res = self._search("search2", "query=album&albumCount=2")
+        self.assertEqual(len(res["searchResult2"]["album"]), 2)
+        res = self._search("search2", "query=artist&songCount=0")
+        self.assertEqual(
+            sorted(a["name"] for a in res["searchResult2"]["artist"]), ["Artist1", "Artist2"]
+        )
+        self.assertNotIn("album", res["searchResult2"])
+        self.cleanUp()
+
+    def test_20_search3(self):
+        """
+        Test search3 method
+        """
+        res = self._search("search3", "query=ARTIST1")
+        self.assertEqual([a["name"] for a in res["searchResult3"]["artist"]], ["Artist1"])
+        res = self._search("search3", "query=song&songCount=3&songOffset=4")
+        self.assertEqual(len(res["searchResult3"]["song"]), 2)
+
+        res = self._search("search", "any=song&count=2")
+        self.assertEqual(res["searchResult"]["totalHits"], "6")
+        self.cleanUp()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from . import test_sub_common
+
+
+class TestOomusicSubSystem(test_sub_common.TestOomusicSubCommon):
+    def test_00_login_cache(self):
+        """
+        Test the cache of the credentials
+        """
+        Users = self.env["res.users"]
+        stats = Users.get_subsonic_auth_stats()
+        res = self.url_open("/rest/getLicense.view" + self.cred).content.decode("utf-8")
+        self.assertIn('status="ok"', res)
+        res = self.url_open("/rest/getLicense.view" + self.cred).content.decode("utf-8")
+        self.assertIn('status="ok"', res)
+        new_stats = Users.get_subsonic_auth_stats()
+        self.assertEqual(new_stats["count"], stats["count"] + 2)
+        self.assertGreaterEqual(new_stats["hits"], stats["hits"] + 1)
+
+        # The cache is invalidated when the password changes
+        Users.search([("login", "=", "admin")]).write({"password": "admin"})
+        stats = Users.get_subsonic_auth_stats()
+        res = self.url_open("/rest/getLicense.view" + self.cred).content.decode("utf-8")
+        self.assertIn('status="ok"', res)
+        new_stats = Users.get_subsonic_auth_stats()
+        self.assertEqual(new_stats["hits"], stats["hits"])
+        self.cleanUp()
+
+    def test_01_login_cache_entries(self):
+        """
+        Test the entries of the credential cache
+        """
+        Users = self.env["res.users"]
+        admin = Users.search([("login", "=", "admin")])
+        Users._set_subsonic_credential("admin", "pwd", "stored", admin.id)
+        self.assertEqual(Users._get_subsonic_credential("admin", "pwd", "stored"), admin.id)
+
+        # Another password, or a change of the stored password, do not match
+        self.assertFalse(Users._get_subsonic_credential("admin", "other", "stored"))
+        self.assertFalse(Users._get_subsonic_credential("admin", "pwd", "stored2"))
+
+        # The entries are removed when the user changes
+        admin.write({"active": True})
+        self.assertFalse(Users._get_subsonic_credential("admin", "pwd", "stored"))
+        self.cleanUp()
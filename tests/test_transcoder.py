@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import os
+from io import BytesIO
+
+from odoo.addons.oomusic.models.oomusic_transcoder import (
+    ESTIMATE_HEADER_SIZE,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_PREFETCH,
+    FixedLengthStream,
+    TranscodeBusy,
+    TranscodeScheduler,
+    evict_cache,
+)
+
+from . import test_common
+
+
+class TestOomusicTranscoder(test_common.TestOomusicCommon):
+    def test_00_cache(self):
+        """
+        Test the transcoding cache
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_0")
+
+        cache_path = Transcoder._get_cache_path(Track.id, bitrate=128)
+        if os.path.isfile(cache_path):
+            os.remove(cache_path)
+        self.assertNotEqual(cache_path, Transcoder._get_cache_path(Track.id, bitrate=64))
+
+        # A seeked track is not cached
+        stream = Transcoder.transcode_stream(Track.id, bitrate=128, seek=1)
+        data = stream.read()
+        stream.close()
+        self.assertTrue(data)
+        self.assertFalse(os.path.isfile(cache_path))
+
+        # The output is written in the cache once completely read
+        stream = Transcoder.transcode_stream(Track.id, bitrate=128)
+        data = b""
+        chunk = stream.read(1024)
+        while chunk:
+            data += chunk
+            chunk = stream.read(1024)
+        stream.close()
+        with open(cache_path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        # Eviction
+        evict_cache(os.path.dirname(cache_path), 0)
+        self.assertFalse(os.path.isfile(cache_path))
+
+        self.cleanUp()
+
+    def test_10_scheduler(self):
+        """
+        Test the limits of the transcoding scheduler
+        """
+        scheduler = TranscodeScheduler()
+        scheduler.acquire(1, 0, 2, max_jobs_user=1, timeout=0.1)
+        with self.assertRaises(TranscodeBusy):
+            scheduler.acquire(1, 0, 2, max_jobs_user=1, timeout=0.1)
+        self.assertEqual(scheduler.stats(), {"running": 1, "queued": 0})
+
+        # Another user can start a job, then the global limit is reached
+        scheduler.acquire(2, 0, 2, max_jobs_user=1, timeout=0.1)
+        with self.assertRaises(TranscodeBusy):
+            scheduler.acquire(3, 0, 2, max_jobs_user=1, timeout=0.1)
+
+        scheduler.release(1)
+        scheduler.release(2)
+        self.assertEqual(scheduler.stats(), {"running": 0, "queued": 0})
+
+    def test_15_scheduler_params(self):
+        """
+        Test the limits of the jobs depending on their priority
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        ConfigParam.set_param("oomusic.trans_max_jobs", 4)
+        ConfigParam.set_param("oomusic.trans_max_jobs_user", 2)
+        ConfigParam.set_param("oomusic.trans_queue_timeout", 10)
+        Transcoder = self.env["oomusic.transcoder"]
+        self.assertEqual(Transcoder._get_scheduler_params(PRIORITY_INTERACTIVE), (4, 2, 10.0))
+        # A prefetch job does not wait forever, since its thread waits for it
+        self.assertEqual(Transcoder._get_scheduler_params(PRIORITY_PREFETCH), (4, 0, 10.0))
+        self.assertEqual(Transcoder._get_scheduler_params(PRIORITY_BATCH), (4, 0, None))
+
+    def test_20_job_close(self):
+        """
+        Test closing a transcoding job kills the process and frees the slot
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_0")
+
+        stats = Transcoder.get_transcode_stats()
+        job = Transcoder.transcode_job(Track.id, priority=PRIORITY_BATCH)
+        self.assertEqual(Transcoder.get_transcode_stats()["running"], stats["running"] + 1)
+        job.read(1024)
+        job.close()
+        self.assertIsNotNone(job.proc.returncode)
+        self.assertEqual(Transcoder.get_transcode_stats(), stats)
+
+        self.cleanUp()
+
+    def test_30_estimate_length(self):
+        """
+        Test the estimation of the output length
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_0")
+        length = Transcoder._estimate_length(Track.id, bitrate=128)
+        self.assertEqual(length, int((Track.duration + 1) * 128 * 1000 / 8) + ESTIMATE_HEADER_SIZE)
+        self.assertFalse(self.env.ref("oomusic.oomusic_transcoder_3")._estimate_length(Track.id))
+
+        # The stream is padded or truncated to the estimated length
+        stream = FixedLengthStream(BytesIO(b"abc"), 5)
+        self.assertEqual(stream.read(4) + stream.read(4) + stream.read(4), b"abc\0\0")
+        stream = FixedLengthStream(BytesIO(b"abcdef"), 4)
+        self.assertEqual(stream.read() + stream.read(), b"abcd")
+
+        self.cleanUp()